@@ -0,0 +1,73 @@
+"""
+Row codec throughput: per-field Cipher objects vs one keyed AES-GCM context.
+
+  python benchmarks/bench_codec.py [rows]
+"""
+import base64
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from vault import Crypto
+
+
+def per_field_encrypt_row(key, row):
+  # the pre-batching implementation: a new Cipher per field
+  associated_data = bytes(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], 'utf-8')
+  encr_row = []
+  for field in row:
+    if not field:
+      encr_row.append('')
+      continue
+    iv, ciphertext, tag = Crypto.encrypt_aesgcm(key, bytes(field, 'utf-8'), associated_data)
+    encr_row.append(base64.urlsafe_b64encode(associated_data).decode('utf-8') + Crypto.delimiter
+                    + base64.urlsafe_b64encode(ciphertext).decode('utf-8') + Crypto.delimiter
+                    + base64.urlsafe_b64encode(iv).decode('utf-8') + Crypto.delimiter
+                    + base64.urlsafe_b64encode(tag).decode('utf-8'))
+  return encr_row
+
+
+def per_field_decrypt_row(key, encr_row):
+  row = []
+  for field in encr_row:
+    if not field:
+      row.append('')
+      continue
+    aad, ciphertext, iv, tag = [base64.urlsafe_b64decode(bytes(f, 'utf-8'))
+                                for f in field.split(Crypto.delimiter)]
+    row.append(Crypto.decrypt_aesgcm(key, aad, iv, ciphertext, tag).decode('utf-8'))
+  return row
+
+
+def rate(num_rows, func):
+  start = time.perf_counter()
+  result = func()
+  return result, num_rows / (time.perf_counter() - start)
+
+
+def main(num_rows):
+  key = os.urandom(32)
+  rows = [['account%d' % i, 'user%d@example.com' % i, 'P@ssw0rd-%d' % i, 'comment %d' % i]
+          for i in range(num_rows)]
+
+  encr, before_enc = rate(num_rows, lambda: [per_field_encrypt_row(key, r) for r in rows])
+  _, before_dec = rate(num_rows, lambda: [per_field_decrypt_row(key, r) for r in encr])
+  batch_encr, after_enc = rate(num_rows, lambda: Crypto.encrypt_rows(key, rows))
+  decr, after_dec = rate(num_rows, lambda: Crypto.decrypt_rows(key, batch_encr))
+
+  # both implementations must read each other's output
+  assert decr == rows
+  assert Crypto.decrypt_rows(key, encr) == rows
+  assert [per_field_decrypt_row(key, r) for r in batch_encr] == rows
+
+  print('rows: %d' % num_rows)
+  print('%-10s %14s %14s %8s' % ('', 'per-field/s', 'batched/s', 'speedup'))
+  print('%-10s %14.0f %14.0f %7.2fx' % ('encrypt', before_enc, after_enc, after_enc / before_enc))
+  print('%-10s %14.0f %14.0f %7.2fx' % ('decrypt', before_dec, after_dec, after_dec / before_dec))
+
+
+if __name__ == '__main__':
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,70 @@
+"""
+Memory retained by CSVTableModel storage, per row, excluding cell contents.
+
+Compares the current model with the layout it replaced: one list per row
+plus a list of per-row state dicts. Cells come from a small pool of shared
+strings, so the figures are the storage overhead alone.
+
+  python benchmarks/bench_memory.py [rows ...]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from ragasiyangal import CSVTableModel
+
+HEADERS = ['AccountName', 'Username', 'Password', 'Comments']
+POOL = ['cell-%d' % i for i in range(1000)]
+
+
+def rows(num_rows):
+  # lists, as produced by csv.reader and RowCodec.decrypt_rows
+  return [[POOL[(i + c) % len(POOL)] for c in range(len(HEADERS))] for i in range(num_rows)]
+
+
+def legacy_layout(data, modified):
+  table = data[1:]
+  state = [{'new': False, 'modified': False, 'deleted': False}] * len(table)
+  for row in range(0, len(table), max(1, len(table) // modified) if modified else len(table) + 1):
+    state[row] = {'new': False, 'modified': True, 'deleted': False}
+  return table, state
+
+
+def current_layout(data, modified):
+  model = CSVTableModel(None, data)
+  for row in range(0, len(data) - 1, max(1, (len(data) - 1) // modified) if modified else len(data)):
+    model._flags[row] |= CSVTableModel.MODIFIED
+  return model
+
+
+def retained(build, num_rows, modified):
+  gc.collect()
+  tracemalloc.start()
+  base = tracemalloc.get_traced_memory()[0]
+  data = [HEADERS] + rows(num_rows)
+  kept = build(data, modified)
+  del data
+  gc.collect()
+  size = tracemalloc.get_traced_memory()[0] - base
+  tracemalloc.stop()
+  del kept
+  return size
+
+
+def main(sizes):
+  print('%10s %10s %18s %18s %8s' % ('rows', 'modified', 'row lists B/row', 'current B/row', 'saved'))
+  for num_rows in sizes:
+    # a tenth of the rows edited, each of which got its own state dict before
+    for modified in (0, num_rows // 10):
+      legacy = retained(legacy_layout, num_rows, modified) / num_rows
+      current = retained(current_layout, num_rows, modified) / num_rows
+      print('%10d %10d %18.1f %18.1f %7.0f%%' % (num_rows, modified, legacy, current,
+                                               100 * (1 - current / legacy)))
+
+
+if __name__ == '__main__':
+  main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -0,0 +1,101 @@
+"""
+Cold start benchmark: time to first window and import time per module.
+
+Starts the GUI in fresh interpreters on the offscreen Qt platform, stops
+each one as soon as the main window has been shown and reports the median.
+
+  python benchmarks/bench_startup.py [--runs N] [--top N] [--json FILE]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# Runs in the child interpreter. The deferred work queued by main() marks
+# the point where the window is up and the event loop is running;
+# QApplication.exec is replaced so that the app returns right after it.
+CHILD = r"""
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, %(root)r)
+import ragasiyangal
+imported = time.perf_counter()
+marks = {}
+load_crypto = ragasiyangal.vault.load_crypto
+
+def deferred():
+  marks['shown'] = time.perf_counter()
+  load_crypto()
+  marks['ready'] = time.perf_counter()
+
+class FirstWindowApplication(ragasiyangal.QApplication):
+  def exec(self):
+    while 'ready' not in marks:
+      self.processEvents()
+    print('TIMES %%f %%f %%f' %% (imported - start, marks['shown'] - start, marks['ready'] - start))
+    return 0
+
+ragasiyangal.vault.load_crypto = deferred
+ragasiyangal.QApplication = FirstWindowApplication
+sys.exit(ragasiyangal.main(['ragasiyangal']))
+"""
+
+IMPORTTIME = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def run_once():
+  env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+  start = time.perf_counter()
+  proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD % {'root': ROOT}],
+                        env=env, capture_output=True, text=True, check=True)
+  total = time.perf_counter() - start
+  import_s, window_s, ready_s = [float(t) for t in
+                                 next(l for l in proc.stdout.splitlines() if l.startswith('TIMES')).split()[1:]]
+  modules = {}
+  for line in proc.stderr.splitlines():
+    match = IMPORTTIME.match(line)
+    if match:
+      self_us, cumulative_us, indent, name = match.groups()
+      modules[name] = (int(self_us), int(cumulative_us), len(indent))
+  return {'process_to_window_s': total - (ready_s - window_s), 'import_s': import_s,
+          'in_process_to_window_s': window_s, 'deferred_s': ready_s - window_s, 'modules': modules}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--top', type=int, default=15, help="modules to list, by cumulative import time")
+  parser.add_argument('--json', help="also write the results to this file")
+  args = parser.parse_args()
+
+  runs = [run_once() for _ in range(args.runs)]
+  summary = {key: statistics.median(run[key] for run in runs)
+             for key in ('process_to_window_s', 'import_s', 'in_process_to_window_s', 'deferred_s')}
+  # modules up to two levels below the script's own imports, median over runs
+  names = [name for name, (_, _, indent) in runs[-1]['modules'].items() if indent // 2 <= 2]
+  modules = {name: statistics.median(run['modules'][name][1] for run in runs if name in run['modules']) / 1e6
+             for name in names}
+  top = sorted(modules.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+  print('runs: %d (median)' % args.runs)
+  print('process start -> first window  %7.3f s' % summary['process_to_window_s'])
+  print('interpreter   -> first window  %7.3f s' % summary['in_process_to_window_s'])
+  print('import ragasiyangal            %7.3f s' % summary['import_s'])
+  print('deferred work after window     %7.3f s' % summary['deferred_s'])
+  print('\n%-45s %12s' % ('module', 'cumulative s'))
+  for name, seconds in top:
+    print('%-45s %12.4f' % (name, seconds))
+
+  if args.json:
+    with open(args.json, 'w') as fout:
+      json.dump({'summary': summary, 'modules': modules, 'runs': args.runs}, fout, indent=2)
+
+
+if __name__ == '__main__':
+  main()
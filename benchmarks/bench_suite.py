@@ -0,0 +1,288 @@
+"""
+Benchmark suite: crypto, file round trips and model operations on synthetic vaults.
+
+Generates vaults of the given sizes and times key derivation, row encrypt
+and decrypt, save and open as the main window does them, and CSVTableModel load,
+setData, insert, delete, bulk paste, delete and undelete, filter and sort
+on the offscreen Qt platform.
+Results are written as JSON; pass an earlier run to --compare to print
+the ratio of every timing against it.
+
+  python benchmarks/bench_suite.py [--rows N ...] [--cell-size N] [--repeat N]
+                                   [--only NAME ...] [--json FILE] [--compare FILE]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import ragasiyangal
+import vault
+from ragasiyangal import QApplication, QModelIndex, QRegularExpression, Qt, TableWidget, MainWindow
+from vault import Crypto, RowCodec
+
+HEADERS = ['AccountName', 'Username', 'Password', 'Comments']
+PASSWORD = 'Bench-m4rk!pass'
+# rows touched by the per-operation model benchmarks
+EDITS = 1000
+# rows touched by the bulk model benchmarks, in one operation each
+BULK = 10000
+
+
+def synthetic_rows(num_rows, cell_size, seed=0):
+  rand = random.Random(seed)
+  alphabet = string.ascii_letters + string.digits
+  def cell(prefix, i):
+    text = '%s%d-' % (prefix, i)
+    return text + ''.join(rand.choices(alphabet, k=max(0, cell_size - len(text))))
+  return [[cell('account', i), cell('user', i), cell('pw', i), cell('note', i)]
+          for i in range(num_rows)]
+
+
+def timed(func, repeat=1, setup=None):
+  """Runs func repeat times, calling setup before each run, and returns
+  (median seconds, min seconds, last result)."""
+  times, result = [], None
+  for _ in range(repeat):
+    state = setup() if setup else None
+    start = time.perf_counter()
+    result = func(state) if setup else func()
+    times.append(time.perf_counter() - start)
+  return statistics.median(times), min(times), result
+
+
+def record(results, name, timing, ops):
+  median, best, _ = timing
+  results[name] = {'seconds': median, 'min_seconds': best, 'ops': ops,
+                   'ops_per_s': ops / median if median else None}
+
+
+class Suite:
+
+  def __init__(self, cell_size, repeat, only):
+    self.cell_size = cell_size
+    self.repeat = repeat
+    self.only = only
+    self.window = MainWindow(TableWidget(None))
+    self.tmpdir = tempfile.mkdtemp(prefix='ragasiyangal-bench-')
+
+  def wanted(self, name):
+    return not self.only or any(name.startswith(prefix) for prefix in self.only)
+
+  def widget(self):
+    return self.window.table_widget
+
+  def model(self):
+    return self.widget().model.sourceModel()
+
+  def load(self, rows):
+    self.widget().update_model([HEADERS] + rows)
+    self.window.vault_kdf = None
+
+  def save(self, file_name):
+    # as the window saves the table under a new password: encrypted, written,
+    # verified against the model, and the model marked saved
+    model = self.model()
+    kdf = vault.KdfParams.new()
+    codec = RowCodec(vault.new_key(PASSWORD.encode(), kdf, self.window.key_cache))
+    encr_rows = model.encrypted_rows(codec)
+    vault.write_rows(file_name, kdf, encr_rows,
+                     verify=lambda saved_rows: model.verify_saved(codec, encr_rows, saved_rows))
+    model.mark_saved(codec, encr_rows)
+
+  def open(self, file_name):
+    # as the window opens a vault: decrypted whole below its lazy open
+    # threshold, and only the headers otherwise
+    with vault.VaultFile(file_name) as vault_file:
+      codec = RowCodec(vault_file.unlock(PASSWORD, self.window.key_cache))
+      encr_rows = vault_file.encr_rows
+      if len(encr_rows) - 1 < MainWindow.lazy_open_threshold:
+        decrypted = vault_file.rows(codec)[1:]
+      else:
+        decrypted = None
+        vault_file.headers(codec)
+    self.widget().update_model(encr_rows, codec, decrypted)
+
+  def fresh_model(self, rows):
+    def setup():
+      self.load(rows)
+      return self.model()
+    return setup
+
+  def run_kdf(self):
+    results = {}
+    if self.wanted('derive_key'):
+      salt = os.urandom(32)
+      record(results, 'derive_key',
+             timed(lambda: Crypto.derive_key(PASSWORD.encode(), salt), self.repeat), 1)
+    return results
+
+  def run_size(self, num_rows):
+    results = {}
+    rows = synthetic_rows(num_rows, self.cell_size)
+    key = os.urandom(32)
+    codec = RowCodec(key)
+    # the same work for both, so per-row and batched throughput compare directly
+    if self.wanted('encrypt_row'):
+      record(results, 'encrypt_row', timed(lambda: [codec.encrypt_row(r) for r in rows], self.repeat), num_rows)
+    encr_rows = codec.encrypt_rows(rows)
+    if self.wanted('decrypt_row'):
+      record(results, 'decrypt_row', timed(lambda encr_rows=encr_rows: [codec.decrypt_row(r) for r in encr_rows], self.repeat), num_rows)
+    if self.wanted('encrypt_rows'):
+      record(results, 'encrypt_rows', timed(lambda: codec.encrypt_rows(rows), self.repeat), num_rows)
+    if self.wanted('decrypt_rows'):
+      record(results, 'decrypt_rows', timed(lambda encr_rows=encr_rows: codec.decrypt_rows(encr_rows), self.repeat), num_rows)
+    # freed before the file benchmarks, which matters for the largest sizes
+    del encr_rows
+
+    file_name = os.path.join(self.tmpdir, 'vault-%d.csv' % num_rows)
+    # the key cache is cleared before every run, so each one pays for the KDF
+    # like the first save or open of a session does
+    def fresh_window(_=None):
+      self.load(rows)
+      self.window.key_cache.clear()
+    if self.wanted('save_file'):
+      record(results, 'save_file', timed(lambda _: self.save(file_name), self.repeat, fresh_window), num_rows)
+    elif self.wanted('open_file') or self.wanted('decrypt_file'):
+      vault.write_file(file_name, PASSWORD, [HEADERS] + rows)
+    if self.wanted('decrypt_file'):
+      def decrypt_file(_):
+        _, key, encr_rows = vault.read_file(file_name, PASSWORD, self.window.key_cache)
+        return Crypto.decrypt_rows(key, encr_rows)
+      record(results, 'decrypt_file',
+             timed(decrypt_file, self.repeat, lambda: self.window.key_cache.clear()), num_rows)
+    if self.wanted('open_file'):
+      record(results, 'open_file',
+             timed(lambda _: self.open(file_name), self.repeat, lambda: self.window.key_cache.clear()), num_rows)
+    if os.path.exists(file_name):
+      results['file_bytes'] = os.path.getsize(file_name)
+      os.remove(file_name)
+
+    if self.wanted('model_load'):
+      record(results, 'model_load', timed(lambda: self.load(rows), self.repeat), num_rows)
+    edits = min(EDITS, num_rows)
+    step = max(1, num_rows // edits)
+    if self.wanted('model_set_data'):
+      def set_data(model):
+        for i, row in enumerate(range(0, step * edits, step)):
+          model.setData(model.index(row, 2), 'changed-%d' % i, Qt.ItemDataRole.EditRole)
+      record(results, 'model_set_data', timed(set_data, self.repeat, self.fresh_model(rows)), edits)
+    if self.wanted('model_insert'):
+      def insert(model):
+        for _ in range(edits):
+          model.insertRows(model.rowCount(QModelIndex()), 1)
+      record(results, 'model_insert', timed(insert, self.repeat, self.fresh_model(rows)), edits)
+    if self.wanted('model_delete'):
+      # existing rows, which are marked for deletion rather than removed
+      def delete(model):
+        with contextlib.redirect_stdout(io.StringIO()):
+          for row in range(0, step * edits, step):
+            model.removeRows(row, 1)
+      record(results, 'model_delete', timed(delete, self.repeat, self.fresh_model(rows)), edits)
+    bulk = min(BULK, num_rows)
+    if self.wanted('model_bulk_paste'):
+      # pasted in the middle of the table
+      pasted = synthetic_rows(bulk, self.cell_size, seed=1)
+      record(results, 'model_bulk_paste',
+             timed(lambda model: model.paste_rows(num_rows // 2, pasted), self.repeat, self.fresh_model(rows)), bulk)
+    if self.wanted('model_bulk_delete') or self.wanted('model_bulk_undelete'):
+      # every other row, so each is a range of its own
+      scattered = range(0, 2 * bulk, 2) if 2 * bulk <= num_rows else range(bulk)
+      def mark(model):
+        with contextlib.redirect_stdout(io.StringIO()):
+          model.remove_rows(scattered)
+        return model
+      if self.wanted('model_bulk_delete'):
+        record(results, 'model_bulk_delete', timed(mark, self.repeat, self.fresh_model(rows)), bulk)
+      if self.wanted('model_bulk_undelete'):
+        def marked():
+          return mark(self.fresh_model(rows)())
+        record(results, 'model_bulk_undelete',
+               timed(lambda model: model.undelete_rows(scattered), self.repeat, marked), bulk)
+
+    self.load(rows)
+    proxy = self.widget().model
+    if self.wanted('filter'):
+      for name, text in (('filter_substring', 'user1'), ('filter_prefix', '^account2'),
+                         ('filter_column', 'Username:user3'), ('filter_regex', 'pw[0-9]+5-')):
+        def apply(text=text):
+          proxy.setFilterRegularExpression(QRegularExpression(
+            text, QRegularExpression.PatternOption.CaseInsensitiveOption))
+          return proxy.rowCount()
+        record(results, name, timed(apply, self.repeat), num_rows)
+        results[name]['matches'] = apply()
+      proxy.setFilterRegularExpression(QRegularExpression(''))
+
+    if self.wanted('sort'):
+      for name, column in (('sort_account', 0), ('sort_password', 2)):
+        def sort(column=column):
+          proxy.sort(column, Qt.SortOrder.AscendingOrder)
+          proxy.sort(-1)
+        record(results, name, timed(sort, self.repeat), num_rows)
+    return results
+
+
+def compare(results, baseline):
+  print('\n%-10s %-20s %12s %12s %8s' % ('rows', 'benchmark', 'baseline s', 'current s', 'ratio'))
+  for size, current in results['sizes'].items():
+    for name, timing in current.items():
+      before = baseline.get('sizes', {}).get(size, {}).get(name)
+      if isinstance(timing, dict) and isinstance(before, dict) and before['seconds']:
+        print('%-10s %-20s %12.4f %12.4f %7.2fx' % (size, name, before['seconds'], timing['seconds'],
+                                                   timing['seconds'] / before['seconds']))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+  parser.add_argument('--cell-size', type=int, default=24, help="characters per generated cell")
+  parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the median is reported")
+  parser.add_argument('--only', nargs='+', help="run only benchmarks whose names start with these")
+  parser.add_argument('--json', help="write the results to this file")
+  parser.add_argument('--compare', help="results of an earlier run to compare against")
+  args = parser.parse_args()
+
+  app = QApplication(sys.argv[:1])
+  vault.load_crypto()
+  suite = Suite(args.cell_size, args.repeat, args.only)
+  results = {
+    'version': ragasiyangal._VERSION_,
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cell_size': args.cell_size,
+    'repeat': args.repeat,
+    'kdf': suite.run_kdf(),
+    'sizes': {},
+  }
+  for name, timing in results['kdf'].items():
+    print('%-10s %-20s %12.4f s' % ('-', name, timing['seconds']))
+  for num_rows in args.rows:
+    size_results = suite.run_size(num_rows)
+    results['sizes'][str(num_rows)] = size_results
+    for name, timing in size_results.items():
+      if isinstance(timing, dict):
+        print('%-10d %-20s %12.4f s %14.0f /s' % (num_rows, name, timing['seconds'], timing['ops_per_s'] or 0))
+  os.rmdir(suite.tmpdir)
+
+  if args.json:
+    with open(args.json, 'w') as fout:
+      json.dump(results, fout, indent=2)
+  if args.compare:
+    with open(args.compare) as fin:
+      compare(results, json.load(fin))
+  del app
+
+
+if __name__ == '__main__':
+  main()
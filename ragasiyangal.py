@@ -1,90 +1,625 @@
 import csv
 
-# Needed for PyQt5
-import re
-from typing import List
+# Only needed for access to command line arguments
+import sys
+
+# Command line subcommands run headless, without ever loading PyQt6
+import vault
+if __name__=='__main__' and len(sys.argv) > 1 and sys.argv[1] in vault.COMMANDS:
+  sys.exit(vault.main(sys.argv[1:]))
 
 from PyQt6.QtCore import (Qt, QAbstractTableModel,
-                          QSortFilterProxyModel, pyqtSlot,
-                          QModelIndex, QRegularExpression)
-from PyQt6.QtGui import (QColor, QKeySequence, QFont, QAction)
+                          QAbstractProxyModel, pyqtSlot, pyqtSignal,
+                          QModelIndex, QRegularExpression, QTimer,
+                          QObject, QRunnable, QThreadPool, QFileSystemWatcher)
+from PyQt6.QtGui import (QColor, QKeySequence, QFont, QAction, QBrush,
+                         QFontMetrics)
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QTableView,
                              QWidget, QHeaderView, QHBoxLayout,
                              QSizePolicy, QFileDialog, QAbstractItemView,
                              QPushButton, QVBoxLayout, QInputDialog,
                              QLineEdit, QMessageBox)
-# Only needed for access to command line arguments
-import sys
-
-# Needed for crypto
+import bisect
+import functools
+import io
 import os
-import base64
-from datetime import datetime
-from cryptography.fernet import Fernet
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import (
-  Cipher, algorithms, modes
-)
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import threading
+import time
+from array import array
+
+from vault import (Crypto, KeyCache, RowCodec, SearchIndex, ColumnStore, natural_key, row_fingerprint,
+                   tracer, traced)
 
 _VERSION_ = "v1.0.6"
 
+# file dialog filter for vaults, in either format
+VAULT_FILES = "Vaults (*.csv *.txt *" + vault.BinaryVault.suffix + ");;CSV Files (*.csv *.txt);;" \
+              "Binary vaults (*" + vault.BinaryVault.suffix + ");;All files (*)"
+
 class CSVTableModel(QAbstractTableModel):
 
-  def __init__(self, parent=None, data=None):
+  # number of decrypted cells kept in memory when rows are loaded sealed
+  plaintext_cache_size = 10000
+
+  # row state flags
+  NEW = 1
+  MODIFIED = 2
+  DELETED = 4
+  # the row's plaintext has not been decrypted yet
+  SEALED = 8
+  # the row's ciphertext is current and can be saved as is
+  ENCRYPTED = 16
+
+  # sent before and after rows are removed in several ranges, with the
+  # (first, last) of each range, so that proxies can map the rows once
+  bulkRemoveStarted = pyqtSignal(list)
+  bulkRemoveFinished = pyqtSignal()
+  # sent when the first row that does not decrypt is found, possibly from
+  # a worker thread; see corrupt_rows
+  corruptRowFound = pyqtSignal()
+
+  def __init__(self, parent=None, data=None, codec=None, decrypted=None):
     super(CSVTableModel, self).__init__(parent)
-    self.load_data(data)
+    # vault.Journal recording each edit, set once the data belongs to a vault file
+    self.journal = None
+    self.load_data(data, codec, decrypted)
 
-  def load_data(self, data):
+  @traced('model_load')
+  def load_data(self, data, codec=None, decrypted=None):
+    """
+    Loads headers and rows. Without a codec, data holds plaintext.
+    With a codec, data holds the encrypted rows of a vault, headers first.
+    The encrypted rows are kept so that rows which are not changed can be
+    saved again without re-encrypting them (see encrypted_rows).
+    If decrypted holds the decrypted rows, they are used for display.
+    Otherwise rows are sealed: cells are decrypted on demand through a
+    bounded LRU keyed by the encrypted field, and a sealed row is decrypted
+    into plaintext once it is edited.
+    Cells are held in ColumnStores and row state in an array of flags.
+    """
     if data is None:
       data = [[],[]]
-    self._headers = data[0]
-    self._data = data[1:]
-    self.reset_state()
+    self._codec = codec
+    if codec is None:
+      self._headers = data[0]
+      self._encrypted_headers = None
+      self._plain = ColumnStore(len(self._headers), data[1:])
+      # no ciphertext until the rows are saved
+      self._cipher = None
+      flags = 0
+    else:
+      self._headers = codec.decrypt_row(data[0])
+      self._encrypted_headers = data[0]
+      self._cipher = ColumnStore(len(self._headers), data[1:])
+      if decrypted is not None:
+        self._plain = ColumnStore(len(self._headers), decrypted)
+        flags = CSVTableModel.ENCRYPTED
+      else:
+        self._plain = ColumnStore(len(self._headers))
+        self._plain.insert_empty(0, len(self._cipher))
+        flags = CSVTableModel.ENCRYPTED | CSVTableModel.SEALED
+      self._use_codec(codec)
+    self._flags = array('B', [flags]) * len(self._plain)
+    # stable row ids for the search index, which is built on first use
+    self._ids = array('q', range(len(self._plain)))
+    self._next_id = len(self._plain)
+    self._index = None
+    # column -> sort key of each row, None where not computed yet
+    self._sort_keys = {}
+    # row id -> vault.PasswordAudit flags and flaws of the last audit
+    self._audit = {}
+    self._audit_flaws = {}
+    self._audit_column = None
+    # row id -> the row in the file on disk (None if removed there), for rows
+    # edited both here and there since the vault was read
+    self._conflicts = {}
+    # ids of the sealed rows found not to decrypt, in a damaged file
+    self._corrupt = set()
+    # bumped whenever rows or cells change, for views caching results
+    self.generation = 0
+
+  def _use_codec(self, codec):
+    self._codec = codec
+    self._decrypt_cell = functools.lru_cache(maxsize=self.plaintext_cache_size)(codec.decrypt_field)
+    # the crypto modules are loaded once there is a codec
+    from cryptography.exceptions import InvalidTag
+    self._decrypt_errors = (InvalidTag, ValueError)
 
   def reset_state(self):
-    self._state = [{'new': False, 'modified': False, 'deleted': False}] * len(self._data)
+    keep = CSVTableModel.SEALED | CSVTableModel.ENCRYPTED
+    for row in range(len(self._flags)):
+      self._flags[row] &= keep
 
   def state(self, row):
-    return self._state[row]
+    flags = self._flags[row]
+    return {'new': bool(flags & CSVTableModel.NEW),
+            'modified': bool(flags & CSVTableModel.MODIFIED),
+            'deleted': bool(flags & CSVTableModel.DELETED)}
+
+  def new_rows(self):
+    return [row for row, flags in enumerate(self._flags) if flags & CSVTableModel.NEW]
+
+  def deleted_rows(self):
+    return [row for row, flags in enumerate(self._flags) if flags & CSVTableModel.DELETED]
+
+  def has_edits(self):
+    # whether any row is new, modified or deleted since the last save
+    edited = CSVTableModel.NEW | CSVTableModel.MODIFIED | CSVTableModel.DELETED
+    return any(flags & edited for flags in self._flags)
+
+  def cell(self, row, column):
+    if self._flags[row] & CSVTableModel.SEALED:
+      return self._open_cell(row, column)
+    return self._plain.cell(row, column)
+
+  def _open_cell(self, row, column, cached=True):
+    """
+    Decrypts a cell of a sealed row, through the plaintext LRU when cached.
+    A cell that does not decrypt reads as None, and its row is marked
+    corrupt: shown as such, and kept from being saved (see corrupt_rows).
+    """
+    value = self._cipher.cell(row, column)
+    if not value:
+      return value
+    try:
+      return self._decrypt_cell(value) if cached else self._codec.decrypt_field(value)
+    except self._decrypt_errors:
+      row_id = self._ids[row]
+      if row_id not in self._corrupt:
+        self._corrupt.add(row_id)
+        if len(self._corrupt) == 1:
+          self.corruptRowFound.emit()
+      return None
+
+  def _open_row(self, row):
+    # a sealed row, decrypted without going through the plaintext LRU
+    return [self._open_cell(row, column, cached=False) for column in range(len(self._headers))]
+
+  def corrupt_rows(self):
+    """The rows found not to decrypt so far, other than rows marked deleted"""
+    if not self._corrupt:
+      return []
+    return [row for row in self.rows_for_ids(self._corrupt) if not self._flags[row] & CSVTableModel.DELETED]
+
+  def check_corrupt(self):
+    """Raises vault.CorruptVault if rows that do not decrypt are to be saved"""
+    corrupt = self.corrupt_rows()
+    if corrupt:
+      raise vault.CorruptVault("%d rows do not decrypt, the file is damaged" % len(corrupt))
+
+  def row_id(self, row):
+    return self._ids[row]
+
+  def rows_for_ids(self, row_ids):
+    if not row_ids:
+      return []
+    rows = dict(zip(self._ids, range(len(self._ids))))
+    return sorted(rows[row_id] for row_id in row_ids)
+
+  def search_index(self):
+    if self._index is None:
+      # rows are read directly rather than through the plaintext LRU,
+      # which would otherwise be flushed by a full pass
+      self._index = SearchIndex((self._ids[row], self.plain_row(row)) for row in range(len(self._plain)))
+    return self._index
+
+  def row_ids(self):
+    return self._ids
+
+  def sort_keys(self, column):
+    """
+    The natural_key of each cell of column. Computed on first use and kept
+    per row afterwards: edited and inserted rows get their key on the next
+    call, and removed rows drop theirs.
+    """
+    keys = self._sort_keys.get(column)
+    if keys is None:
+      keys = self._sort_keys[column] = [None] * len(self._plain)
+    if None in keys:
+      for row, key in enumerate(keys):
+        if key is None:
+          # sealed cells are decrypted directly rather than through the plaintext LRU
+          if self._flags[row] & CSVTableModel.SEALED:
+            keys[row] = natural_key(self._open_cell(row, column, cached=False))
+          else:
+            keys[row] = natural_key(self._plain.cell(row, column))
+    return keys
+
+  def column_values(self, column):
+    """
+    (row id, plaintext) of column for the rows that are not deleted. Sealed
+    cells are decrypted directly rather than through the plaintext LRU.
+    """
+    for row in range(len(self._plain)):
+      flags = self._flags[row]
+      if flags & CSVTableModel.DELETED:
+        continue
+      if flags & CSVTableModel.SEALED:
+        yield self._ids[row], self._open_cell(row, column, cached=False)
+      else:
+        yield self._ids[row], self._plain.cell(row, column)
+
+  def set_audit(self, column, audit):
+    """Marks the rows flagged by audit, a vault.PasswordAudit of column (None to clear the marks)"""
+    self._audit = audit.flags() if audit is not None else {}
+    self._audit_flaws = audit.flaws if audit is not None else {}
+    self._audit_column = column
+    if len(self._plain):
+      self.dataChanged.emit(self.index(0, 0), self.index(len(self._plain) - 1, len(self._headers) - 1),
+                            [Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.ToolTipRole])
+
+  def plain_row(self, row):
+    """Like row(), but decrypts sealed rows without going through the plaintext LRU"""
+    if self._flags[row] & CSVTableModel.SEALED:
+      return self._open_row(row)
+    return self._plain.row(row)
+
+  def unseal(self, row):
+    if self._flags[row] & CSVTableModel.SEALED:
+      self._plain.set_row(row, self._open_row(row))
+      self._flags[row] &= ~CSVTableModel.SEALED
+
+  def codec(self):
+    return self._codec
+
+  def _reusable(self, codec, row):
+    # whether the row's ciphertext can be saved as is with codec
+    return codec is self._codec and self._flags[row] & CSVTableModel.ENCRYPTED
+
+  @traced('encrypted_rows')
+  def encrypted_rows(self, codec, progress=None):
+    """
+    Returns the headers and the rows that are not deleted, encrypted with
+    codec. If codec is the one the rows were loaded with, rows which have
+    not changed since keep their ciphertext and only the others are
+    encrypted, so the cost follows the number of edits.
+    """
+    reuse = codec is self._codec
+    encr_rows = [self._encrypted_headers if reuse else None]
+    dirty, dirty_rows = [], []
+    if encr_rows[0] is None:
+      dirty.append(0)
+      dirty_rows.append(self._headers)
+    for row in range(len(self._plain)):
+      if self._flags[row] & CSVTableModel.DELETED:
+        continue
+      if self._reusable(codec, row):
+        encr_rows.append(self._cipher.row(row))
+        continue
+      dirty.append(len(encr_rows))
+      encr_rows.append(None)
+      dirty_rows.append(self.plain_row(row))
+    self.check_corrupt()
+    for position, encr_row in zip(dirty, codec.encrypt_rows(dirty_rows, progress=progress)):
+      encr_rows[position] = encr_row
+    return encr_rows
+
+  def verify_saved(self, codec, encr_rows, saved_rows, check_all=False):
+    """
+    Checks saved_rows, read back one at a time from a file written with
+    encr_rows (as returned by encrypted_rows), against this model.
+    Every saved row must match what was written. Rows encrypted for this
+    save (every row, with check_all) are decrypted, which checks their
+    GCM tags, and compared with the plaintext in the model.
+    Raises ValueError on the first mismatch.
+    """
+    expected = iter(encr_rows)
+    def check(saved_row, encr_row, fresh, plain_row):
+      if saved_row != encr_row:
+        raise ValueError("Saved row differs from the row written")
+      if (check_all or fresh) \
+          and codec.decrypt_row(saved_row) != ['' if cell is None else cell for cell in plain_row()]:
+        raise ValueError("Saved row does not decrypt to the row in the table")
+    saved_rows = iter(saved_rows)
+    check(next(saved_rows, None), next(expected),
+          codec is not self._codec or self._encrypted_headers is None, lambda: self._headers)
+    for row in range(len(self._plain)):
+      if self._flags[row] & CSVTableModel.DELETED:
+        continue
+      check(next(saved_rows, None), next(expected),
+            not self._reusable(codec, row), lambda: self.plain_row(row))
+    if next(saved_rows, None) is not None:
+      raise ValueError("Saved file has more rows than the table")
+
+  def plain_rows(self):
+    """The headers and the rows that are not deleted, in plaintext"""
+    rows = [self._headers] + [self.plain_row(row) for row in range(len(self._plain))
+                              if not self._flags[row] & CSVTableModel.DELETED]
+    self.check_corrupt()
+    return rows
+
+  @traced('mark_saved')
+  def mark_saved(self, codec=None, encr_rows=None):
+    """
+    Updates the model in place after encr_rows (as returned by
+    encrypted_rows) were saved with codec: deleted rows are removed,
+    every row becomes clean and keeps the ciphertext it was saved with.
+    Without codec, after plain_rows() were saved as a binary vault, rows
+    become clean and keep whatever ciphertext they had.
+    """
+    self._remove_ranges(CSVTableModel.row_ranges(self.deleted_rows()))
+    if codec is not None:
+      if codec is not self._codec:
+        self._use_codec(codec)
+      # sealed rows now read the ciphertext they were saved with
+      self._encrypted_headers = encr_rows[0]
+      self._cipher = ColumnStore(len(self._headers), encr_rows[1:])
+      keep, saved = CSVTableModel.SEALED, CSVTableModel.ENCRYPTED
+    else:
+      keep, saved = CSVTableModel.SEALED | CSVTableModel.ENCRYPTED, 0
+    for row in range(len(self._flags)):
+      self._flags[row] = (self._flags[row] & keep) | saved
+    # the rows shown are the ones in the file now
+    self._conflicts = {}
+    self._renumber()
+    self.generation += 1
+    if len(self._plain):
+      self.dataChanged.emit(self.index(0, 0),
+                            self.index(len(self._plain) - 1, len(self._headers) - 1), [])
+
+  def _renumber(self):
+    """
+    Gives the rows the ids a vault.Journal replayed against the vault file
+    gives them, once the rows that are not new are the rows of the file, as
+    after a save: those rows are numbered in order, and the new rows after
+    them, as if inserted in order. Edits journaled from then on use the
+    ids replay uses. Everything keyed by row id is renumbered too.
+    """
+    file_rows = [row for row in range(len(self._flags)) if not self._flags[row] & CSVTableModel.NEW]
+    order = file_rows + self.new_rows()
+    if self._next_id == len(order) and all(self._ids[row] == row_id for row_id, row in enumerate(order)):
+      return
+    new_ids = {}
+    for row_id, row in enumerate(order):
+      new_ids[self._ids[row]] = row_id
+    self._ids = array('q', [new_ids[row_id] for row_id in self._ids])
+    self._next_id = len(order)
+    if self._index is not None:
+      self._index.renumber(new_ids)
+    self._audit = {new_ids[row_id]: flags for row_id, flags in self._audit.items() if row_id in new_ids}
+    self._audit_flaws = {new_ids[row_id]: flaws for row_id, flaws in self._audit_flaws.items() if row_id in new_ids}
+    self._conflicts = {new_ids[row_id]: row for row_id, row in self._conflicts.items() if row_id in new_ids}
+    self._corrupt = {new_ids[row_id] for row_id in self._corrupt}
+
+  def fingerprints(self):
+    """
+    Fingerprints of the rows as they are in the vault file, headers first,
+    with the row of each after the headers. Rows that are not in the file,
+    new rows, are left out. Edited rows keep the ciphertext they were read
+    with, so their fingerprint is that of the file too.
+    """
+    rows = [row for row in range(len(self._flags))
+            if not self._flags[row] & CSVTableModel.NEW and None not in self._cipher.row(row)]
+    return [row_fingerprint(self._encrypted_headers)] + [row_fingerprint(self._cipher.row(row)) for row in rows], rows
+
+  @traced('merge')
+  def merge(self, encr_rows, changes, decrypted, file_rows):
+    """
+    Applies the changes made to the vault file elsewhere, as returned by
+    vault.read_changes against fingerprints(), with file_rows the rows
+    fingerprints() returned alongside. Rows changed or removed in the file
+    are changed or removed here, and rows added there are inserted where
+    they are in the file. A row edited here and changed or removed there
+    keeps the edit, and is marked as a conflict; a row deleted here and
+    changed there takes the change, still marked deleted and as a conflict.
+    Changes are not journaled, since the file has them, and the rows are
+    renumbered as replay numbers them (see _renumber). Returns the number
+    of conflicts. Raises ValueError, changing nothing, if the columns changed.
+    """
+    if any(old == 0 or new == 0 for _, old, new in changes):
+      raise ValueError("The columns of the vault changed")
+    def position(old):
+      # model row of a row of the file as it was, or the end of those rows
+      if old <= len(file_rows):
+        return file_rows[old - 1]
+      return file_rows[-1] + 1 if file_rows else 0
+    # rows added before the same row are inserted together
+    added = {}
+    for kind, old, new in changes:
+      if kind == 'added':
+        added.setdefault(position(old), []).append(new)
+    operations = [(position(old), False, kind, new) for kind, old, new in changes if kind != 'added']
+    operations.extend((row, True, 'added', news) for row, news in added.items())
+    # applied bottom up, so that rows above keep their position; added rows
+    # go in after any change to the row they go before
+    operations.sort(key=lambda operation: (-operation[0], operation[1]))
+    conflicts = 0
+    for row, _, kind, new in operations:
+      if kind == 'added':
+        self._insert_file_rows(row, [decrypted[j] for j in new], [encr_rows[j] for j in new])
+        continue
+      row_id = self._ids[row]
+      flags = self._flags[row]
+      if kind == 'removed':
+        if flags & CSVTableModel.MODIFIED:
+          self._conflicts[row_id] = None
+          self._flags[row] = CSVTableModel.NEW
+          conflicts += 1
+        else:
+          self.beginRemoveRows(QModelIndex(), row, row)
+          self._delete_rows(row, 1)
+          self.endRemoveRows()
+      elif flags & CSVTableModel.MODIFIED:
+        # the row is saved from the plaintext here, over the file's version
+        self._conflicts[row_id] = decrypted[new]
+        self._cipher.set_row(row, encr_rows[new])
+        conflicts += 1
+      else:
+        if flags & CSVTableModel.DELETED:
+          self._conflicts[row_id] = decrypted[new]
+          conflicts += 1
+        if self._index is not None:
+          self._index.remove_row(row_id, self.plain_row(row))
+          self._index.add_row(row_id, decrypted[new])
+        self._plain.set_row(row, decrypted[new])
+        self._cipher.set_row(row, encr_rows[new])
+        self._flags[row] = CSVTableModel.ENCRYPTED | (flags & CSVTableModel.DELETED)
+        for keys in self._sort_keys.values():
+          keys[row] = None
+        self._audit.pop(row_id, None)
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self._headers) - 1), [])
+    # further edits are journaled against the file as it is now
+    self._renumber()
+    self.generation += 1
+    return conflicts
+
+  def _insert_file_rows(self, position, rows, encr_rows):
+    # inserts rows read from the vault file, clean and with their ciphertext
+    self.beginInsertRows(QModelIndex(), position, position + len(rows) - 1)
+    self._plain.insert(position, rows)
+    self._cipher.insert(position, encr_rows)
+    self._flags[position:position] = array('B', [CSVTableModel.ENCRYPTED]) * len(rows)
+    row_ids = array('q', range(self._next_id, self._next_id + len(rows)))
+    self._ids[position:position] = row_ids
+    self._next_id += len(rows)
+    for keys in self._sort_keys.values():
+      keys[position:position] = [None] * len(rows)
+    if self._index is not None:
+      for row_id, row in zip(row_ids, rows):
+        self._index.add_row(row_id, row)
+    self.generation += 1
+    self.endInsertRows()
+
+  def append_rows(self, rows):
+    """
+    Appends plaintext rows, as loaded rather than new rows, with a single
+    insert notification. Used to fill the model in batches.
+    """
+    if not rows:
+      return
+    first = len(self._plain)
+    self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+    self._plain.insert(first, rows)
+    if self._cipher is not None:
+      self._cipher.insert_empty(first, len(rows))
+    self._flags.extend(array('B', [0]) * len(rows))
+    self._ids.extend(range(self._next_id, self._next_id + len(rows)))
+    self._next_id += len(rows)
+    for keys in self._sort_keys.values():
+      keys.extend([None] * len(rows))
+    if self._index is not None:
+      for row in range(first, len(self._plain)):
+        self._index.add_row(self._ids[row], self._plain.row(row))
+    self.generation += 1
+    self.endInsertRows()
+
+  def _delete_rows(self, first, count):
+    # removes rows from storage and from the search index
+    if self._index is not None:
+      for row in range(first, first + count):
+        self._index.remove_row(self._ids[row], self.plain_row(row))
+    self._plain.delete(first, count)
+    if self._cipher is not None:
+      self._cipher.delete(first, count)
+    del self._flags[first:first + count]
+    if self._corrupt:
+      self._corrupt.difference_update(self._ids[first:first + count])
+    del self._ids[first:first + count]
+    for keys in self._sort_keys.values():
+      del keys[first:first + count]
+    self.generation += 1
+
+  @staticmethod
+  @functools.lru_cache(maxsize=None)
+  def render_roles():
+    # font, alignment and brushes shared by every cell, built once
+    font = QFont("Helvetica", 14)
+    deleted_font = QFont(font)
+    deleted_font.setStrikeOut(True)
+    return {
+      'font': font,
+      'deleted_font': deleted_font,
+      'alignment': Qt.AlignmentFlag.AlignLeft|Qt.AlignmentFlag.AlignVCenter,
+      'new': QBrush(QColor(Qt.GlobalColor.cyan)),
+      'modified': QBrush(QColor(Qt.GlobalColor.yellow)),
+      'deleted': QBrush(QColor(Qt.GlobalColor.darkGray)),
+      'weak': QBrush(QColor(Qt.GlobalColor.red)),
+      'reused': QBrush(QColor(Qt.GlobalColor.darkMagenta)),
+      'conflict': QBrush(QColor(255, 165, 0)),
+      'corrupt': QBrush(QColor(Qt.GlobalColor.magenta)),
+    }
 
   def data(self, index, role):
     if role == Qt.ItemDataRole.DisplayRole:
-      return self._data[index.row()][index.column()]
+      return self.cell(index.row(), index.column())
     elif role == Qt.ItemDataRole.FontRole:
-      sansFont = QFont("Helvetica", 14)
-      if self._state[index.row()]['deleted']:
-        sansFont.setStrikeOut(True)
-      return sansFont
+      if self._flags[index.row()] & CSVTableModel.DELETED:
+        return CSVTableModel.render_roles()['deleted_font']
+      return CSVTableModel.render_roles()['font']
     elif role == Qt.ItemDataRole.TextAlignmentRole:
-      return Qt.AlignmentFlag.AlignLeft|Qt.AlignmentFlag.AlignVCenter
+      return CSVTableModel.render_roles()['alignment']
     elif role == Qt.ItemDataRole.EditRole:
-      return self._data[index.row()][index.column()]
+      return self.cell(index.row(), index.column())
     elif role == Qt.ItemDataRole.BackgroundRole:
-      if self._state[index.row()]['new']:
-        return QColor(Qt.GlobalColor.cyan)
-      elif self._state[index.row()]['modified']:
-          return QColor(Qt.GlobalColor.yellow)
-      elif self._state[index.row()]['deleted']:
-        return QColor(Qt.GlobalColor.darkGray)
+      flags = self._flags[index.row()]
+      if self._corrupt and self._ids[index.row()] in self._corrupt:
+        return CSVTableModel.render_roles()['corrupt']
+      elif self._conflicts and self._ids[index.row()] in self._conflicts:
+        return CSVTableModel.render_roles()['conflict']
+      elif flags & CSVTableModel.NEW:
+        return CSVTableModel.render_roles()['new']
+      elif flags & CSVTableModel.MODIFIED:
+        return CSVTableModel.render_roles()['modified']
+      elif flags & CSVTableModel.DELETED:
+        return CSVTableModel.render_roles()['deleted']
+    elif role == Qt.ItemDataRole.ForegroundRole:
+      if self._audit:
+        flags = self._audit.get(self._ids[index.row()], 0)
+        if flags & vault.PasswordAudit.WEAK:
+          return CSVTableModel.render_roles()['weak']
+        elif flags:
+          return CSVTableModel.render_roles()['reused']
+    elif role == Qt.ItemDataRole.ToolTipRole:
+      row_id = self._ids[index.row()]
+      tips = []
+      if self._corrupt and row_id in self._corrupt:
+        tips.append("Could not be decrypted, the file is damaged. Delete the row to save the vault.")
+      if self._conflicts and row_id in self._conflicts:
+        disk_row = self._conflicts[row_id]
+        tips.append("Removed from the file on disk too." if disk_row is None else
+                    "Changed in the file on disk too, to: " + ", ".join(disk_row) + ".")
+        tips.append("Saving keeps the row as shown here.")
+      flags = self._audit.get(row_id, 0)
+      if flags:
+        tips.extend(vault.PasswordAudit.describe(flags, self._audit_flaws.get(row_id, 0)))
+      return '\n'.join(tips) if tips else None
     return None
 
   def setData(self, index, value, role):
     if not index.isValid():
       return False
-    if self._data[index.row()][index.column()] == value:
+    row = index.row()
+    old_value = self.cell(row, index.column())
+    if old_value == value:
       #if actual text has not changed, do nothing
       return False
-    self._data[index.row()][index.column()] = value
-    if not self._state[index.row()]['new']:
+    if self._index is not None:
+      self._index.update_cell(self._ids[row], index.column(), old_value, value)
+    self.unseal(row)
+    self._plain.set_cell(row, index.column(), value)
+    if index.column() in self._sort_keys:
+      self._sort_keys[index.column()][row] = None
+    if index.column() == self._audit_column and self._ids[row] in self._audit:
+      # the audit no longer applies to the new password
+      del self._audit[self._ids[row]]
+      self.dataChanged.emit(self.index(row, 0), self.index(row, len(self._headers) - 1),
+                            [Qt.ItemDataRole.ForegroundRole, Qt.ItemDataRole.ToolTipRole])
+    # the saved ciphertext is stale now; it is kept as the row's version in
+    # the file, to find the rows changed there (see fingerprints)
+    self._flags[row] &= ~CSVTableModel.ENCRYPTED
+    if not self._flags[row] & CSVTableModel.NEW:
       #existing row, mark it as edited
-      self._state[index.row()] = {'new': False, 'modified': True, 'deleted': False}
+      self._flags[row] = (self._flags[row] & ~CSVTableModel.DELETED) | CSVTableModel.MODIFIED
+    self.generation += 1
+    self._journal('set', self._ids[row], index.column(), '' if value is None else value)
     self.parent().table_view.clearSelection()
-    self.parent().table_view.resizeRowsToContents()
+    self.parent().resize_row(index)
     self.parent().parent().set_needs_save()
     return True
 
+  def headers(self):
+    return self._headers
+
   def headerData(self, section, orientation, role):
     if role != Qt.ItemDataRole.DisplayRole:
       return None
@@ -96,60 +631,515 @@ class CSVTableModel(QAbstractTableModel):
   def flags(self, index):
     return Qt.ItemFlag.ItemIsEnabled|Qt.ItemFlag.ItemIsEditable|Qt.ItemFlag.ItemIsSelectable
 
+  @staticmethod
+  def row_ranges(rows):
+    """The contiguous (first, last) ranges of rows, a sorted list of row numbers"""
+    ranges = []
+    for row in rows:
+      if ranges and ranges[-1][1] == row - 1:
+        ranges[-1] = (ranges[-1][0], row)
+      else:
+        ranges.append((row, row))
+    return ranges
+
   def insertRows(self , position , rows , parent=QModelIndex()):
-    # Ignore position. Always append to end of table
-    # self.beginInsertRows(QModelIndex(),position,position+rows-1)
-    self.beginInsertRows(QModelIndex(),len(self._data),len(self._data)+rows-1)
-    columns = len(self._headers)
-    for row in range(0, rows):
-      self._data.append([None] * columns)
-      self._state.append({'new': True, 'modified': False, 'deleted': False})
+    # new, empty rows before position, or at the end of the table
+    return self._insert_new(position, rows)
+
+  def paste_rows(self, position, rows):
+    """
+    Inserts plaintext rows, such as rows pasted from the clipboard, as new
+    rows before position, or at the end of the table.
+    """
+    num_columns = len(self._headers)
+    rows = [(['' if cell is None else str(cell) for cell in row] + [''] * num_columns)[:num_columns]
+            for row in rows]
+    return self._insert_new(position, len(rows), rows)
+
+  def _insert_new(self, position, count, rows=None):
+    # one insert notification and one journal record for all the rows
+    if count <= 0:
+      return False
+    position = max(0, min(position, len(self._plain)))
+    record = ['insert', self._next_id, count]
+    if position < len(self._plain) or rows is not None:
+      # the row inserted before, and the cells of the rows
+      record.append(self._ids[position] if position < len(self._plain) else '')
+    if rows is not None:
+      record.extend(cell for row in rows for cell in row)
+    self._journal(*record)
+    self.beginInsertRows(QModelIndex(), position, position + count - 1)
+    if rows is None:
+      self._plain.insert_empty(position, count)
+    else:
+      self._plain.insert(position, rows)
+    if self._cipher is not None:
+      self._cipher.insert_empty(position, count)
+    self._flags[position:position] = array('B', [CSVTableModel.NEW]) * count
+    row_ids = array('q', range(self._next_id, self._next_id + count))
+    self._ids[position:position] = row_ids
+    self._next_id += count
+    for keys in self._sort_keys.values():
+      keys[position:position] = [None] * count
+    if rows is not None and self._index is not None:
+      for row_id, row in zip(row_ids, rows):
+        self._index.add_row(row_id, row)
+    self.generation += 1
     self.endInsertRows()
     return True
 
   def removeRows(self , position , rows , parent=QModelIndex()):
-    if self._state[position]['new']:
-      #new row, just remove it from model and view
-      self.beginRemoveRows(QModelIndex(),position,position+rows-1)
-      for row in range(0, rows):
-        del self._data[position]
+    return self.remove_rows(range(position, position + rows))
+
+  def remove_rows(self, rows):
+    """
+    Removes rows, any collection of row numbers: new rows are removed from
+    the table, the others are marked for deletion until the next save.
+    Makes one journal record, and sends one notification per contiguous
+    range of rows removed or marked.
+    """
+    rows = sorted(set(rows))
+    if not rows:
+      return False
+    record = ['remove']
+    for first, last in CSVTableModel.row_ranges(rows):
+      record.extend((self._ids[first], last - first + 1))
+    self._journal(*record)
+    # existing rows are marked first, while the row numbers still hold
+    marked = [row for row in rows
+              if not self._flags[row] & (CSVTableModel.NEW | CSVTableModel.DELETED)]
+    keep = CSVTableModel.SEALED | CSVTableModel.ENCRYPTED
+    for row in marked:
+      self._flags[row] = (self._flags[row] & keep) | CSVTableModel.DELETED
+    for first, last in CSVTableModel.row_ranges(marked):
+      self.dataChanged.emit(self.index(first, 0), self.index(last, len(self._headers) - 1), [])
+    if marked:
+      print(marked[0] if len(marked) == 1 else "%d rows" % len(marked), "marked deleted")
+    # new rows are just removed from model and view
+    self._remove_ranges(CSVTableModel.row_ranges([row for row in rows if self._flags[row] & CSVTableModel.NEW]))
+    return True
+
+  def _remove_ranges(self, ranges):
+    # removes the (first, last) ranges of rows, one notification per range, bottom up
+    bulk = len(ranges) > 1
+    if bulk:
+      self.bulkRemoveStarted.emit(ranges)
+    for first, last in reversed(ranges):
+      self.beginRemoveRows(QModelIndex(), first, last)
+      self._delete_rows(first, last - first + 1)
       self.endRemoveRows()
-    else:
-      #existing row, mark it for deletion
-      self._state[position] = {'new': False, 'modified': False, 'deleted': True}
-      print(position, "marked deleted")
-      self.dataChanged.emit(parent, parent, [])
+    if bulk:
+      self.bulkRemoveFinished.emit()
+
+  def undelete_rows(self, rows):
+    """
+    Clears the deletion mark of those of rows that have one. A row edited
+    since it was saved is marked modified again. Returns False if no row
+    was marked.
+    """
+    rows = [row for row in sorted(set(rows)) if self._flags[row] & CSVTableModel.DELETED]
+    if not rows:
+      return False
+    ranges = CSVTableModel.row_ranges(rows)
+    record = ['undelete']
+    for first, last in ranges:
+      record.extend((self._ids[first], last - first + 1))
+    self._journal(*record)
+    for row in rows:
+      flags = self._flags[row] & ~CSVTableModel.DELETED
+      if self._codec is not None and not flags & CSVTableModel.ENCRYPTED:
+        # its plaintext is not the ciphertext saved
+        flags |= CSVTableModel.MODIFIED
+      self._flags[row] = flags
+    for first, last in ranges:
+      self.dataChanged.emit(self.index(first, 0), self.index(last, len(self._headers) - 1), [])
     return True
 
+  def _journal(self, *fields):
+    if self.journal is None:
+      return
+    try:
+      self.journal.append(*fields)
+    except OSError as error:
+      # the edit is kept in the table all the same; later edits are not
+      # journaled, so that replaying the journal gives a consistent state
+      print("Edit journal disabled:", error)
+      self.journal = None
+
+  def replay(self, records):
+    """
+    Applies edits read back from a vault.Journal, as setData, insertRows,
+    paste_rows, remove_rows and undelete_rows made them. Raises ValueError
+    if a record does not fit the rows, as when the journal is for another
+    version of the vault.
+    """
+    journal, self.journal = self.journal, None
+    rows = None
+    def position(row_id):
+      nonlocal rows
+      if rows is None:
+        rows = dict(zip(self._ids, range(len(self._ids))))
+      if row_id not in rows:
+        raise ValueError("Journal does not match the vault: no row %d" % row_id)
+      return rows[row_id]
+    def ranges(fields):
+      # (row id, count) pairs, as row numbers
+      return [row for row_id, count in zip(fields[::2], fields[1::2])
+              for row in range(position(int(row_id)), position(int(row_id)) + int(count))]
+    try:
+      for record in records:
+        operation, row_id = record[0], int(record[1])
+        if operation == 'insert':
+          if row_id != self._next_id:
+            raise ValueError("Journal does not match the vault: row %d inserted as %d" % (self._next_id, row_id))
+          count = int(record[2])
+          before = len(self._plain) if len(record) < 4 or not record[3] else position(int(record[3]))
+          cells = record[4:]
+          if cells:
+            num_columns = len(self._headers)
+            self.paste_rows(before, [cells[start:start + num_columns]
+                                     for start in range(0, count * num_columns, num_columns)])
+          else:
+            self.insertRows(before, count)
+          rows = None
+        elif operation == 'set':
+          self.setData(self.index(position(row_id), int(record[2])), record[3], Qt.ItemDataRole.EditRole)
+        elif operation == 'remove':
+          self.remove_rows(ranges(record[1:]))
+          rows = None
+        elif operation == 'undelete':
+          self.undelete_rows(ranges(record[1:]))
+        else:
+          raise ValueError("Unknown journal record: " + operation)
+    finally:
+      self.journal = journal
+
+  def pending_records(self):
+    """
+    Journal records that replay the edits not saved yet onto the vault
+    file as it is now: the cells edited in rows of the file, the rows
+    marked deleted, and the new rows with their cells. Rows that are not
+    new are taken to be the rows of the file, in order, as they are after a
+    save or a merge, and are numbered as replay numbers them.
+    """
+    records, removed = [], []
+    file_ids = {}
+    for row in range(len(self._flags)):
+      flags = self._flags[row]
+      if flags & CSVTableModel.NEW:
+        continue
+      row_id = file_ids[row] = len(file_ids)
+      if not flags & CSVTableModel.ENCRYPTED:
+        # the plaintext was edited; the ciphertext is the row in the file
+        saved = [self._open_cell(row, column, cached=False) or '' for column in range(len(self._headers))]
+        for column, value in enumerate(self._plain.row(row)):
+          value = '' if value is None else value
+          if value != saved[column]:
+            records.append(['set', row_id, column, value])
+      if flags & CSVTableModel.DELETED:
+        removed.append(row)
+    if removed:
+      record = ['remove']
+      for first, last in CSVTableModel.row_ranges(removed):
+        record.extend((file_ids[first], last - first + 1))
+      records.append(record)
+    next_id = len(file_ids)
+    for first, last in CSVTableModel.row_ranges(self.new_rows()):
+      count = last - first + 1
+      record = ['insert', next_id, count, file_ids.get(last + 1, '')]
+      cells = [cell for row in range(first, last + 1) for cell in self._plain.row(row)]
+      if any(cell is not None for cell in cells):
+        record.extend('' if cell is None else cell for cell in cells)
+      records.append(record)
+      next_id += count
+    return records
+
   def rowCount(self, index):
-    # The length of the outer list.
-    return len(self._data)
+    return len(self._plain)
 
   def columnCount(self, index):
-    # The following takes the first sub-list, and returns
-    # the length (only works if all rows are an equal length)
-    return len(self._data[0])
+    return len(self._headers)
 
   def row(self, row_num):
-    return self._data[row_num]
-
-class CustomSortFilterProxyModel(QSortFilterProxyModel):
-  def filterAcceptsRow(self, row_num, parent):
-    filterString = self.filterRegularExpression().pattern()
-    if not filterString:
-      # nothing to filter
-      return True
-    model = self.sourceModel()
-    row = model.row(row_num)
-    if not row:
-      return False
-    tests = [filterString in col for col in filter(None,row)]
-    if not tests:
-      # brand new row with None in all columns
-      return True
-    return True in tests
+    if self._flags[row_num] & CSVTableModel.SEALED:
+      return [self.cell(row_num, column) for column in range(len(self._headers))]
+    return self._plain.row(row_num)
+
+class CustomSortFilterProxyModel(QAbstractProxyModel):
+  """
+  Filters rows by the filter pattern:
+    text           rows with a cell containing text
+    ^text          rows with a cell starting with text
+    Column:text    either of the above, limited to one column, e.g. Username:bob
+  Plain text queries (where '.' is taken literally) are answered from the
+  source model's SearchIndex. Patterns using other regular expression syntax
+  are matched as a regular expression against every cell.
+  The case-insensitive option is honoured. Brand new empty rows always show.
+  Sorts rows in natural, case-insensitive order with one keyed sort over
+  the source model's cached sort keys, rather than a comparison callback
+  per pair of rows. Rows added or edited after a sort keep their place
+  until the next sort; added rows go to the end, or where they are in the
+  source model when the rows are not sorted.
+  The proxy is an array of source rows; the reverse mapping is rebuilt on
+  first use after the array changes.
+  """
+
+  regex_chars = set('^$*+?{}[]\\|()')
+
+  def __init__(self, parent=None):
+    super().__init__(parent)
+    self._source = None
+    self._regex = QRegularExpression()
+    self._accepted = None
+    self._accepted_generation = None
+    self._sort_column = -1
+    self._sort_order = Qt.SortOrder.AscendingOrder
+    # proxy row -> source row, and source row -> proxy row (-1 when filtered
+    # out, None until needed)
+    self._rows = array('q')
+    self._proxy_rows = None
+    # the proxy rows once the source rows being removed in bulk are gone
+    self._bulk_rows = None
+
+  def setSourceModel(self, model):
+    self.beginResetModel()
+    self._source = model
+    self._accepted_generation = None
+    super().setSourceModel(model)
+    model.modelAboutToBeReset.connect(self.beginResetModel)
+    model.modelReset.connect(self._source_reset)
+    model.rowsInserted.connect(self._source_rows_inserted)
+    model.rowsAboutToBeRemoved.connect(self._source_rows_about_to_be_removed)
+    model.rowsRemoved.connect(self._source_rows_removed)
+    model.bulkRemoveStarted.connect(self._source_bulk_remove_started)
+    model.bulkRemoveFinished.connect(self._source_bulk_remove_finished)
+    model.dataChanged.connect(self._source_data_changed)
+    self._set_rows(self._mapped_rows())
+    self.endResetModel()
+
+  def filterRegularExpression(self):
+    return self._regex
+
+  def setFilterRegularExpression(self, regex):
+    if isinstance(regex, str):
+      regex = QRegularExpression(regex)
+    self.beginResetModel()
+    self._regex = regex
+    self._accepted_generation = None
+    self._set_rows(self._mapped_rows())
+    self.endResetModel()
+
+  def accepted_rows(self):
+    """
+    Returns the source rows passing the filter, or None when there is no
+    filter. The result is cached until the pattern or the source model changes.
+    """
+    if self._accepted_generation != self._source.generation:
+      regex = self.filterRegularExpression()
+      with tracer.span('filter', pattern_length=len(regex.pattern())):
+        self._accepted = self._filter(regex, self._source) if regex.pattern() else None
+      self._accepted_generation = self._source.generation
+    return self._accepted
+
+  def sortColumn(self):
+    return self._sort_column
+
+  def sortOrder(self):
+    return self._sort_order
+
+  def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+    # column -1 restores the order of the source model
+    with tracer.span('sort', column=column):
+      self._sort_column = column
+      self._sort_order = order
+      self.layoutAboutToBeChanged.emit([], QAbstractProxyModel.LayoutChangeHint.VerticalSortHint)
+      persistent = self.persistentIndexList()
+      source = [(self._rows[index.row()], index.column()) for index in persistent]
+      self._set_rows(self._mapped_rows())
+      self.changePersistentIndexList(persistent, [self._proxy_index(row, column) for row, column in source])
+      self.layoutChanged.emit([], QAbstractProxyModel.LayoutChangeHint.VerticalSortHint)
+
+  def _mapped_rows(self):
+    # the source rows passing the filter, in sort order
+    accepted = self.accepted_rows()
+    rows = range(self._source.rowCount(QModelIndex())) if accepted is None else sorted(accepted)
+    if self._sort_column >= 0:
+      rows = sorted(rows, key=self._source.sort_keys(self._sort_column).__getitem__,
+                    reverse=self._sort_order == Qt.SortOrder.DescendingOrder)
+    return array('q', rows)
+
+  def _set_rows(self, rows):
+    self._rows = rows
+    self._proxy_rows = None
+
+  def proxy_rows(self):
+    """The proxy row of each source row, -1 for rows filtered out"""
+    if self._proxy_rows is None:
+      self._proxy_rows = array('q', [-1]) * self._source.rowCount(QModelIndex())
+      for proxy_row, source_row in enumerate(self._rows):
+        self._proxy_rows[source_row] = proxy_row
+    return self._proxy_rows
+
+  def _proxy_index(self, source_row, column):
+    proxy_row = self.proxy_rows()[source_row]
+    return self.createIndex(proxy_row, column) if proxy_row >= 0 else QModelIndex()
+
+  def _source_reset(self):
+    self._accepted_generation = None
+    self._set_rows(self._mapped_rows())
+    self.endResetModel()
+
+  def _source_rows_inserted(self, parent, first, last):
+    # inserted rows that pass the filter go after the rows before them when
+    # the rows are not sorted, and at the end otherwise
+    count = last - first + 1
+    appended = last == self._source.rowCount(QModelIndex()) - 1
+    if not appended:
+      self._set_rows(array('q', [row + count if row >= first else row for row in self._rows]))
+    accepted = self.accepted_rows()
+    added = [row for row in range(first, last + 1) if accepted is None or row in accepted]
+    position = len(self._rows)
+    if not appended and self._sort_column < 0:
+      position = bisect.bisect_left(self._rows, first)
+    if appended and self._proxy_rows is not None:
+      # the common case, kept cheap: only the new rows are mapped
+      self._proxy_rows.extend(array('q', [-1]) * count)
+      for proxy_row, source_row in enumerate(added, len(self._rows)):
+        self._proxy_rows[source_row] = proxy_row
+    if added:
+      self.beginInsertRows(QModelIndex(), position, position + len(added) - 1)
+      self._rows[position:position] = array('q', added)
+      if position < len(self._rows) - len(added):
+        self._proxy_rows = None
+      self.endInsertRows()
+
+  def _source_bulk_remove_started(self, ranges):
+    # the proxy rows of every range are removed now, and the rows left are
+    # mapped to their new source rows once, rather than once per range
+    removed = bytearray(self._source.rowCount(QModelIndex()))
+    for first, last in ranges:
+      removed[first:last + 1] = b'\x01' * (last - first + 1)
+    self._remove_proxy_rows([proxy_row for proxy_row, row in enumerate(self._rows) if removed[row]])
+    shift, below = array('q', bytes(8 * len(removed))), 0
+    for row, gone in enumerate(removed):
+      shift[row] = below
+      below += gone
+    self._bulk_rows = array('q', [row - shift[row] for row in self._rows])
+
+  def _source_bulk_remove_finished(self):
+    rows, self._bulk_rows = self._bulk_rows, None
+    self._set_rows(rows)
+
+  def _remove_proxy_rows(self, removed):
+    # removed, sorted proxy rows, one contiguous range at a time, bottom up
+    for start, end in reversed(CSVTableModel.row_ranges(removed)):
+      self.beginRemoveRows(QModelIndex(), start, end)
+      del self._rows[start:end + 1]
+      self._proxy_rows = None
+      self.endRemoveRows()
+
+  def _source_rows_about_to_be_removed(self, parent, first, last):
+    if self._bulk_rows is not None:
+      return
+    self._remove_proxy_rows(sorted(row for row in self.proxy_rows()[first:last + 1] if row >= 0))
+
+  def _source_rows_removed(self, parent, first, last):
+    if self._bulk_rows is not None:
+      return
+    count = last - first + 1
+    self._set_rows(array('q', [row - count if row > last else row for row in self._rows]))
+
+  def _source_data_changed(self, top_left, bottom_right, roles):
+    if not top_left.isValid() or not bottom_right.isValid():
+      return
+    rows = [row for row in self.proxy_rows()[top_left.row():bottom_right.row() + 1] if row >= 0]
+    if rows:
+      self.dataChanged.emit(self.createIndex(min(rows), top_left.column()),
+                            self.createIndex(max(rows), bottom_right.column()), roles)
+
+  def mapToSource(self, index):
+    if not index.isValid():
+      return QModelIndex()
+    return self._source.index(self._rows[index.row()], index.column())
+
+  def mapFromSource(self, source_index):
+    if not source_index.isValid():
+      return QModelIndex()
+    return self._proxy_index(source_index.row(), source_index.column())
+
+  def index(self, row, column, parent=QModelIndex()):
+    if parent.isValid() or not 0 <= row < len(self._rows) or not 0 <= column < self.columnCount():
+      return QModelIndex()
+    return self.createIndex(row, column)
+
+  def parent(self, index=None):
+    if index is None:
+      return super().parent()
+    return QModelIndex()
+
+  def rowCount(self, parent=QModelIndex()):
+    return 0 if parent.isValid() else len(self._rows)
+
+  def columnCount(self, parent=QModelIndex()):
+    return 0 if parent.isValid() or self._source is None else self._source.columnCount(QModelIndex())
+
+  def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+    # called for every visible cell, so the source index is made directly
+    return self._source.data(self._source.index(self._rows[index.row()], index.column()), role)
+
+  def insertRows(self, row, count, parent=QModelIndex()):
+    # before the source row of row, or at the end
+    position = self._rows[row] if row < len(self._rows) else self._source.rowCount(QModelIndex())
+    return self._source.insertRows(position, count)
+
+  def removeRows(self, row, count, parent=QModelIndex()):
+    return self._source.remove_rows(self._rows[row:row + count])
+
+  def _filter(self, regex, model):
+    text = regex.pattern()
+    case_sensitive = not (regex.patternOptions() & QRegularExpression.PatternOption.CaseInsensitiveOption)
+    columns = range(len(model.headers()))
+    column, _, rest = text.partition(':')
+    headers = [str(header).casefold() for header in model.headers()]
+    if rest and column.strip().casefold() in headers:
+      columns = [headers.index(column.strip().casefold())]
+      text = rest
+      # a regular expression applies to the cells without the column prefix
+      regex = QRegularExpression(text, regex.patternOptions())
+    prefix = text.startswith('^')
+    if prefix:
+      text = text[1:]
+    num_rows = model.rowCount(QModelIndex())
+    accepted = {row_num for row_num in model.new_rows() if not any(model.row(row_num))}
+    if CustomSortFilterProxyModel.regex_chars.intersection(text):
+      # a regular expression, every cell has to be tested
+      for row_num in range(num_rows):
+        row = model.row(row_num)
+        if any(row[column] and regex.match(row[column]).hasMatch() for column in columns):
+          accepted.add(row_num)
+      return accepted
+    # the index narrows down the rows, the cells decide
+    candidates = model.search_index().search(text, columns, prefix)
+    if not case_sensitive:
+      text = text.casefold()
+    for row_num in model.rows_for_ids(candidates):
+      row = model.row(row_num)
+      for column in columns:
+        cell = row[column]
+        if not cell:
+          continue
+        if not case_sensitive:
+          cell = cell.casefold()
+        if cell.startswith(text) if prefix else text in cell:
+          accepted.add(row_num)
+          break
+    return accepted
 
 class TableWidget(QWidget):
+
+    # models up to this many rows are sized to their contents when loaded
+    resize_rows_limit = 1000
+
     def __init__(self, data):
         QWidget.__init__(self)
 
@@ -165,8 +1155,13 @@ class TableWidget(QWidget):
         self.vertical_header = self.table_view.verticalHeader()
         self.horizontal_header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
         # self.horizontal_header.setStretchLastSection(True)
+        # ResizeToContents measures every row on each layout change, so rows
+        # get a uniform default height and are only resized when edited
         self.vertical_header.setSectionResizeMode(
-            QHeaderView.ResizeMode.ResizeToContents
+            QHeaderView.ResizeMode.Interactive
+        )
+        self.vertical_header.setDefaultSectionSize(
+            QFontMetrics(CSVTableModel.render_roles()['font']).height() + 8
         )
         self.vertical_header.setVisible(False)
 
@@ -181,16 +1176,27 @@ class TableWidget(QWidget):
         self.btn_layout = QHBoxLayout()
         self.addRowBtn = QPushButton("Add")
         self.addRowBtn.setShortcut(QKeySequence(Qt.Key.Key_Control + Qt.Key.Key_Down))
-        self.addRowBtn.setToolTip("Add a new row")
+        self.addRowBtn.setToolTip("Add a new row below the selected rows")
         self.addRowBtn.clicked.connect(self.addRowBtn_clicked)
         self.btn_layout.addWidget(self.addRowBtn)
 
         self.delRowBtn = QPushButton("Delete")
         self.delRowBtn.setShortcut(QKeySequence.StandardKey.Delete)
-        self.delRowBtn.setToolTip("Delete selected row")
+        self.delRowBtn.setToolTip("Delete selected rows")
         self.delRowBtn.clicked.connect(self.delRowBtn_clicked)
         self.btn_layout.addWidget(self.delRowBtn)
 
+        self.undeleteRowBtn = QPushButton("Undelete")
+        self.undeleteRowBtn.setToolTip("Keep selected rows that are marked for deletion")
+        self.undeleteRowBtn.clicked.connect(self.undeleteRowBtn_clicked)
+        self.btn_layout.addWidget(self.undeleteRowBtn)
+
+        self.pasteBtn = QPushButton("Paste")
+        self.pasteBtn.setShortcut(QKeySequence.StandardKey.Paste)
+        self.pasteBtn.setToolTip("Add the rows copied from a spreadsheet or CSV file below the selected rows")
+        self.pasteBtn.clicked.connect(self.pasteBtn_clicked)
+        self.btn_layout.addWidget(self.pasteBtn)
+
         self.filterBtn = QPushButton("Filter")
         self.filterBtn.setShortcut(QKeySequence.StandardKey.Find)
         self.filterBtn.setToolTip("Filter rows")
@@ -206,41 +1212,112 @@ class TableWidget(QWidget):
 
         self.set_model(data)
 
-    def set_model(self, data):
+    def set_model(self, data, codec=None, decrypted=None):
         # Getting the Model
-        model = CSVTableModel(self, data)
+        model = CSVTableModel(self, data, codec, decrypted)
+        # queued, since rows are found corrupt while sorting or on a worker thread
+        model.corruptRowFound.connect(self.corrupt_row_found, Qt.ConnectionType.QueuedConnection)
         # proxyModel = QSortFilterProxyModel()
         proxyModel = CustomSortFilterProxyModel()
         proxyModel.setSourceModel(model)
         self.model = proxyModel
         self.table_view.setModel(self.model)
+        if model.rowCount(QModelIndex()) <= self.resize_rows_limit:
+            self.table_view.resizeRowsToContents()
 
-    def update_model(self, data):
-        self.set_model(data)
+    def corrupt_row_found(self):
+        self.parent().corrupt_row_found()
+
+    def resize_row(self, source_index):
+        index = self.model.mapFromSource(source_index)
+        if index.isValid():
+            self.table_view.resizeRowToContents(index.row())
+
+    @traced('update_model')
+    def update_model(self, data, codec=None, decrypted=None):
+        self.set_model(data, codec, decrypted)
         self.table_view.update()
 
     def reset_model_state(self):
         self.model.sourceModel().reset_state()
 
+    def selected_rows(self):
+        # source rows of the selected rows, in order
+        return sorted(self.model.mapToSource(index).row()
+                      for index in self.table_view.selectionModel().selectedRows() if index.isValid())
+
+    def insert_position(self):
+        # new rows go below the last selected row, or at the end
+        rows = self.selected_rows()
+        return rows[-1] + 1 if rows else self.model.sourceModel().rowCount(QModelIndex())
+
+    def scroll_to_source(self, row):
+        index = self.model.mapFromSource(self.model.sourceModel().index(row, 0))
+        if index.isValid():
+            self.table_view.scrollTo(index)
+
+    @staticmethod
+    def clipboard_rows(text, headers):
+        """
+        Rows of text copied from a spreadsheet (tab separated) or a CSV file.
+        Blank lines are skipped. A first line of column names is dropped,
+        and the columns of other password managers' exports are mapped to
+        headers (see vault.import_mapping).
+        """
+        first_line = text.split('\n', 1)[0]
+        reader = csv.reader(io.StringIO(text), 'excel-tab' if '\t' in first_line else 'excel')
+        rows = [row for row in reader if any(cell.strip() for cell in row)]
+        if not rows:
+            return rows
+        mapping = vault.import_mapping(rows[0], headers)
+        if mapping is not None:
+            return [[row[index] if index is not None and index < len(row) else '' for index in mapping]
+                    for row in rows[1:]]
+        if [cell.strip().casefold() for cell in rows[0]] == [str(header).casefold() for header in headers]:
+            return rows[1:]
+        return rows
+
     @pyqtSlot()
     def addRowBtn_clicked(self):
-        self.model.insertRows(0, 1)
-        self.table_view.scrollToBottom()
+        position = self.insert_position()
+        self.model.sourceModel().insertRows(position, 1)
+        self.scroll_to_source(position)
         return
 
     @pyqtSlot()
     def delRowBtn_clicked(self):
-        rows = self.table_view.selectionModel().selectedRows()
-        if len(rows) == 1:
-            if rows[0].isValid():
-                self.model.removeRows(rows[0].row(), 1)
-                self.parent().set_needs_save()
-        else:
-            QMessageBox.critical(
-                self,
-                "Multiple Rows Selected!",
-                "For your safety, delete one row at a time",
-            )
+        rows = self.selected_rows()
+        if not rows:
+            return
+        if len(rows) > 1:
+            reply = QMessageBox.question(self, "Multiple Rows Selected!",
+                                         "Delete the %d selected rows?" % len(rows),
+                                         QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                                         QMessageBox.StandardButton.No)
+            if reply != QMessageBox.StandardButton.Yes:
+                return
+        self.table_view.clearSelection()
+        self.model.sourceModel().remove_rows(rows)
+        self.parent().set_needs_save()
+        return
+
+    @pyqtSlot()
+    def undeleteRowBtn_clicked(self):
+        if self.model.sourceModel().undelete_rows(self.selected_rows()):
+            self.parent().set_needs_save()
+        return
+
+    @pyqtSlot()
+    def pasteBtn_clicked(self):
+        model = self.model.sourceModel()
+        rows = TableWidget.clipboard_rows(QApplication.clipboard().text(), model.headers())
+        if not rows:
+            return
+        position = self.insert_position()
+        self.table_view.clearSelection()
+        model.paste_rows(position, rows)
+        self.scroll_to_source(position)
+        self.parent().set_needs_save()
         return
 
     @pyqtSlot()
@@ -269,9 +1346,87 @@ class TableWidget(QWidget):
             self.filterBtn.setToolTip("Filter rows")
         return
 
+class TaskSignals(QObject):
+  progress = pyqtSignal(str, int, int)
+  partial = pyqtSignal(object)
+  finished = pyqtSignal(object)
+  failed = pyqtSignal(object)
+
+class Task(QRunnable):
+  """
+  Runs func(progress) on a QThreadPool thread. func reports progress by
+  calling progress(stage, done, total), which raises vault.Cancelled once
+  cancel() has been called. The outcome is delivered through signals,
+  which Qt queues to the thread of the connected window.
+  With streaming set, func is called as func(progress, send) and can hand
+  partial results to the GUI thread with send(data).
+  """
+
+  # seconds between progress signals
+  progress_interval = 0.1
+  # partial results sent but not yet handled on the GUI thread
+  max_pending = 4
+
+  def __init__(self, func, streaming=False):
+    super().__init__()
+    self.signals = TaskSignals()
+    self._func = func
+    self._streaming = streaming
+    self._cancelled = False
+    self._last_progress = 0
+    self._pending = threading.Semaphore(Task.max_pending)
+
+  def cancel(self):
+    self._cancelled = True
+
+  def progress(self, stage, done, total):
+    if self._cancelled:
+      raise vault.Cancelled()
+    now = time.monotonic()
+    if now - self._last_progress >= Task.progress_interval:
+      self._last_progress = now
+      self.signals.progress.emit(stage, done, total)
+
+  def send(self, data):
+    # waits while max_pending results are queued, so that a fast worker
+    # does not pile up data faster than the GUI thread takes it
+    while not self._pending.acquire(timeout=Task.progress_interval):
+      if self._cancelled:
+        raise vault.Cancelled()
+    self.signals.partial.emit(data)
+
+  def handled(self):
+    self._pending.release()
+
+  def run(self):
+    try:
+      if self._streaming:
+        result = self._func(self.progress, self.send)
+      else:
+        result = self._func(self.progress)
+    except BaseException as error:
+      self.signals.failed.emit(error)
+    else:
+      self.signals.finished.emit(result)
+
 # Subclass QMainWindow to customize your application's main window
 class MainWindow(QMainWindow):
 
+  # vaults with at least this many rows are opened with on-demand decryption
+  lazy_open_threshold = 5000
+  # after a save, decrypt every saved row to check it, rather than only
+  # the rows encrypted by that save
+  verify_all_rows = False
+  # record every edit in an encrypted journal next to the open vault
+  journal_edits = True
+  # journaled edits after which they are saved to the vault in the background
+  journal_compact_records = 1000
+  # merge the changes made to the open vault file by other programs
+  watch_vault_file = True
+  # milliseconds to wait after the file changes before reading it, for the
+  # writer (a file sync tool, or a save of our own) to finish
+  watch_delay = 500
+
   def __init__(self, widget):
     super().__init__()
     self.setWindowTitle("Ragasiyangal - Password Manager")
@@ -285,6 +1440,31 @@ class MainWindow(QMainWindow):
     self.status = self.statusBar()
     self.needs_save = False
     self.filter_on = False
+    self.key_cache = KeyCache()
+    # KdfParams (salt and KDF parameters) of the open vault, None for new or imported data
+    self.vault_kdf = None
+    # the Task of the operation running in the background, and the
+    # (Task, lock_table) of the ones waiting for it
+    self.task = None
+    self.queued_tasks = []
+    # vault.Journal of the edits to the open vault since it was saved
+    self.journal = None
+    # the open vault file, and its os.stat when it was last read or written
+    self.vault_file_name = None
+    self.vault_stat = None
+    # the file changed on disk in a way that could not be merged
+    self.disk_changed = False
+    self.watcher = QFileSystemWatcher(self)
+    self.watcher.fileChanged.connect(self.file_changed)
+    self.watch_timer = QTimer(self)
+    self.watch_timer.setSingleShot(True)
+    self.watch_timer.setInterval(self.watch_delay)
+    self.watch_timer.timeout.connect(self.check_vault_file)
+    self.cancel_button = QPushButton("Cancel")
+    self.cancel_button.setToolTip("Cancel the running operation")
+    self.cancel_button.clicked.connect(self.cancel_task)
+    self.cancel_button.setVisible(False)
+    self.status.addPermanentWidget(self.cancel_button)
 
   def setFilter(self, enabled:bool):
     self.filter_on = enabled
@@ -331,8 +1511,13 @@ class MainWindow(QMainWindow):
       import_action.setStatusTip("Import an unencrypted CSV file")
       import_action.triggered.connect(self.import_file)
 
+      audit_action = QAction("Audit Passwords", self)
+      audit_action.setStatusTip("Mark the rows with weak, reused or similar passwords")
+      audit_action.triggered.connect(self.audit_passwords)
+
       other_menu = menu_bar.addMenu("Other")
       other_menu.addAction(import_action)
+      other_menu.addAction(audit_action)
 
       about_action = QAction("About", self)
       about_action.setStatusTip("About this app")
@@ -351,7 +1536,11 @@ class MainWindow(QMainWindow):
     if self.is_filter_on():
       return
     csv_data = [['AccountName', 'Username', 'Password', 'Comments'], ['', '', '', '']]
+    self.key_cache.clear()
+    self.vault_kdf = None
     self.table_widget.update_model(csv_data)
+    self.__set_journal(None)
+    self.__watch(None)
     self.reset_needs_save()
 
   def import_file(self):
@@ -362,48 +1551,101 @@ class MainWindow(QMainWindow):
                                   "CSV Files (*.csv *.txt);;All files (*)")
     if not file_name:
       return
+    # rows are shown as they are read, and the table can be used meanwhile
+    started = False
+    def add_rows(chunk):
+      nonlocal started
+      headers, rows = chunk
+      if headers is not None:
+        started = True
+        self.vault_kdf = None
+        self.table_widget.update_model([headers] + rows)
+        self.__set_journal(None)
+        self.__watch(None)
+        self.set_needs_save()
+      else:
+        self.table_widget.model.sourceModel().append_rows(rows)
+    def imported(num_rows):
+      if num_rows is not None:
+        self.status.showMessage("%s imported, %d rows. Needs to be saved" % (file_name, num_rows))
+    def failed(error):
+      if isinstance(error, vault.Cancelled) and started:
+        self.status.showMessage("Import cancelled, %d rows imported. Needs to be saved"
+                                % self.table_widget.model.sourceModel().rowCount(QModelIndex()))
+        return
+      self.__task_error(error, "Error Importing File!", "Could not read " + file_name)
+    self.run_task(lambda progress, send: self.__read_import(file_name, progress, send),
+                  imported, failed, partial=add_rows, lock_table=False)
+
+  def __read_import(self, file_name, progress, send):
+    # runs on a worker thread, sending (headers, rows) for the first chunk
+    # and (None, rows) for the others; returns the number of rows or None
+    num_rows = None
     with open(file_name) as fin:
-      csv_data = [row for row in csv.reader(fin)]
-    if csv_data:
-      self.table_widget.update_model(csv_data)
-      self.set_needs_save()
-      self.status.showMessage(file_name + " imported. Needs to be saved")
-    return
+      headers, chunks = vault.read_import(fin, progress=progress)
+      for rows in chunks:
+        send((headers if num_rows is None else None, rows))
+        num_rows = (num_rows or 0) + len(rows)
+    if headers and num_rows is None:
+      send((headers, []))
+      num_rows = 0
+    return num_rows
 
   def open_file(self):
     if self.is_filter_on():
       return
     file_name, filter = \
       QFileDialog.getOpenFileName(self, "Open file", ".",
-                                  "CSV Files (*.csv *.txt);;All files (*)")
+                                  VAULT_FILES)
     if not file_name:
       return
-    num_tries = 1
-    while num_tries <= 5 :
-      password, ok = QInputDialog().getText(self, "Attention",
-                                        "Password:",
-                                        QLineEdit.EchoMode.Password if num_tries <= 2 else QLineEdit.EchoMode.Normal,
-                                        "")
-      if ok:
-        csv_data = None
-        try:
-          csv_data = self.__decrypt_file(file_name, password)
-        except:
-          print(sys.exc_info())
-          pass
-        if csv_data:
-          self.table_widget.update_model(csv_data)
-          self.reset_needs_save()
-          self.status.showMessage(file_name + " loaded")
-          break
-        else:
-          num_tries = num_tries + 1
-          QMessageBox.critical(self,
-                            "Wrong Password!",
-                            "You entered the wrong password. Please try again.")
-      else:
+    # keys derived for the previous vault are no longer needed
+    self.key_cache.clear()
+    # the file is read once; each password tried then costs only the KDF
+    self.run_task(lambda progress: vault.VaultFile(file_name, progress),
+                  lambda vault_file: self.__ask_open_password(vault_file, 1),
+                  lambda error: self.__open_error(error, file_name))
+
+  def __ask_open_password(self, vault_file, num_tries):
+    # asked again, up to 5 times, when the password is wrong
+    file_name = vault_file.file_name
+    if num_tries > 5:
+      vault_file.close()
+      self.status.showMessage(file_name + " not opened")
+      return
+    password, ok = QInputDialog().getText(self, "Attention",
+                                      "Password:",
+                                      QLineEdit.EchoMode.Password if num_tries <= 2 else QLineEdit.EchoMode.Normal,
+                                      "")
+    if not ok:
+      vault_file.close()
+      self.status.showMessage(file_name + " not opened")
+      return
+    trace_start = tracer.mark()
+    def loaded(result):
+      vault_file.close()
+      self.__show_vault(result)
+      if not self.needs_save:
+        self.status.showMessage(self.trace_message(file_name + " loaded", trace_start))
+    def failed(error):
+      if isinstance(error, vault.WrongPassword):
+        QMessageBox.critical(self,
+                          "Wrong Password!",
+                          "You entered the wrong password. Please try again.")
+        self.__ask_open_password(vault_file, num_tries + 1)
         return
-    return
+      vault_file.close()
+      self.__open_error(error, file_name)
+    self.run_task(lambda progress: self.__read_vault(vault_file, password, progress),
+                  loaded, failed)
+
+  def __open_error(self, error, file_name):
+    if isinstance(error, vault.Cancelled):
+      self.status.showMessage("Opening " + file_name + " cancelled")
+    elif isinstance(error, vault.CorruptVault):
+      self.__task_error(error, "Corrupt File!", file_name + ": " + str(error))
+    else:
+      self.__task_error(error, "Error Opening File!", "Could not read " + file_name)
 
   def save_file(self):
     if self.is_filter_on():
@@ -413,72 +1655,436 @@ class MainWindow(QMainWindow):
                               "Nothing to Save",
                               "You have not entered any data.")
       return
+    corrupt = self.table_widget.model.sourceModel().corrupt_rows()
+    if corrupt:
+      QMessageBox.critical(self, "Corrupt Rows!",
+                           "%d rows could not be decrypted, the file is damaged.\n"
+                           "They are marked in the table. Delete them before you save." % len(corrupt))
+      self.table_widget.scroll_to_source(corrupt[0])
+      return
     file_name, filter = \
       QFileDialog.getSaveFileName(self, "Open file", "." + "/export.csv",
-                                  "CSV Files (*.csv *.txt);;All files (*)")
+                                  VAULT_FILES)
     if not file_name:
       return
+    if self.disk_changed and os.path.abspath(file_name) == os.path.abspath(self.vault_file_name):
+      reply = QMessageBox.question(self, "File Changed on Disk",
+                                   file_name + " was changed by another program since it was opened.\n"
+                                   "Do you want to overwrite those changes?",
+                                   QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                                   QMessageBox.StandardButton.No)
+      if reply != QMessageBox.StandardButton.Yes:
+        return
     password = self.show_password_create()
     if not password:
       return
-    file_saved = self.__encrypt_file(file_name, password)
-    if file_saved:
-      # reload saved file as a sanity check
-      try:
-        csv_data = self.__decrypt_file(file_name, password)
-        if csv_data:
-          self.status.showMessage(file_name + " saved")
-          self.table_widget.update_model(csv_data)
-          self.reset_needs_save()
-      except:
-        self.status.showMessage("Error saving file")
-        QMessageBox.critical(self,
-                             "Error Saving File!",
-                             "Please try again! To avoid risk of losing data, " +
-                                    "you can copy the content manually or take a screenshot.")
+    trace_start = tracer.mark()
+    def saved(result):
+      # the table is updated in place once the saved file is verified
+      self.__mark_saved(result)
+      self.reset_needs_save()
+      self.status.showMessage(self.trace_message(file_name + " saved", trace_start))
+    def failed(error):
+      if isinstance(error, vault.Cancelled):
+        self.status.showMessage("Save cancelled, " + file_name + " was not changed")
+        return
+      print(error)
+      self.status.showMessage("Error saving file")
+      QMessageBox.critical(self,
+                           "Error Saving File!",
+                           "Please try again! To avoid risk of losing data, " +
+                                  "you can copy the content manually or take a screenshot.")
+    self.run_task(lambda progress: self.__write_vault(file_name, password, progress),
+                  saved, failed)
+
+  def audit_passwords(self):
+    model = self.table_widget.model.sourceModel()
+    if 'Password' not in model.headers():
+      QMessageBox.warning(self, "No Password Column!", "This document has no Password column to audit.")
+      return
+    column = model.headers().index('Password')
+    codec = model.codec()
+    # reuse is found through hashes keyed by the vault key, or by a key of
+    # their own for data that is not encrypted yet
+    key = codec.subkey(vault.PasswordAudit.key_label) if codec is not None else os.urandom(32)
+    num_rows = model.rowCount(QModelIndex())
+    def audit(progress):
+      return vault.PasswordAudit(key).run(model.column_values(column), progress, num_rows)
+    def audited(audit):
+      model.set_audit(column, audit)
+      self.status.showMessage("Audit: %(weak)d weak, %(reused)d reused, %(similar)d similar passwords. "
+                              "Hover over a marked row for details" % audit.summary())
+    def failed(error):
+      self.__task_error(error, "Audit Failed!", "Could not audit the passwords")
+    self.run_task(audit, audited, failed)
+
+  def __task_error(self, error, title, message):
+    if isinstance(error, vault.Cancelled):
+      self.status.showMessage("Cancelled")
+      return
+    print(error)
+    self.status.showMessage(message)
+    QMessageBox.critical(self, title, message)
+
+  def run_task(self, func, finished, failed, partial=None, lock_table=True):
+    """
+    Runs func(progress) on a worker thread, then finished(result) or
+    failed(exception) on the GUI thread. The window stays responsive but
+    locked while the task runs; its progress is shown in the status bar
+    next to a Cancel button.
+    With partial, func is called as func(progress, send), and partial(data)
+    runs on the GUI thread for each send(data). Without lock_table, the
+    table can be used while the task runs; only the menus are locked.
+    Tasks run one at a time: one started while another runs is queued,
+    and starts once the running task and its callback are done.
+    """
+    task = Task(func, streaming=partial is not None)
+    # the callbacks go with the task's own signals, so that each outcome
+    # reaches the callbacks of the task it belongs to
+    task.signals.progress.connect(self.show_progress)
+    if partial is not None:
+      task.signals.partial.connect(functools.partial(self.task_partial, task, partial))
+    task.signals.finished.connect(functools.partial(self.task_done, task, finished))
+    task.signals.failed.connect(functools.partial(self.task_done, task, failed))
+    self.queued_tasks.append((task, lock_table))
+    if self.task is None:
+      self.__start_next_task()
+
+  def __start_next_task(self):
+    if self.task is not None or not self.queued_tasks:
+      return
+    self.task, lock_table = self.queued_tasks.pop(0)
+    self.set_busy(True, lock_table)
+    QThreadPool.globalInstance().start(self.task)
+
+  def task_partial(self, task, partial, data):
+    try:
+      partial(data)
+    finally:
+      task.handled()
+
+  def task_done(self, task, callback, outcome):
+    if task is not self.task:
+      # a task dropped by closeEvent
+      return
+    self.task = None
+    self.set_busy(False)
+    try:
+      callback(outcome)
+    finally:
+      self.__start_next_task()
+
+  def cancel_task(self):
+    if self.task is not None:
+      self.task.cancel()
+      self.status.showMessage("Cancelling...")
+
+  def set_busy(self, busy, lock_table=True):
+    self.table_widget.setEnabled(not (busy and lock_table))
+    self.menuBar().setEnabled(not busy)
+    self.cancel_button.setVisible(busy)
+
+  def show_progress(self, stage, done, total):
+    if total:
+      self.status.showMessage("%s: %d of %d rows" % (stage, done, total))
+    elif done:
+      self.status.showMessage("%s: %d rows" % (stage, done))
+    else:
+      self.status.showMessage(stage + "...")
 
-  def __encrypt_file(self, file_name, password):
-    # generate a key using password and random salt
+  def trace_message(self, message, trace_start):
+    # with tracing on, the status bar also shows where the time went
+    if not tracer.enabled:
+      return message
+    tracer.write()
+    return message + " (" + tracer.summary(trace_start) + ")"
+
+  @traced('save')
+  def __write_vault(self, file_name, password, progress=None):
+    """
+    Encrypts the table and writes it to file_name. Only reads the model,
+    so it can run on a worker thread; __mark_saved applies the result.
+    Binary vaults (see vault.binary_target) are encrypted whole under a
+    new salt, which is cheap with one record per row.
+    """
+    model = self.table_widget.model.sourceModel()
     password_bytes = bytes(password, 'utf-8')
-    salt_bytes = os.urandom(32)
-    key = Crypto.derive_key(password_bytes, salt_bytes)
-
-    # start writing to file
-    with open(file_name, "w") as fileOutput:
-      # write salt to file as a comment metadata
-      # https://www.w3.org/TR/tabular-data-model/#embedded-metadata
-      fileOutput.write('# ' + base64.urlsafe_b64encode(salt_bytes).decode('utf-8') + '\n')
-
-      # prepare to write csv table data
-      writer = csv.writer(fileOutput)
-
-      # write csv headers
-      headers = [self.table_widget.model.headerData(c, Qt.Orientation.Horizontal)
-                 for c in range(self.table_widget.model.columnCount())]
-      writer.writerow(Crypto.encrypt_row(key, headers))
-
-      #write csv rows
-      for row in range(self.table_widget.model.rowCount()):
-        if self.table_widget.model.sourceModel().state(row)['deleted']:
-          continue
-        rowdata = [
-          self.table_widget.model.data(
-            self.table_widget.model.index(row, column),
-            Qt.ItemDataRole.DisplayRole
-          )
-          for column in range(self.table_widget.model.columnCount())
-        ]
-        writer.writerow(Crypto.encrypt_row(key, rowdata))
-    return True
+    if vault.binary_target(file_name):
+      if progress is not None:
+        progress("Deriving key", 0, 0)
+      kdf = vault.KdfParams.new()
+      codec = RowCodec(vault.new_key(password_bytes, kdf, self.key_cache))
+      return self.__write_rows(file_name, kdf, codec, progress, binary=True)
+    codec = model.codec()
+    data_key = None
+    if codec is not None and self.vault_kdf is not None:
+      try:
+        data_key = vault.derive_key(password_bytes, self.vault_kdf, self.key_cache)
+      except vault.WrongPassword:
+        pass
+    if data_key is not None and codec.has_key(data_key):
+      # same password as the open vault: keep its salt, so that rows which
+      # have not changed are written with their existing ciphertext
+      kdf = self.vault_kdf
+      kdf.record_check(self.key_cache.derive_key(password_bytes, kdf))
+    elif codec is not None and self.vault_kdf is not None and self.vault_kdf.wrapped_key is not None:
+      # a new password for a vault with a data key: the data key is wrapped
+      # under it, and rows which have not changed keep their ciphertext too
+      if progress is not None:
+        progress("Deriving key", 0, 0)
+      kdf = vault.KdfParams.new()
+      vault.new_key(password_bytes, kdf, self.key_cache, codec)
+    else:
+      # generate a key using password, a random salt and KDF parameters
+      # calibrated for this machine
+      if progress is not None:
+        progress("Deriving key", 0, 0)
+      kdf = vault.KdfParams.new()
+      codec = RowCodec(vault.new_key(password_bytes, kdf, self.key_cache))
+    return self.__write_rows(file_name, kdf, codec, progress)
+
+  def __write_rows(self, file_name, kdf, codec, progress=None, binary=False):
+    """
+    Writes the table to file_name under kdf and codec. Returns the result
+    for __mark_saved, with a new, empty journal for the saved file.
+    """
+    model = self.table_widget.model.sourceModel()
+    if binary:
+      vault.BinaryVault.write(file_name, kdf, codec, model.plain_rows(), progress=progress)
+      return None, None, None, self.__new_journal(file_name, kdf, codec), file_name
+    encr_rows = model.encrypted_rows(codec, progress)
+    # written to a temporary file, read back and verified as a sanity check,
+    # and only then moved over file_name
+    vault.write_rows(file_name, kdf, encr_rows,
+                     verify=lambda saved_rows: model.verify_saved(codec, encr_rows, saved_rows,
+                                                                  self.verify_all_rows),
+                     progress=progress)
+    return kdf, codec, encr_rows, self.__new_journal(file_name, kdf, codec), file_name
+
+  def __mark_saved(self, result):
+    kdf, codec, encr_rows, journal, file_name = result
+    self.table_widget.model.sourceModel().mark_saved(codec, encr_rows)
+    if kdf is not None:
+      self.vault_kdf = kdf
+    # the saved file holds every edit journaled so far
+    if self.journal is not None:
+      self.journal.discard()
+    self.__set_journal(journal)
+    self.__watch(file_name)
+
+  def __new_journal(self, file_name, kdf, codec):
+    return vault.Journal(file_name, kdf, codec) if self.journal_edits else None
+
+  def __set_journal(self, journal, records=()):
+    """
+    Journals further edits to journal. records, edits journaled before the
+    vault was opened, are replayed into the table if the user agrees, and
+    deleted otherwise.
+    """
+    if self.journal is not None:
+      self.journal.close()
+    self.journal = journal
+    model = self.table_widget.model.sourceModel()
+    if records:
+      reply = QMessageBox.question(self, "Recover Edits",
+                                   "%d edits to this vault were not saved before it was last closed.\n"
+                                   "Do you want to recover them?" % len(records),
+                                   QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                                   QMessageBox.StandardButton.Yes)
+      if reply == QMessageBox.StandardButton.Yes:
+        try:
+          model.replay(records)
+          if model.has_edits():
+            self.set_needs_save()
+          self.status.showMessage("%d edits recovered. Needs to be saved" % len(records))
+        except ValueError as error:
+          # edits up to the failing one are in the table, and are saved with it
+          print(error)
+          if model.has_edits():
+            self.set_needs_save()
+          QMessageBox.critical(self, "Journal Error!", "Some edits could not be recovered.")
+          journal.discard()
+          self.journal = None
+      else:
+        journal.discard()
+    model.journal = self.journal
 
-  def __decrypt_file(self, file_name, password):
-    password_bytes = bytes(password, "utf-8")
-    with open(file_name) as fin:
-      reader = csv.reader(fin)
-      salt_bytes = base64.urlsafe_b64decode(bytes(next(reader, None)[0].lstrip('#').strip(), 'utf-8'))
-      key = Crypto.derive_key(password_bytes, salt_bytes)
-      csv_data = [Crypto.decrypt_row(key, row) for row in csv.reader(fin)]
-    return csv_data
+  def compact_journal(self):
+    """
+    Saves the journaled edits to the vault in the background, with the key
+    and KDF parameters it is open with, and starts a new journal. Waits
+    for the next edit while another operation runs or a filter is on.
+    """
+    journal = self.journal
+    if journal is None or not journal.count or self.task is not None or self.filter_on or self.disk_changed:
+      return
+    num_edits = journal.count
+    trace_start = tracer.mark()
+    def compacted(result):
+      self.__mark_saved(result)
+      self.reset_needs_save()
+      self.status.showMessage(self.trace_message("%d edits saved to %s" % (num_edits, journal.vault_name),
+                                                 trace_start))
+    def failed(error):
+      # the edits stay in the journal
+      if not isinstance(error, vault.Cancelled):
+        print(error)
+      self.status.showMessage("Edits not saved to " + journal.vault_name + ", they are kept in its journal")
+    self.run_task(lambda progress: self.__write_rows(journal.vault_name, journal.kdf, journal.codec, progress,
+                                                     binary=vault.is_binary(journal.vault_name)),
+                  compacted, failed)
+
+  @traced('open')
+  def __read_vault(self, vault_file, password, progress=None):
+    """
+    Unlocks the parsed vault_file, raising vault.WrongPassword or
+    vault.CorruptVault. Vaults with at least lazy_open_threshold rows are
+    loaded sealed and decrypted cell by cell as they are viewed; only the
+    headers are decrypted up front, which also checks files without a key
+    check. Binary vaults are decrypted whole, which is cheap with one
+    record per row. The vault's journal is read too. Runs on a worker
+    thread; __show_vault puts the result in the table.
+    """
+    codec = RowCodec(vault_file.unlock(password, self.key_cache, progress))
+    journal = self.__new_journal(vault_file.file_name, vault_file.kdf, codec)
+    records = journal.records() if journal is not None else []
+    file_name = vault_file.file_name
+    if vault_file.binary is not None:
+      return None, None, vault_file.rows(codec, progress), None, journal, records, file_name
+    encr_data = vault_file.encr_rows
+    if len(encr_data) - 1 < self.lazy_open_threshold:
+      decrypted = vault_file.rows(codec, progress)[1:]
+    else:
+      decrypted = None
+      vault_file.headers(codec)
+    return vault_file.kdf, codec, encr_data, decrypted, journal, records, file_name
+
+  def __show_vault(self, result):
+    kdf, codec, data, decrypted, journal, records, file_name = result
+    self.table_widget.update_model(data, codec, decrypted)
+    self.vault_kdf = kdf
+    self.reset_needs_save()
+    self.__set_journal(journal, records)
+    self.__watch(file_name)
+
+  def __watch(self, file_name):
+    """Watches file_name, the open vault file (None for none), for changes made by other programs"""
+    self.watch_timer.stop()
+    if self.watcher.files():
+      self.watcher.removePaths(self.watcher.files())
+    self.vault_file_name = file_name
+    self.vault_stat = self.__file_stat(file_name)
+    self.disk_changed = False
+    if file_name is not None and self.watch_vault_file:
+      self.watcher.addPath(file_name)
+
+  @staticmethod
+  def __file_stat(file_name):
+    try:
+      stat = os.stat(file_name)
+    except (OSError, TypeError):
+      return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+  def file_changed(self, path):
+    # the file may still be being written; it is read once it settles
+    self.watch_timer.start()
+
+  def check_vault_file(self):
+    """
+    Merges the changes made to the open vault file since it was read or
+    saved (see CSVTableModel.merge). Only the rows which changed are read
+    again and decrypted. Changes that cannot be merged, to a binary vault,
+    to the columns, or a file saved under another password, are reported,
+    and the user is asked before they are overwritten by a save.
+    """
+    file_name = self.vault_file_name
+    if file_name is None:
+      return
+    if self.task is not None or QApplication.activeModalWidget() is not None:
+      # tried again once the running operation is done, or the dialog
+      # asking for it closed
+      self.watch_timer.start()
+      return
+    if file_name not in self.watcher.files() and os.path.exists(file_name):
+      # the file was replaced rather than written in place
+      self.watcher.addPath(file_name)
+    stat = self.__file_stat(file_name)
+    if stat is None or stat == self.vault_stat:
+      return
+    self.vault_stat = stat
+    model = self.table_widget.model.sourceModel()
+    kdf, codec = self.vault_kdf, model.codec()
+    if kdf is None or codec is None or vault.is_binary(file_name):
+      self.__disk_changed(file_name, "binary vaults are written whole")
+      return
+    def read(progress):
+      fingerprints, file_rows = model.fingerprints()
+      changes = vault.read_changes(file_name, kdf, codec, fingerprints, progress)
+      return changes, file_rows, self.__new_journal(file_name, kdf, codec)
+    def merged(result):
+      (encr_rows, changes, decrypted), file_rows, journal = result
+      if not changes:
+        # touched but not changed
+        self.disk_changed = False
+        return
+      try:
+        conflicts = model.merge(encr_rows, changes, decrypted, file_rows)
+      except ValueError as error:
+        self.__disk_changed(file_name, str(error))
+        return
+      # further edits are journaled against the file as it is now, after
+      # the edits not saved yet, which would otherwise be lost in a crash
+      self.__set_journal(self.__carry_edits(journal))
+      self.disk_changed = False
+      message = "%d rows changed in %s merged" % (len(changes), file_name)
+      if conflicts:
+        message += ", %d of them also edited here, kept as shown. Needs to be saved" % conflicts
+        self.set_needs_save()
+      self.status.showMessage(message)
+    def failed(error):
+      if isinstance(error, vault.Cancelled):
+        self.__disk_changed(file_name, "reading it was cancelled")
+      else:
+        self.__disk_changed(file_name, str(error))
+    self.run_task(read, merged, failed)
+
+  def __carry_edits(self, journal):
+    """
+    Journals the edits not saved yet (see CSVTableModel.pending_records)
+    to journal, a new journal for the same vault, in place of the current
+    one. Both share a file, which the first record truncates. Returns
+    journal, or None if it could not be written.
+    """
+    if self.journal is not None:
+      self.journal.close()
+    records = self.table_widget.model.sourceModel().pending_records() if journal is not None else []
+    if not records:
+      if self.journal is not None:
+        self.journal.discard()
+      return journal
+    try:
+      for record in records:
+        journal.append(*record)
+    except OSError as error:
+      print("Edit journal disabled:", error)
+      journal.discard()
+      return None
+    return journal
+
+  def corrupt_row_found(self):
+    message = "Rows of this vault could not be decrypted, the file is damaged. " \
+              "They are marked in the table, and have to be deleted before the vault can be saved."
+    self.status.showMessage(message)
+    QMessageBox.warning(self, "Corrupt File!", message)
+
+  def __disk_changed(self, file_name, reason):
+    print(file_name, "changed on disk:", reason)
+    self.disk_changed = True
+    message = file_name + " was changed by another program, and the changes could not be merged (" + reason + ")."
+    self.status.showMessage(message)
+    QMessageBox.warning(self, "File Changed on Disk!",
+                        message + "\nOpen it again to see them. Saving over it would overwrite them.")
 
   def show_password_create(self):
     password, confirm_password = '', None
@@ -516,191 +2122,65 @@ class MainWindow(QMainWindow):
 
   def closeEvent(self, event):
     if self.needs_save:
+      # a save running meanwhile carries on, and may finish while the user decides
+      kept = "\n They are kept in the edit journal, and can be recovered when the vault is opened again." \
+             if self.journal is not None and self.journal.count else ""
       reply = QMessageBox.question(self, 'Window Close',
-                                   'You have unsaved changes.\n Are you sure you want to close the window?',
+                                   'You have unsaved changes.' + kept + '\n Are you sure you want to close the window?',
                                    QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No, QMessageBox.StandardButton.No)
 
       if reply == QMessageBox.StandardButton.No:
         event.ignore()
         return
+    if self.task is not None:
+      # once the close is confirmed, a save in progress is cancelled,
+      # leaving the file as it was
+      self.queued_tasks = []
+      self.task.cancel()
+      QThreadPool.globalInstance().waitForDone()
+      self.task = None
+    if self.journal is not None:
+      self.journal.close()
+    self.key_cache.clear()
     event.accept()
 
   def set_needs_save(self):
     self.needs_save = True
     self.status.setStyleSheet("background-color : red")
     self.status.showMessage("WARNING: Data changed and needs to be saved")
+    if self.journal is not None and self.journal.count >= self.journal_compact_records:
+      QTimer.singleShot(0, self.compact_journal)
 
   def reset_needs_save(self):
     self.needs_save = False
     self.statusBar().setStyleSheet("")
     self.status.showMessage("")
 
-class Crypto:
-
-  delimiter = '|'
-
-  @classmethod
-  def password_check(cls, password):
-    """
-    credit: https://stackoverflow.com/a/32542964/8991379
-    Verify the strength of 'password'
-    Returns a dict indicating the wrong criteria
-    A password is considered strong if:
-        8 characters length or more
-        1 digit or more
-        1 symbol or more
-        1 uppercase letter or more
-        1 lowercase letter or more
-    """
-    error_msgs = []
-
-    # calculating the length
-    length_error = len(password) < 8
-    if length_error:
-      error_msgs.append("Length is less than 8.")
-
-    # searching for digits
-    digit_error = re.search(r"\d", password) is None
-    if digit_error:
-      error_msgs.append("Does not have at least 1 number.")
-
-    # searching for uppercase
-    uppercase_error = re.search(r"[A-Z]", password) is None
-    if uppercase_error:
-      error_msgs.append("Does not have at least 1 UPPER case letter.")
-
-    # searching for lowercase
-    lowercase_error = re.search(r"[a-z]", password) is None
-    if lowercase_error:
-      error_msgs.append("Does not have at least 1 lower case letter.")
-
-    # searching for symbols
-    # symbol_error = re.search(r"[ !#$%&'()*+,-./[\\\]^_`{|}~" + r'"]', password) is None
-    symbol_error = re.search(r"\W", password) is None
-    if symbol_error:
-      error_msgs.append("Does not have at least 1 special symbol.")
-
-    # overall result
-    password_ok = not (length_error or digit_error or uppercase_error or lowercase_error or symbol_error)
-
-    return {
-      'password_ok': password_ok,
-      'length_error': length_error,
-      'digit_error': digit_error,
-      'uppercase_error': uppercase_error,
-      'lowercase_error': lowercase_error,
-      'symbol_error': symbol_error,
-      'error_msg': '\n'.join(error_msgs)
-    }
-
-  @classmethod
-  def get_fernet(cls, password:bytes, salt: bytes):
-    kdf = PBKDF2HMAC(
-      algorithm=hashes.SHA256(),
-      length=32,
-      salt=salt,
-      iterations=100000,
-      backend=default_backend()
-    )
-    key = base64.urlsafe_b64encode(kdf.derive(password))
-    f = Fernet(key)
-    return f
-
-  @classmethod
-  def derive_key(cls, password:bytes, salt:bytes):
-    kdf = PBKDF2HMAC(
-      algorithm=hashes.SHA256(),
-      length=32,
-      salt=salt,
-      iterations=100000,
-      backend=default_backend()
-    )
-    key = kdf.derive(password)
-    return key
-
-  @classmethod
-  def encrypt_aesgcm(cls, key, plaintext:bytes, associated_data:bytes):
-    # Generate a random 96-bit IV.
-    iv = os.urandom(12)
-
-    # Construct an AES-GCM Cipher object with the given key and a
-    # randomly generated IV.
-    encryptor = Cipher(
-      algorithms.AES(key),
-      modes.GCM(iv),
-      backend=default_backend()
-    ).encryptor()
-
-    # associated_data will be authenticated but not encrypted,
-    # it must also be passed in on decryption.
-    encryptor.authenticate_additional_data(associated_data)
-
-    # Encrypt the plaintext and get the associated ciphertext.
-    # GCM does not require padding.
-    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
-
-    return (iv, ciphertext, encryptor.tag)
-
-  @classmethod
-  def decrypt_aesgcm(cls, key, associated_data:bytes, iv:bytes, ciphertext:bytes, tag:bytes):
-    # Construct a Cipher object, with the key, iv, and additionally the
-    # GCM tag used for authenticating the message.
-    decryptor = Cipher(
-      algorithms.AES(key),
-      modes.GCM(iv, tag),
-      backend=default_backend()
-    ).decryptor()
-
-    # We put associated_data back in or the tag will fail to verify
-    # when we finalize the decryptor.
-    decryptor.authenticate_additional_data(associated_data)
-
-    # Decryption gets us the authenticated plaintext.
-    # If the tag does not match an InvalidTag exception will be raised.
-    return decryptor.update(ciphertext) + decryptor.finalize()
-
-  @classmethod
-  def encrypt_row(cls, key, row:List[str]):
-    associated_data = bytes(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], 'utf-8')
-    encr_row = []
-    for field in row:
-      if not field:
-        encr_row.append('')
-        continue
-      field_bytes = bytes(field, 'utf-8')
-      iv, ciphertext, tag = Crypto.encrypt_aesgcm(key, field_bytes, associated_data)
-      encr_field = base64.urlsafe_b64encode(associated_data).decode('utf-8') + Crypto.delimiter \
-                  + base64.urlsafe_b64encode(ciphertext).decode('utf-8') + Crypto.delimiter \
-                  + base64.urlsafe_b64encode(iv).decode('utf-8') + Crypto.delimiter \
-                  + base64.urlsafe_b64encode(tag).decode('utf-8')
-      encr_row.append(encr_field)
-    return encr_row
-
-  @classmethod
-  def decrypt_row(cls, key, encr_row):
-    row = []
-    for field in encr_row:
-      if not field:
-        row.append('')
-        continue
-      field_splits = field.split(Crypto.delimiter)
-      associated_data = base64.urlsafe_b64decode(bytes(field_splits[0], 'utf-8'))
-      ciphertext = base64.urlsafe_b64decode(bytes(field_splits[1], 'utf-8'))
-      iv = base64.urlsafe_b64decode(bytes(field_splits[2], 'utf-8'))
-      tag = base64.urlsafe_b64decode(bytes(field_splits[3], 'utf-8'))
-      plaintext_bytes = Crypto.decrypt_aesgcm(key, associated_data, iv, ciphertext, tag)
-      row.append(plaintext_bytes.decode('utf-8'))
-    return row
-
-if __name__=='__main__':
+def main(argv):
+  if getattr(sys, 'frozen', False):
+    # lets a PyInstaller build start worker processes for the process executor
+    import multiprocessing
+    multiprocessing.freeze_support()
+  if any(arg.startswith('--trace') for arg in argv[1:]):
+    import argparse
+    parser = argparse.ArgumentParser(prog='ragasiyangal')
+    vault.add_trace_arguments(parser)
+    args, qt_args = parser.parse_known_args(argv[1:])
+    vault.enable_trace(args)
+    argv = argv[:1] + qt_args
   # You need one (and only one) QApplication instance per application.
-  # Pass in sys.argv to allow command line arguments for your app.
-  # If you know you won't use command line arguments QApplication([]) works too.
-  app = QApplication(sys.argv)
+  # Pass in argv to allow command line arguments for your app.
+  app = QApplication(argv)
   # Create a Qt widget, which will be our window.
   widget = TableWidget(None)
   window = MainWindow(widget)
   window.show()
-  sys.exit(app.exec())
-# Your application won't reach here until you exit and the event
-# loop has stopped.
\ No newline at end of file
+  # load the crypto stack once the window is up, rather than before it
+  # or on the first open or save
+  QTimer.singleShot(0, vault.load_crypto)
+  # Your application won't reach past exec until you exit and the event
+  # loop has stopped.
+  return app.exec()
+
+if __name__=='__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,125 @@
+"""
+Round trips of the edit journal: edits journaled after a save are
+replayed onto the saved vault file when it is opened again.
+
+  python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import vault
+from ragasiyangal import QApplication, QModelIndex, Qt, TableWidget, MainWindow
+from vault import RowCodec
+
+HEADERS = ['AccountName', 'Username', 'Password', 'Comments']
+PASSWORD = 'Journal-t3st!pass'
+
+
+class JournalReplayTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.app = QApplication.instance() or QApplication(sys.argv[:1])
+    cls.window = MainWindow(TableWidget(None))
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp(prefix='ragasiyangal-test-')
+    self.file_name = os.path.join(self.tmpdir, 'vault.csv')
+    rows = [['acct%d' % i, 'user%d' % i, 'pw%d' % i, ''] for i in range(5)]
+    self.kdf = vault.KdfParams.new(target_seconds=0)
+    self.codec = RowCodec(vault.new_key(PASSWORD.encode(), self.kdf))
+    encr_rows = self.codec.encrypt_rows([HEADERS] + rows)
+    vault.write_rows(self.file_name, self.kdf, encr_rows)
+    self.window.table_widget.update_model(encr_rows, self.codec, rows)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def model(self):
+    return self.window.table_widget.model.sourceModel()
+
+  def save(self):
+    # as the window saves with the password the vault is open with, then
+    # journals further edits against the saved file
+    model = self.model()
+    encr_rows = model.encrypted_rows(self.codec)
+    vault.write_rows(self.file_name, self.kdf, encr_rows)
+    model.mark_saved(self.codec, encr_rows)
+    model.journal = vault.Journal(self.file_name, self.kdf, self.codec)
+
+  def set_cell(self, row, column, value):
+    model = self.model()
+    model.setData(model.index(row, column), value, Qt.ItemDataRole.EditRole)
+
+  def rows(self, model):
+    return [[cell or '' for cell in model.plain_row(row)] + [model.state(row)]
+            for row in range(model.rowCount(QModelIndex()))]
+
+  def reopen(self):
+    # the saved file, with the journaled edits replayed onto it
+    model = self.model()
+    model.journal.close()
+    expected = self.rows(model)
+    with vault.VaultFile(self.file_name) as vault_file:
+      codec = RowCodec(vault_file.unlock(PASSWORD))
+      encr_rows = vault_file.encr_rows
+      decrypted = vault_file.rows(codec)[1:]
+    journal = vault.Journal(self.file_name, vault_file.kdf, codec)
+    self.window.table_widget.update_model(encr_rows, codec, decrypted)
+    self.model().replay(journal.records())
+    return expected, self.rows(self.model())
+
+  def test_edit_after_saving_deleted_row(self):
+    self.model().remove_rows([0])
+    self.save()
+    self.set_cell(0, 2, 'CHANGED')
+    expected, replayed = self.reopen()
+    self.assertEqual(replayed, expected)
+    self.assertEqual(replayed[0][:3], ['acct1', 'user1', 'CHANGED'])
+
+  def test_insert_after_saving_inserted_row(self):
+    self.model().paste_rows(2, [['mid', 'user', 'pw', '']])
+    self.save()
+    self.model().paste_rows(4, [['later', 'user', 'pw', '']])
+    self.set_cell(2, 2, 'CHANGED')
+    self.model().remove_rows([5])
+    expected, replayed = self.reopen()
+    self.assertEqual(replayed, expected)
+
+  def merge_from_disk(self, position, rows):
+    # another program inserts rows in the vault file, keeping the ciphertext
+    # of the others, and the window merges them, carrying the edits not
+    # saved yet into a journal for the new file
+    model = self.model()
+    with vault.VaultFile(self.file_name) as vault_file:
+      encr_rows = vault_file.encr_rows
+    encr_rows[position + 1:position + 1] = self.codec.encrypt_rows(rows)
+    vault.write_rows(self.file_name, self.kdf, encr_rows)
+    fingerprints, file_rows = model.fingerprints()
+    encr_rows, changes, decrypted = vault.read_changes(self.file_name, self.kdf, self.codec, fingerprints)
+    model.merge(encr_rows, changes, decrypted, file_rows)
+    journal = vault.Journal(self.file_name, self.kdf, self.codec)
+    for record in model.pending_records():
+      journal.append(*record)
+    model.journal = journal
+
+  def test_edit_after_merging_added_row(self):
+    self.model().journal = vault.Journal(self.file_name, self.kdf, self.codec)
+    self.set_cell(3, 1, 'EDITED')
+    self.model().paste_rows(1, [['local', 'user', 'pw', '']])
+    self.merge_from_disk(0, [['NEWTOP', 'user', 'pw', '']])
+    self.set_cell(0, 2, 'CHANGED')
+    self.model().insertRows(3, 1)
+    expected, replayed = self.reopen()
+    self.assertEqual(replayed, expected)
+    self.assertEqual(replayed[0][:3], ['NEWTOP', 'user', 'CHANGED'])
+
+
+if __name__ == '__main__':
+  unittest.main()
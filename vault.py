@@ -0,0 +1,2134 @@
+"""
+Vault file format and crypto for ragasiyangal, with no dependency on PyQt6.
+
+The GUI in ragasiyangal.py uses this module for all file operations, and it
+can also be used on its own to script bulk operations:
+
+  ragasiyangal list vault.csv
+  ragasiyangal get vault.csv github --field Password
+  ragasiyangal export vault.csv plain.csv
+  ragasiyangal import plain.csv vault.csv --merge
+  ragasiyangal rekey vault.csv
+  ragasiyangal convert vault.csv vault.rgsy
+  ragasiyangal calibrate --kdf scrypt
+  ragasiyangal search github vaults/ 'team-*.rgsy'
+  ragasiyangal audit vault.csv
+
+The password is read from the RAGASIYANGAL_PASSWORD environment variable
+(RAGASIYANGAL_NEW_PASSWORD for the new password of rekey) or prompted for.
+Every command accepts --trace FILE to record where the time went.
+"""
+import collections
+import csv
+import functools
+import hashlib
+import json
+import re
+import struct
+import sys
+import threading
+from array import array
+from typing import List
+
+# Needed for crypto
+import os
+import base64
+import hmac
+import time
+from datetime import datetime
+# The cryptography modules are imported on first use rather than here,
+# so that starting the GUI does not wait for them. See load_crypto().
+
+def load_crypto():
+  """Imports the cryptography modules used by this module ahead of first use"""
+  import cryptography.exceptions
+  import cryptography.hazmat.primitives.ciphers.aead
+  import cryptography.hazmat.primitives.kdf.pbkdf2
+
+class Cancelled(Exception):
+  """
+  Raised by a progress callback to stop the operation reporting to it.
+  Long operations take an optional progress(stage, done, total) callable,
+  called every Crypto.progress_interval rows; total is 0 when not known.
+  """
+
+class WrongPassword(ValueError):
+  """The password does not unlock the vault"""
+
+class CorruptVault(ValueError):
+  """The file is not a vault, or is damaged"""
+
+class Tracer:
+  """
+  Named timing spans around the expensive steps of opening and saving a
+  vault, written as a Chrome trace event JSON file (chrome://tracing,
+  Perfetto). Enabled with the RAGASIYANGAL_TRACE environment variable or
+  the --trace option, both naming the trace file; RAGASIYANGAL_TRACE_MEMORY
+  or --trace-memory also record current and peak memory with tracemalloc.
+  When disabled, span() returns a shared no-op context manager.
+  """
+
+  def __init__(self):
+    self.enabled = False
+    self.memory = False
+    self.file_name = None
+    self.events = []
+    self._origin = time.perf_counter()
+
+  def enable(self, file_name, memory=False):
+    if not self.enabled:
+      import atexit
+      atexit.register(self.write)
+    self.enabled = True
+    self.file_name = file_name
+    if memory and not self.memory:
+      import tracemalloc
+      tracemalloc.start()
+    self.memory = self.memory or memory
+
+  def enable_from_environment(self):
+    if os.environ.get('RAGASIYANGAL_TRACE'):
+      self.enable(os.environ['RAGASIYANGAL_TRACE'],
+                  os.environ.get('RAGASIYANGAL_TRACE_MEMORY', '') not in ('', '0'))
+
+  def span(self, name, **args):
+    if not self.enabled:
+      return _NO_SPAN
+    return _Span(self, name, args)
+
+  def mark(self):
+    """Starts a new operation: returns its position for summary() and resets the memory peak"""
+    if self.memory:
+      import tracemalloc
+      tracemalloc.reset_peak()
+    return len(self.events)
+
+  def summary(self, since=0):
+    """One line of total seconds per span name since mark(), and the memory peak"""
+    totals = {}
+    for event in self.events[since:]:
+      totals[event['name']] = totals.get(event['name'], 0) + event['dur'] / 1e6
+    parts = ['%s %.3fs' % item for item in totals.items()]
+    if self.memory:
+      import tracemalloc
+      parts.append('peak %.1f MB' % (tracemalloc.get_traced_memory()[1] / 2**20))
+    return ', '.join(parts)
+
+  def write(self):
+    if not self.enabled or not self.file_name:
+      return
+    with open(self.file_name, 'w') as fout:
+      json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fout)
+
+class _Span:
+
+  __slots__ = ('_tracer', '_name', '_args', '_start')
+
+  def __init__(self, tracer, name, args):
+    self._tracer = tracer
+    self._name = name
+    self._args = args
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    end = time.perf_counter()
+    tracer = self._tracer
+    if tracer.memory:
+      import tracemalloc
+      current, peak = tracemalloc.get_traced_memory()
+      self._args['memory'] = current
+      self._args['peak_memory'] = peak
+    if exc_info[0] is not None:
+      self._args['error'] = exc_info[0].__name__
+    tracer.events.append({'name': self._name, 'ph': 'X', 'pid': os.getpid(),
+                          'tid': threading.get_ident(),
+                          'ts': (self._start - tracer._origin) * 1e6,
+                          'dur': (end - self._start) * 1e6, 'args': self._args})
+    return False
+
+class _NoSpan:
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+_NO_SPAN = _NoSpan()
+
+tracer = Tracer()
+tracer.enable_from_environment()
+
+def traced(name):
+  """Decorator that runs the function in a tracer span called name"""
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if not tracer.enabled:
+        return func(*args, **kwargs)
+      with tracer.span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+class Crypto:
+
+  delimiter = '|'
+
+  # batches smaller than parallel_threshold rows are processed serially,
+  # larger ones are split into chunks over parallel_workers threads or processes
+  parallel_threshold = 5000
+  parallel_workers = os.cpu_count() or 1
+  parallel_executor = 'thread'
+  # rows between calls to a progress callback
+  progress_interval = 1000
+
+  @classmethod
+  def password_check(cls, password):
+    """
+    credit: https://stackoverflow.com/a/32542964/8991379
+    Verify the strength of 'password'
+    Returns a dict indicating the wrong criteria
+    A password is considered strong if:
+        8 characters length or more
+        1 digit or more
+        1 symbol or more
+        1 uppercase letter or more
+        1 lowercase letter or more
+    """
+    flaws = cls.password_flaws(password)
+    result = {'password_ok': not flaws}
+    result.update((name, bool(flaws & flaw)) for flaw, name, _ in cls._flaw_messages)
+    result['error_msg'] = '\n'.join(message for flaw, _, message in cls._flaw_messages if flaws & flaw)
+    return result
+
+  # password_check criteria, as the bits returned by password_flaws
+  SHORT = 1
+  NO_DIGIT = 2
+  NO_UPPER = 4
+  NO_LOWER = 8
+  NO_SYMBOL = 16
+  _flaw_messages = ((SHORT, 'length_error', "Length is less than 8."),
+                    (NO_DIGIT, 'digit_error', "Does not have at least 1 number."),
+                    (NO_UPPER, 'uppercase_error', "Does not have at least 1 UPPER case letter."),
+                    (NO_LOWER, 'lowercase_error', "Does not have at least 1 lower case letter."),
+                    (NO_SYMBOL, 'symbol_error', "Does not have at least 1 special symbol."))
+
+  @classmethod
+  def password_flaws(cls, password):
+    """
+    The password_check criteria that password fails, as a combination of
+    the SHORT, NO_DIGIT, NO_UPPER, NO_LOWER and NO_SYMBOL bits, from one
+    pass over its distinct characters. 0 for a strong password.
+    """
+    missing = cls.NO_DIGIT | cls.NO_UPPER | cls.NO_LOWER | cls.NO_SYMBOL
+    for char in set(password):
+      # the classes matched by the regexes [A-Z], [a-z], \d and \W
+      if 'A' <= char <= 'Z':
+        missing &= ~cls.NO_UPPER
+      elif 'a' <= char <= 'z':
+        missing &= ~cls.NO_LOWER
+      elif char.isdecimal():
+        missing &= ~cls.NO_DIGIT
+      elif not (char.isalnum() or char == '_'):
+        missing &= ~cls.NO_SYMBOL
+      if not missing:
+        break
+    if len(password) < 8:
+      missing |= cls.SHORT
+    return missing
+
+  @classmethod
+  def get_fernet(cls, password:bytes, salt: bytes):
+    from cryptography.fernet import Fernet
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    kdf = PBKDF2HMAC(
+      algorithm=hashes.SHA256(),
+      length=32,
+      salt=salt,
+      iterations=100000,
+      backend=default_backend()
+    )
+    key = base64.urlsafe_b64encode(kdf.derive(password))
+    f = Fernet(key)
+    return f
+
+  @classmethod
+  @traced('derive_key')
+  def derive_key(cls, password:bytes, salt:bytes, iterations=100000):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    kdf = PBKDF2HMAC(
+      algorithm=hashes.SHA256(),
+      length=32,
+      salt=salt,
+      iterations=iterations,
+      backend=default_backend()
+    )
+    key = kdf.derive(password)
+    return key
+
+  @classmethod
+  @traced('derive_key')
+  def derive_key_scrypt(cls, password:bytes, salt:bytes, n, r, p):
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+    return Scrypt(salt=salt, length=32, n=n, r=r, p=p).derive(password)
+
+  @classmethod
+  def encrypt_aesgcm(cls, key, plaintext:bytes, associated_data:bytes):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    # Generate a random 96-bit IV.
+    iv = os.urandom(12)
+
+    # Construct an AES-GCM Cipher object with the given key and a
+    # randomly generated IV.
+    encryptor = Cipher(
+      algorithms.AES(key),
+      modes.GCM(iv),
+      backend=default_backend()
+    ).encryptor()
+
+    # associated_data will be authenticated but not encrypted,
+    # it must also be passed in on decryption.
+    encryptor.authenticate_additional_data(associated_data)
+
+    # Encrypt the plaintext and get the associated ciphertext.
+    # GCM does not require padding.
+    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+
+    return (iv, ciphertext, encryptor.tag)
+
+  @classmethod
+  def decrypt_aesgcm(cls, key, associated_data:bytes, iv:bytes, ciphertext:bytes, tag:bytes):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    # Construct a Cipher object, with the key, iv, and additionally the
+    # GCM tag used for authenticating the message.
+    decryptor = Cipher(
+      algorithms.AES(key),
+      modes.GCM(iv, tag),
+      backend=default_backend()
+    ).decryptor()
+
+    # We put associated_data back in or the tag will fail to verify
+    # when we finalize the decryptor.
+    decryptor.authenticate_additional_data(associated_data)
+
+    # Decryption gets us the authenticated plaintext.
+    # If the tag does not match an InvalidTag exception will be raised.
+    return decryptor.update(ciphertext) + decryptor.finalize()
+
+  @classmethod
+  def encrypt_row(cls, key, row:List[str]):
+    return RowCodec(key).encrypt_row(row)
+
+  @classmethod
+  def decrypt_row(cls, key, encr_row):
+    return RowCodec(key).decrypt_row(encr_row)
+
+  @classmethod
+  def encrypt_rows(cls, key, rows, workers=None, executor=None):
+    return RowCodec(key).encrypt_rows(rows, workers, executor)
+
+  @classmethod
+  def decrypt_rows(cls, key, encr_rows, workers=None, executor=None):
+    return RowCodec(key).decrypt_rows(encr_rows, workers, executor)
+
+class KdfParams:
+  """
+  Key derivation function and parameters of a vault, recorded in the first
+  line of the file:
+    # ragasiyangal:2 kdf=pbkdf2-sha256 iterations=600000 salt=<b64 salt>
+    # ragasiyangal:3 kdf=scrypt n=131072 r=8 p=1 check=<b64> key=<b64> salt=<b64 salt>
+  check is a MAC of a fixed string under the key derived from the password,
+  so that a wrong password is rejected as soon as the key is derived,
+  without decrypting any row. Vaults saved before it was added have none.
+  key is the vault's data key, which the rows are encrypted with, wrapped
+  with AES-GCM under the derived key, so that a new password only needs a
+  new header (see rekey_file). Vaults saved before it was added (format 2)
+  have their rows encrypted with the derived key itself.
+  Files written before the header was versioned start with '# <b64 salt>'
+  and use PBKDF2-SHA256 with 100,000 iterations; they are read as before
+  and keep that header when saved again under the same password.
+  New vaults get parameters calibrated to take about target_seconds to
+  derive a key on this machine, and never less than the minimums below.
+  """
+
+  version = 3
+  kdfs = ('pbkdf2-sha256', 'scrypt')
+  default_kdf = 'pbkdf2-sha256'
+  target_seconds = 0.5
+  legacy_iterations = 100000
+  min_iterations = 100000
+  min_scrypt_n = 2**14
+  scrypt_r = 8
+  scrypt_p = 1
+  # scrypt uses 128 * n * r bytes of memory
+  max_scrypt_memory = 2**30
+  check_length = 16
+  # associated data of the wrapped data key
+  wrap_label = b'ragasiyangal data key'
+
+  def __init__(self, kdf, salt:bytes, legacy=False, check:bytes=None, wrapped_key:bytes=None, **params):
+    if kdf not in KdfParams.kdfs:
+      raise ValueError("Unsupported key derivation function: " + kdf)
+    self.kdf = kdf
+    self.salt = salt
+    self.legacy = legacy
+    self.check = check
+    self.wrapped_key = wrapped_key
+    self.params = params
+
+  def derive_key(self, password:bytes):
+    if self.kdf == 'scrypt':
+      return Crypto.derive_key_scrypt(password, self.salt, self.params['n'],
+                                      self.params['r'], self.params['p'])
+    return Crypto.derive_key(password, self.salt, self.params['iterations'])
+
+  @staticmethod
+  def key_check(key):
+    return hmac.new(bytes(key), b'ragasiyangal key check', 'sha256').digest()[:KdfParams.check_length]
+
+  def verify_key(self, key):
+    """Raises WrongPassword if key does not match the recorded key check"""
+    if self.check is not None and not hmac.compare_digest(KdfParams.key_check(key), self.check):
+      raise WrongPassword("wrong password")
+
+  def record_check(self, key):
+    """Records the key check of key, to be written with the header. Legacy headers have no room for it."""
+    if not self.legacy:
+      self.check = KdfParams.key_check(key)
+
+  def wrap_key(self, key, data_key:bytes):
+    """Records data_key wrapped under key, the key derived from the password"""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    nonce = os.urandom(12)
+    self.wrapped_key = nonce + AESGCM(bytes(key)).encrypt(nonce, bytes(data_key), KdfParams.wrap_label)
+
+  def data_key(self, key):
+    """
+    The key the rows are encrypted with, given key, the key derived from
+    the password and checked with verify_key: the unwrapped data key, or
+    key itself for vaults without one. Raises WrongPassword if the data key
+    does not unwrap, or CorruptVault if it does not although the key check
+    passed.
+    """
+    if self.wrapped_key is None:
+      return key
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    try:
+      return AESGCM(bytes(key)).decrypt(self.wrapped_key[:12], self.wrapped_key[12:], KdfParams.wrap_label)
+    except (InvalidTag, ValueError) as error:
+      if self.check is not None:
+        raise CorruptVault("the data key in the header is damaged") from error
+      raise WrongPassword("wrong password") from error
+
+  def line(self):
+    if self.legacy:
+      return '# ' + base64.urlsafe_b64encode(self.salt).decode('utf-8')
+    b64encode = base64.urlsafe_b64encode
+    # format 2 readers know every field but the wrapped key
+    return ' '.join(['# ragasiyangal:%d' % (KdfParams.version if self.wrapped_key else 2), 'kdf=' + self.kdf]
+                    + ['%s=%d' % item for item in sorted(self.params.items())]
+                    + (['check=' + b64encode(self.check).decode('utf-8')] if self.check else [])
+                    + (['key=' + b64encode(self.wrapped_key).decode('utf-8')] if self.wrapped_key else [])
+                    + ['salt=' + b64encode(self.salt).decode('utf-8')])
+
+  @classmethod
+  def parse(cls, line):
+    fields = line.lstrip('#').split()
+    if not fields or not fields[0].startswith('ragasiyangal:'):
+      # legacy header, the salt alone
+      return cls('pbkdf2-sha256', cls._parse_salt(line.lstrip('#').strip()),
+                 legacy=True, iterations=cls.legacy_iterations)
+    version = int(fields[0].partition(':')[2])
+    if version > KdfParams.version:
+      raise ValueError("Vault was written by a newer version (format %d)" % version)
+    values = dict(field.split('=', 1) for field in fields[1:])
+    salt = cls._parse_salt(values.pop('salt'))
+    check, wrapped_key = values.pop('check', None), values.pop('key', None)
+    if check is not None:
+      check = base64.urlsafe_b64decode(bytes(check, 'utf-8'))
+    if wrapped_key is not None:
+      wrapped_key = base64.urlsafe_b64decode(bytes(wrapped_key, 'utf-8'))
+    kdf = values.pop('kdf')
+    return cls(kdf, salt, check=check, wrapped_key=wrapped_key,
+               **{name: int(value) for name, value in values.items()})
+
+  @staticmethod
+  def _parse_salt(text):
+    # an empty file, or an empty line, reads as a legacy header without a salt
+    salt = base64.urlsafe_b64decode(bytes(text, 'utf-8'))
+    if not salt:
+      raise ValueError("no salt in the header")
+    return salt
+
+  @classmethod
+  def new(cls, kdf=None, target_seconds=None):
+    """Parameters for a new vault: a random salt and calibrated costs"""
+    kdf = kdf or cls.default_kdf
+    params = cls.calibrate(kdf, cls.target_seconds if target_seconds is None else target_seconds)
+    return cls(kdf, os.urandom(32), **dict(params))
+
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def calibrate(cls, kdf, target_seconds):
+    """
+    Returns the parameters, as (name, value) pairs, for which kdf takes
+    about target_seconds on this machine. The cost is measured once per
+    process with a small probe and scaled, since both functions take time
+    linear in their cost parameter.
+    """
+    salt = os.urandom(32)
+    if kdf == 'scrypt':
+      n, r, p = cls.min_scrypt_n, cls.scrypt_r, cls.scrypt_p
+      start = time.perf_counter()
+      Crypto.derive_key_scrypt(b'calibration', salt, n, r, p)
+      scale = target_seconds / (time.perf_counter() - start)
+      while scale >= 2 and 128 * (n * 2) * r <= cls.max_scrypt_memory:
+        n *= 2
+        scale /= 2
+      return (('n', n), ('p', p), ('r', r))
+    if kdf != 'pbkdf2-sha256':
+      raise ValueError("Unsupported key derivation function: " + kdf)
+    probe = 10000
+    while True:
+      start = time.perf_counter()
+      Crypto.derive_key(b'calibration', salt, probe)
+      elapsed = time.perf_counter() - start
+      # too short a probe is dominated by timer and call overhead
+      if elapsed >= 0.02 or probe >= cls.min_iterations:
+        break
+      probe *= 2
+    iterations = int(probe * target_seconds / elapsed) // 1000 * 1000
+    return (('iterations', max(cls.min_iterations, iterations)),)
+
+  def _key(self):
+    return (self.kdf, self.salt, tuple(sorted(self.params.items())))
+
+  def __eq__(self, other):
+    return isinstance(other, KdfParams) and self._key() == other._key()
+
+  def __hash__(self):
+    return hash(self._key())
+
+  def __repr__(self):
+    return 'KdfParams(%r, %s)' % (self.kdf, ', '.join('%s=%d' % item for item in sorted(self.params.items())))
+
+class KeyCache:
+  """
+  Session cache of keys derived with KdfParams, so repeated operations
+  on the same vault do not pay for the KDF again.
+  Entries are keyed by (KdfParams, HMAC of the password under a per-process secret)
+  and expire after ttl seconds. Keys are held in bytearrays which are zeroed
+  when evicted; this is best effort since Python may have made copies.
+  Callers that keep a key beyond the current operation keep a copy.
+  """
+
+  def __init__(self, ttl=300):
+    self._ttl = ttl
+    self._secret = os.urandom(32)
+    self._entries = {}
+
+  def derive_key(self, password:bytes, kdf:KdfParams):
+    self.expire()
+    cache_key = (kdf, hmac.new(self._secret, password, 'sha256').digest())
+    entry = self._entries.get(cache_key)
+    if entry is None:
+      entry = [bytearray(kdf.derive_key(password)), 0]
+      self._entries[cache_key] = entry
+    entry[1] = time.monotonic() + self._ttl
+    return entry[0]
+
+  def expire(self):
+    now = time.monotonic()
+    for cache_key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+      self._evict(cache_key)
+
+  def clear(self):
+    for cache_key in list(self._entries):
+      self._evict(cache_key)
+
+  def _evict(self, cache_key):
+    key, _ = self._entries.pop(cache_key)
+    key[:] = bytes(len(key))
+
+  def __len__(self):
+    return len(self._entries)
+
+class RowCodec:
+  """
+  Encrypts and decrypts whole rows with one keyed AES-GCM context.
+  Every non-empty field is written as b64(aad)|b64(ciphertext)|b64(iv)|b64(tag),
+  the same format produced by encrypt_aesgcm, so files stay interchangeable.
+  """
+
+  tag_length = 16
+
+  def __init__(self, key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    # a copy of its own: a key handed out by a KeyCache is zeroed when
+    # evicted, while the codec may still be in use
+    self._key = bytes(key)
+    self._aesgcm = AESGCM(self._key)
+
+  def encrypt_row(self, row:List[str]):
+    b64encode = base64.urlsafe_b64encode
+    # one timestamp per row is used as associated data for all its fields
+    associated_data = bytes(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], 'utf-8')
+    aad_prefix = b64encode(associated_data).decode('utf-8') + Crypto.delimiter
+    encrypt = self._aesgcm.encrypt
+    encr_row = []
+    for field in row:
+      if not field:
+        encr_row.append('')
+        continue
+      iv = os.urandom(12)
+      sealed = encrypt(iv, field.encode('utf-8'), associated_data)
+      encr_row.append(aad_prefix
+                      + b64encode(sealed[:-RowCodec.tag_length]).decode('utf-8') + Crypto.delimiter
+                      + b64encode(iv).decode('utf-8') + Crypto.delimiter
+                      + b64encode(sealed[-RowCodec.tag_length:]).decode('utf-8'))
+    return encr_row
+
+  def decrypt_row(self, encr_row):
+    b64decode = base64.urlsafe_b64decode
+    decrypt = self._aesgcm.decrypt
+    row = []
+    for field in encr_row:
+      if not field:
+        row.append('')
+        continue
+      aad, ciphertext, iv, tag = field.split(Crypto.delimiter)
+      # AESGCM expects the tag appended to the ciphertext
+      # If the tag does not match an InvalidTag exception will be raised.
+      plaintext_bytes = decrypt(b64decode(iv), b64decode(ciphertext) + b64decode(tag), b64decode(aad))
+      row.append(plaintext_bytes.decode('utf-8'))
+    return row
+
+  def seal_record(self, row, associated_data:bytes):
+    """
+    Encrypts a whole row as one record of the binary format: returns a
+    random nonce and the ciphertext of the length-prefixed fields.
+    """
+    fields = [('' if cell is None else cell).encode('utf-8') for cell in row]
+    plaintext = b''.join(struct.pack('<I', len(field)) + field for field in fields)
+    nonce = os.urandom(12)
+    return nonce, self._aesgcm.encrypt(nonce, plaintext, associated_data)
+
+  def open_record(self, nonce, ciphertext, associated_data:bytes):
+    plaintext = self._aesgcm.decrypt(bytes(nonce), bytes(ciphertext), associated_data)
+    row, offset = [], 0
+    while offset < len(plaintext):
+      length, = struct.unpack_from('<I', plaintext, offset)
+      row.append(plaintext[offset + 4:offset + 4 + length].decode('utf-8'))
+      offset += 4 + length
+    return row
+
+  def has_key(self, key):
+    return hmac.compare_digest(bytes(self._key), bytes(key))
+
+  def subkey(self, label:bytes):
+    """A key for another purpose, derived from this codec's key by HMAC-SHA256 over label"""
+    return hmac.new(bytes(self._key), label, hashlib.sha256).digest()
+
+  def decrypt_field(self, field):
+    b64decode = base64.urlsafe_b64decode
+    aad, ciphertext, iv, tag = field.split(Crypto.delimiter)
+    return self._aesgcm.decrypt(b64decode(iv), b64decode(ciphertext) + b64decode(tag),
+                                b64decode(aad)).decode('utf-8')
+
+  def encrypt_rows(self, rows, workers=None, executor=None, progress=None):
+    rows = list(rows)
+    with tracer.span('encrypt_rows', rows=len(rows)):
+      return self._map_rows(self.encrypt_row, _encrypt_chunk, rows, workers, executor,
+                            progress, "Encrypting")
+
+  def decrypt_rows(self, encr_rows, workers=None, executor=None, progress=None):
+    encr_rows = list(encr_rows)
+    with tracer.span('decrypt_rows', rows=len(encr_rows)):
+      return self._map_rows(self.decrypt_row, _decrypt_chunk, encr_rows, workers, executor,
+                            progress, "Decrypting")
+
+  def _map_rows(self, row_func, chunk_func, rows, workers, executor, progress=None, stage=None):
+    rows = list(rows)
+    workers = Crypto.parallel_workers if workers is None else workers
+    executor = executor or Crypto.parallel_executor
+    if workers <= 1 or len(rows) < Crypto.parallel_threshold:
+      if progress is None:
+        return [row_func(row) for row in rows]
+      result = []
+      for start in range(0, len(rows), Crypto.progress_interval):
+        progress(stage, start, len(rows))
+        result.extend([row_func(row) for row in rows[start:start + Crypto.progress_interval]])
+      progress(stage, len(rows), len(rows))
+      return result
+    # a few chunks per worker keeps them busy when chunks finish unevenly
+    chunk_size = -(-len(rows) // (workers * 4))
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    if executor == 'process':
+      # worker processes build their own RowCodec from the raw key
+      pool = ProcessPoolExecutor(workers)
+      key = bytes(self._key)
+      jobs = [pool.submit(chunk_func, key, chunk) for chunk in chunks]
+    elif executor == 'thread':
+      pool = ThreadPoolExecutor(workers)
+      jobs = [pool.submit(lambda chunk: [row_func(row) for row in chunk], chunk) for chunk in chunks]
+    else:
+      raise ValueError("Unknown executor: " + executor)
+    with pool:
+      # chunks are collected in submission order, so rows keep their order
+      result = []
+      try:
+        for job in jobs:
+          result.extend(job.result())
+          if progress is not None:
+            progress(stage, len(result), len(rows))
+      except BaseException:
+        # chunks already running finish, the others are dropped
+        pool.shutdown(cancel_futures=True)
+        raise
+      return result
+
+def _encrypt_chunk(key, rows):
+  codec = RowCodec(key)
+  return [codec.encrypt_row(row) for row in rows]
+
+def _decrypt_chunk(key, encr_rows):
+  codec = RowCodec(key)
+  return [codec.decrypt_row(encr_row) for encr_row in encr_rows]
+
+def password_key(password:bytes, kdf:KdfParams, key_cache=None):
+  """Derives the key for password with kdf, through key_cache if given"""
+  if key_cache is not None:
+    return key_cache.derive_key(password, kdf)
+  return kdf.derive_key(password)
+
+def derive_key(password:bytes, kdf:KdfParams, key_cache=None):
+  """
+  Returns the key the rows of the vault are encrypted with (see
+  KdfParams.data_key), raising WrongPassword if kdf has a key check the key
+  derived from password fails, or a data key which does not unwrap with it.
+  """
+  key = password_key(password, kdf, key_cache)
+  kdf.verify_key(key)
+  return kdf.data_key(key)
+
+def new_key(password:bytes, kdf:KdfParams, key_cache=None, codec=None):
+  """
+  Derives the key for password under new parameters kdf, records its key
+  check and wraps a data key with it: codec's key, so that rows encrypted
+  with codec stay valid, or a new random one. Returns the data key.
+  """
+  kdf.check = None
+  kdf.wrapped_key = None
+  key = password_key(password, kdf, key_cache)
+  kdf.record_check(key)
+  if kdf.legacy:
+    # no room for a data key in the header
+    return key
+  data_key = os.urandom(32) if codec is None else bytes(codec._key)
+  kdf.wrap_key(key, data_key)
+  return data_key
+
+def read_header(fin):
+  """Reads the KdfParams from the comment line at the top of a vault file"""
+  try:
+    return KdfParams.parse(fin.readline())
+  except (ValueError, KeyError) as error:
+    raise CorruptVault("not a vault file, or a damaged one: %s" % error) from error
+
+def write_header(fout, kdf:KdfParams):
+  # write the salt and KDF parameters to file as a comment metadata
+  # https://www.w3.org/TR/tabular-data-model/#embedded-metadata
+  fout.write(kdf.line() + '\n')
+
+def read_file(file_name, password, key_cache=None, progress=None):
+  """
+  Returns the KdfParams, the key and the encrypted rows (headers first) of a CSV vault file.
+  """
+  vault_file = VaultFile(file_name, progress)
+  key = vault_file.unlock(password, key_cache, progress)
+  return vault_file.kdf, key, vault_file.encr_rows
+
+def read_rows(fin, progress=None, stage="Reading"):
+  """Reads all CSV rows from fin, reporting progress every Crypto.progress_interval rows"""
+  return list(_progress_rows(csv.reader(fin), progress, stage, 0))
+
+def _progress_rows(rows, progress, stage, total):
+  # passes rows through, calling progress every Crypto.progress_interval rows
+  if progress is None:
+    yield from rows
+    return
+  done = 0
+  progress(stage, 0, total)
+  for row in rows:
+    yield row
+    done += 1
+    if done % Crypto.progress_interval == 0:
+      progress(stage, done, total)
+  progress(stage, done, total)
+
+# Column names used by other password managers' CSV exports (Chrome, Edge,
+# Firefox, Bitwarden, LastPass, 1Password, KeePass, KeePassXC, Dashlane),
+# casefolded, in order of preference for each column of a vault
+IMPORT_COLUMNS = {
+  'AccountName': ('accountname', 'account', 'name', 'title', 'url', 'login_uri',
+                  'website', 'web site'),
+  'Username': ('username', 'login_username', 'login name', 'user name', 'login',
+               'user', 'email'),
+  'Password': ('password', 'login_password'),
+  'Comments': ('comments', 'notes', 'note', 'comment', 'extra'),
+}
+
+def import_mapping(headers, columns=None):
+  """
+  Maps the headers of a CSV export to columns (Vault.default_headers by
+  default). Returns, for each column, the index of the header it is taken
+  from, or None. Returns None instead when the headers are the columns
+  already, or when they match fewer than two of them, so that the rows
+  are imported as they are.
+  """
+  columns = columns or Vault.default_headers
+  names = [header.strip().casefold() for header in headers]
+  if names == [column.casefold() for column in columns]:
+    return None
+  mapping = []
+  for column in columns:
+    candidates = IMPORT_COLUMNS.get(column, (column.casefold(),))
+    mapping.append(next((names.index(name) for name in candidates if name in names), None))
+  if sum(index is not None for index in mapping) < 2:
+    return None
+  return mapping
+
+def read_import(fin, chunk_size=1000, progress=None):
+  """
+  Reads a plaintext CSV file, such as an export from another password
+  manager, without holding all of it in memory. Returns the headers and an
+  iterator over lists of at most chunk_size rows. The headers of known
+  exporter layouts are mapped to Vault.default_headers (see import_mapping).
+  """
+  reader = csv.reader(fin)
+  headers = next(reader, None)
+  if not headers:
+    return None, iter(())
+  mapping = import_mapping(headers)
+  if mapping is not None:
+    headers = list(Vault.default_headers)
+  def chunks():
+    rows = []
+    for row in _progress_rows(reader, progress, "Importing", 0):
+      if mapping is not None:
+        row = [row[index] if index is not None and index < len(row) else '' for index in mapping]
+      rows.append(row)
+      if len(rows) == chunk_size:
+        yield rows
+        rows = []
+    if rows:
+      yield rows
+  return headers, chunks()
+
+def iter_file(file_name, password, key_cache=None):
+  """
+  Yields the decrypted rows (headers first) of a vault file one at a time.
+  """
+  from cryptography.exceptions import InvalidTag
+  with open(file_name) as fin:
+    kdf = read_header(fin)
+    codec = RowCodec(derive_key(bytes(password, 'utf-8'), kdf, key_cache))
+    for number, encr_row in enumerate(csv.reader(fin)):
+      try:
+        yield codec.decrypt_row(encr_row)
+      except (InvalidTag, ValueError) as error:
+        if number == 0 and kdf.check is None and isinstance(error, InvalidTag):
+          raise WrongPassword("wrong password") from error
+        raise CorruptVault("row %d does not decrypt, the file is damaged" % number) from error
+
+def write_file(file_name, password, rows, key_cache=None, kdf=None):
+  """
+  Encrypts rows (headers first) under password with a fresh salt and
+  writes them to file_name. kdf defaults to KdfParams.new().
+  Returns the key used.
+  """
+  kdf = kdf or KdfParams.new()
+  key = new_key(bytes(password, 'utf-8'), kdf, key_cache)
+  write_rows(file_name, kdf, Crypto.encrypt_rows(key, rows))
+  return key
+
+def write_rows(file_name, kdf:KdfParams, encr_rows, verify=None, progress=None):
+  """
+  Writes rows that are already encrypted (headers first) under the key
+  derived with kdf. The rows go to a temporary file next to file_name,
+  which is flushed to disk and then renamed over file_name, so file_name
+  always holds either the old or the new vault.
+  verify, if given, is called with an iterator over the rows read back
+  from the temporary file before the rename; if it raises, the temporary
+  file is removed and file_name is left untouched. The same holds when
+  progress raises Cancelled.
+  """
+  def write(fout):
+    with tracer.span('write_csv'):
+      write_header(fout, kdf)
+      csv.writer(fout).writerows(_progress_rows(encr_rows, progress, "Writing", len(encr_rows)))
+  def check(tmp_name):
+    with open(tmp_name) as fin, tracer.span('verify'):
+      read_header(fin)
+      verify(_progress_rows(csv.reader(fin), progress, "Verifying", len(encr_rows)))
+  _replace_file(file_name, "w", write, check if verify is not None else None)
+
+def _replace_file(file_name, mode, write, check=None):
+  # calls write(fout) on a temporary file next to file_name, flushes it to
+  # disk, calls check(tmp_name) and renames it over file_name; on any
+  # exception the temporary file is removed and file_name is left as it was
+  import shutil
+  import tempfile
+  file_name = os.path.abspath(file_name)
+  directory = os.path.dirname(file_name)
+  fd, tmp_name = tempfile.mkstemp(prefix='.' + os.path.basename(file_name) + '.',
+                                  suffix='.tmp', dir=directory)
+  try:
+    with os.fdopen(fd, mode) as fout:
+      write(fout)
+      fout.flush()
+      os.fsync(fout.fileno())
+    if check is not None:
+      check(tmp_name)
+    if os.path.exists(file_name):
+      shutil.copymode(file_name, tmp_name)
+    os.replace(tmp_name, file_name)
+  except BaseException:
+    os.unlink(tmp_name)
+    raise
+  _fsync_directory(directory)
+
+class BinaryVault:
+  """
+  Binary vault container, an alternative to the CSV format with raw bytes
+  and a single AES-GCM record per row:
+    magic       8 bytes, b'RGSYVLT2'
+    header      u32 length, then the KdfParams header line in UTF-8
+    rows        per row: 12 byte nonce, u32 length, ciphertext and tag;
+                the plaintext is each field as u32 length + UTF-8 bytes,
+                and the associated data is the header line, or the magic
+                for vaults with a data key, whose header changes with the
+                password while the rows do not
+    index       u64 offset of each row, headers first
+    trailer     u64 offset of the index, u64 number of rows, b'RGSYIDX2'
+  All integers are little-endian. The file is memory mapped and rows are
+  found through the index, so any row can be decrypted without reading
+  the others.
+  """
+
+  magic = b'RGSYVLT2'
+  index_magic = b'RGSYIDX2'
+  suffix = '.rgsy'
+  nonce_length = 12
+  _trailer = struct.Struct('<QQ8s')
+
+  def __init__(self, file_name):
+    import mmap
+    self._file = open(file_name, 'rb')
+    try:
+      self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+      if self._map[:8] != BinaryVault.magic:
+        raise ValueError(file_name + ": not a binary vault")
+      header_length, = struct.unpack_from('<I', self._map, 8)
+      self.header = bytes(self._map[12:12 + header_length])
+      self.kdf = KdfParams.parse(self.header.decode('utf-8'))
+      self.associated_data = BinaryVault.associated_data(self.kdf, self.header)
+      index_offset, self._num_rows, index_magic = \
+        BinaryVault._trailer.unpack_from(self._map, len(self._map) - BinaryVault._trailer.size)
+      if index_magic != BinaryVault.index_magic \
+          or index_offset + 8 * self._num_rows + BinaryVault._trailer.size != len(self._map):
+        raise ValueError(file_name + ": truncated or corrupt binary vault")
+      self._index_offset = index_offset
+    except BaseException:
+      self.close()
+      raise
+
+  def __len__(self):
+    return self._num_rows
+
+  def record(self, row):
+    """The nonce and the ciphertext of a row (0 is the headers)"""
+    if not 0 <= row < self._num_rows:
+      raise IndexError(row)
+    offset, = struct.unpack_from('<Q', self._map, self._index_offset + 8 * row)
+    length, = struct.unpack_from('<I', self._map, offset + BinaryVault.nonce_length)
+    start = offset + BinaryVault.nonce_length + 4
+    return self._map[offset:offset + BinaryVault.nonce_length], self._map[start:start + length]
+
+  def decrypt_row(self, codec, row):
+    nonce, ciphertext = self.record(row)
+    return codec.open_record(nonce, ciphertext, self.associated_data)
+
+  def rows(self, codec, progress=None):
+    """Decrypts every row, headers first"""
+    return [self.decrypt_row(codec, row)
+            for row in _progress_rows(range(self._num_rows), progress, "Decrypting", self._num_rows)]
+
+  def close(self):
+    if getattr(self, '_map', None) is not None:
+      self._map.close()
+      self._map = None
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  @classmethod
+  def associated_data(cls, kdf:KdfParams, header:bytes):
+    return cls.magic if kdf.wrapped_key is not None else header
+
+  @classmethod
+  def detect(cls, file_name):
+    """Whether file_name is a binary vault rather than a CSV one"""
+    with open(file_name, 'rb') as fin:
+      return fin.read(len(cls.magic)) == cls.magic
+
+  @classmethod
+  def write(cls, file_name, kdf:KdfParams, codec, rows, verify=True, progress=None):
+    """
+    Encrypts rows (headers first) with codec and writes them to file_name,
+    through a temporary file like write_rows. With verify, every row is
+    read back from the temporary file and decrypted before the rename.
+    """
+    rows = rows if isinstance(rows, list) else list(rows)
+    header = kdf.line().encode('utf-8')
+    associated_data = cls.associated_data(kdf, header)
+    def write(fout):
+      with tracer.span('write_binary', rows=len(rows)):
+        fout.write(cls.magic + struct.pack('<I', len(header)) + header)
+        offsets = array('Q')
+        offset = len(cls.magic) + 4 + len(header)
+        for row in _progress_rows(rows, progress, "Encrypting", len(rows)):
+          nonce, ciphertext = codec.seal_record(row, associated_data)
+          offsets.append(offset)
+          fout.write(nonce + struct.pack('<I', len(ciphertext)) + ciphertext)
+          offset += len(nonce) + 4 + len(ciphertext)
+        if sys.byteorder != 'little':
+          offsets.byteswap()
+        fout.write(offsets.tobytes())
+        fout.write(cls._trailer.pack(offset, len(rows), cls.index_magic))
+    def check(tmp_name):
+      with cls(tmp_name) as written, tracer.span('verify'):
+        if len(written) != len(rows):
+          raise ValueError("Saved file has a different number of rows")
+        for row in _progress_rows(range(len(rows)), progress, "Verifying", len(rows)):
+          if written.decrypt_row(codec, row) != ['' if cell is None else cell for cell in rows[row]]:
+            raise ValueError("Saved row does not decrypt to the row written")
+    _replace_file(file_name, "wb", write, check if verify else None)
+
+  def copy(self, file_name, kdf:KdfParams, codec):
+    """
+    Writes this vault to file_name with the header of kdf instead of its
+    own, copying the rows as they are: kdf must wrap the same data key.
+    The headers row is decrypted with codec from the written file, as a
+    check, before it replaces file_name.
+    """
+    header = kdf.line().encode('utf-8')
+    start = 12 + len(self.header)
+    # rows move by the difference in header length
+    shift = len(header) - len(self.header)
+    def write(fout):
+      with tracer.span('copy_binary', rows=self._num_rows):
+        fout.write(BinaryVault.magic + struct.pack('<I', len(header)) + header)
+        fout.write(self._map[start:self._index_offset])
+        offsets = array('Q', self._map[self._index_offset:self._index_offset + 8 * self._num_rows])
+        if sys.byteorder != 'little':
+          offsets.byteswap()
+        offsets = array('Q', (offset + shift for offset in offsets))
+        if sys.byteorder != 'little':
+          offsets.byteswap()
+        fout.write(offsets.tobytes())
+        fout.write(BinaryVault._trailer.pack(self._index_offset + shift, self._num_rows, BinaryVault.index_magic))
+    def check(tmp_name):
+      with BinaryVault(tmp_name) as written:
+        if len(written) != self._num_rows:
+          raise ValueError("Saved file has a different number of rows")
+        written.decrypt_row(codec, 0)
+    _replace_file(file_name, "wb", write, check)
+
+def is_binary(file_name):
+  return BinaryVault.detect(file_name)
+
+def binary_target(file_name):
+  """Whether saving to file_name writes a binary vault: existing vaults
+  keep their format, new ones are binary when named *.rgsy"""
+  if os.path.exists(file_name):
+    return is_binary(file_name)
+  return file_name.endswith(BinaryVault.suffix)
+
+class VaultFile:
+  """
+  A vault file in either format, read and parsed once so that it can be
+  unlocked with one password after another: a wrong password costs only
+  the key derivation. Raises CorruptVault if the file cannot be parsed;
+  unlock() raises WrongPassword, and rows() CorruptVault for rows that do
+  not decrypt under the right key.
+  """
+
+  def __init__(self, file_name, progress=None):
+    self.file_name = file_name
+    self.binary = None
+    self.encr_rows = None
+    try:
+      if is_binary(file_name):
+        self.binary = BinaryVault(file_name)
+        self.kdf = self.binary.kdf
+        num_rows = len(self.binary)
+      else:
+        with open(file_name) as fin:
+          self.kdf = read_header(fin)
+          with tracer.span('read_csv'):
+            self.encr_rows = read_rows(fin, progress)
+        num_rows = len(self.encr_rows)
+    except (ValueError, KeyError, struct.error, csv.Error) as error:
+      if isinstance(error, CorruptVault):
+        raise
+      raise CorruptVault("not a vault file, or a damaged one: %s" % error) from error
+    if not num_rows:
+      self.close()
+      raise CorruptVault("not a vault file: no headers row")
+
+  def unlock(self, password, key_cache=None, progress=None):
+    """Returns the key the rows are encrypted with, or raises WrongPassword"""
+    if progress is not None:
+      progress("Deriving key", 0, 0)
+    return self.check_key(password_key(bytes(password, 'utf-8'), self.kdf, key_cache))
+
+  def check_key(self, key):
+    """
+    Returns the key the rows are encrypted with if key, derived from the
+    password, unlocks the vault, or raises WrongPassword
+    """
+    from cryptography.exceptions import InvalidTag
+    self.kdf.verify_key(key)
+    key = self.kdf.data_key(key)
+    if self.kdf.check is None:
+      # no key check in the header: only the right key decrypts the headers row
+      try:
+        self.headers(RowCodec(key))
+      except CorruptVault as error:
+        if isinstance(error.__cause__, InvalidTag):
+          raise WrongPassword("wrong password") from error.__cause__
+        raise
+    return key
+
+  def headers(self, codec):
+    """Decrypts the headers row"""
+    if self.binary is not None:
+      return self._decrypt(lambda: self.binary.decrypt_row(codec, 0))
+    return self._decrypt(lambda: codec.decrypt_row(self.encr_rows[0]))
+
+  def rows(self, codec, progress=None, workers=None):
+    """Decrypts every row, headers first"""
+    if self.binary is not None:
+      return self._decrypt(lambda: self.binary.rows(codec, progress))
+    return self._decrypt(lambda: codec.decrypt_rows(self.encr_rows, workers, progress=progress))
+
+  def _decrypt(self, decrypt):
+    from cryptography.exceptions import InvalidTag
+    try:
+      return decrypt()
+    except (InvalidTag, ValueError) as error:
+      raise CorruptVault("a row does not decrypt, the file is damaged (%s)" % (str(error) or type(error).__name__)) from error
+
+  def close(self):
+    if self.binary is not None:
+      self.binary.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+def read_kdf(file_name):
+  """The KdfParams of a vault in either format, read without its rows"""
+  try:
+    if is_binary(file_name):
+      with BinaryVault(file_name) as binary:
+        return binary.kdf
+  except (ValueError, struct.error) as error:
+    raise CorruptVault("not a vault file, or a damaged one: %s" % error) from error
+  with open(file_name) as fin:
+    return read_header(fin)
+
+def read_vault(file_name, password, key_cache=None, progress=None):
+  """
+  Returns the KdfParams, the RowCodec and the decrypted rows (headers
+  first) of a vault in either format.
+  """
+  with VaultFile(file_name, progress) as vault_file:
+    codec = RowCodec(vault_file.unlock(password, key_cache, progress))
+    return vault_file.kdf, codec, vault_file.rows(codec, progress)
+
+def convert_file(source, target, password, binary=None, key_cache=None, progress=None):
+  """
+  Writes the vault source to target in the other format (or as binary
+  says), under the same password, salt and KDF parameters. The plaintext
+  is kept exactly; every row gets new ciphertext. Returns True if target
+  was written as a binary vault.
+  """
+  kdf, codec, rows = read_vault(source, password, key_cache, progress)
+  if binary is None:
+    binary = not is_binary(source)
+  if binary:
+    BinaryVault.write(target, kdf, codec, rows, progress=progress)
+  else:
+    write_rows(target, kdf, codec.encrypt_rows(rows, progress=progress))
+  return binary
+
+def rekey_file(file_name, password, new_password, output=None, kdf=None, rotate=False,
+               key_cache=None, progress=None):
+  """
+  Changes the password of the vault file_name, writing it to output
+  (default file_name) in the same format, under new parameters kdf
+  (default KdfParams.new()). The data key of the vault is wrapped under
+  the new password and the rows are copied byte for byte, so only the
+  header is new: no row is parsed, decrypted or encrypted, and the cost
+  is two key derivations and a file copy. Vaults without a data key, from
+  before it was added, are decrypted and encrypted again under a new one,
+  as is every vault with rotate, for when the old data key may be known,
+  and every vault written to an output in the other format (see
+  binary_target). Returns True if the rows were encrypted again.
+  """
+  kdf = kdf or KdfParams.new()
+  output = output or file_name
+  binary = binary_target(output)
+  new_password = bytes(new_password, 'utf-8')
+  if not rotate and not binary and not is_binary(file_name):
+    with open(file_name) as fin:
+      old_kdf = read_header(fin)
+    if old_kdf.wrapped_key is not None:
+      if progress is not None:
+        progress("Deriving key", 0, 0)
+      codec = RowCodec(derive_key(bytes(password, 'utf-8'), old_kdf, key_cache))
+      new_key(new_password, kdf, key_cache, codec)
+      _copy_rows(file_name, output, kdf, codec)
+      return False
+  with VaultFile(file_name, progress) as vault_file:
+    codec = RowCodec(vault_file.unlock(password, key_cache, progress))
+    if not rotate and vault_file.kdf.wrapped_key is not None and binary == (vault_file.binary is not None):
+      new_key(new_password, kdf, key_cache, codec)
+      vault_file.binary.copy(output, kdf, codec)
+      return False
+    rows = vault_file.rows(codec, progress)
+  codec = RowCodec(new_key(new_password, kdf, key_cache))
+  if binary:
+    BinaryVault.write(output, kdf, codec, rows, progress=progress)
+  else:
+    write_rows(output, kdf, codec.encrypt_rows(rows, progress=progress))
+  return True
+
+def _copy_rows(file_name, output, kdf:KdfParams, codec):
+  # writes the CSV vault file_name to output with the header of kdf and the
+  # rows copied as they are; the headers row is decrypted from the written
+  # file as a check before it replaces output
+  import shutil
+  with open(file_name, 'rb') as fin:
+    fin.readline()
+    def write(fout):
+      with tracer.span('copy_csv'):
+        fout.write(bytes(kdf.line() + '\n', 'utf-8'))
+        shutil.copyfileobj(fin, fout, 1 << 20)
+    def check(tmp_name):
+      with open(tmp_name) as written:
+        read_header(written)
+        codec.decrypt_row(next(csv.reader(written)))
+    _replace_file(output, "wb", write, check)
+
+def file_digest(file_name):
+  """SHA-256 of the contents of file_name"""
+  digest = hashlib.sha256()
+  with open(file_name, 'rb') as fin:
+    for block in iter(lambda: fin.read(1 << 20), b''):
+      digest.update(block)
+  return digest.digest()
+
+class Journal:
+  """
+  Encrypted append-only log of the edits made to a vault since it was
+  saved, kept next to it as <vault>.journal, so that edits survive a crash
+  at the cost of one small record each rather than a rewrite of the vault:
+    magic       8 bytes, b'RGSYJNL1'
+    digest      SHA-256 of the vault file the edits apply to
+    records     per record: 12 byte nonce, u32 length, ciphertext and tag;
+                the plaintext is a list of fields as in the binary format,
+                and the associated data is the digest and the u64 number
+                of the record
+  Records are sealed with the vault's own key, so no key is derived. A
+  journal left for another version of the vault is ignored, and replaced
+  by the next append. Reading stops at the first record that is cut short
+  or fails to authenticate, which is where a crash during an append
+  leaves the file; appends continue from there.
+  """
+
+  magic = b'RGSYJNL1'
+  suffix = '.journal'
+
+  def __init__(self, vault_name, kdf:KdfParams, codec, digest=None):
+    self.vault_name = vault_name
+    self.file_name = vault_name + Journal.suffix
+    self.kdf = kdf
+    self.codec = codec
+    self.digest = file_digest(vault_name) if digest is None else digest
+    # number of records, and bytes of the file holding them (None until read)
+    self.count = 0
+    self._length = None
+    self._file = None
+
+  def _associated_data(self, number):
+    return self.digest + struct.pack('<Q', number)
+
+  def records(self):
+    """Reads the records journaled for this version of the vault, as lists of fields"""
+    from cryptography.exceptions import InvalidTag
+    records = []
+    self._length = 0
+    try:
+      with open(self.file_name, 'rb') as fin:
+        data = fin.read()
+    except FileNotFoundError:
+      data = b''
+    header = Journal.magic + self.digest
+    if data[:len(header)] == header:
+      offset = len(header)
+      while offset + 16 <= len(data):
+        length, = struct.unpack_from('<I', data, offset + 12)
+        end = offset + 16 + length
+        if end > len(data):
+          break
+        try:
+          records.append(self.codec.open_record(data[offset:offset + 12], data[offset + 16:end],
+                                                self._associated_data(len(records))))
+        except InvalidTag:
+          break
+        offset = end
+      self._length = offset
+    self.count = len(records)
+    return records
+
+  def append(self, *fields):
+    """Seals fields (converted to str) as the next record and syncs it to disk"""
+    if self._file is None:
+      if self._length is None:
+        self.records()
+      if self._length:
+        self._file = open(self.file_name, 'r+b')
+        self._file.truncate(self._length)
+        self._file.seek(self._length)
+      else:
+        self._file = open(self.file_name, 'wb')
+        self._file.write(Journal.magic + self.digest)
+    nonce, ciphertext = self.codec.seal_record([str(field) for field in fields],
+                                               self._associated_data(self.count))
+    self._file.write(nonce + struct.pack('<I', len(ciphertext)) + ciphertext)
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._length = self._file.tell()
+    self.count += 1
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def discard(self):
+    """Closes and deletes the journal, once its edits are saved or declined"""
+    self.close()
+    try:
+      os.remove(self.file_name)
+    except FileNotFoundError:
+      pass
+    self.count = 0
+    self._length = 0
+
+def _fsync_directory(directory):
+  # makes the rename durable; not possible on every platform
+  try:
+    fd = os.open(directory, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+def row_fingerprint(row):
+  """Digest of the fields of a row, so that rows can be matched without comparing them whole"""
+  return hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=16).digest()
+
+def diff_rows(old, new):
+  """
+  Compares two versions of a table given as lists of row fingerprints, in
+  linear time. Rows found in both, in the same order, are unchanged; the
+  rows between two unchanged ones are paired in order as changed, and the
+  ones left over are removed from old or added to new. Returns a list of
+  ('changed', old index, new index), ('removed', old index, None) and
+  ('added', old index, new index) tuples, where an added row goes before
+  the old row of that index (len(old) for the end).
+  """
+  # new indices of each fingerprint, last first so that pop() gives the first
+  positions = {}
+  for j in range(len(new) - 1, -1, -1):
+    positions.setdefault(new[j], []).append(j)
+  anchors = []
+  last = -1
+  for i, fingerprint in enumerate(old):
+    js = positions.get(fingerprint)
+    while js and js[-1] <= last:
+      js.pop()
+    if js:
+      last = js.pop()
+      anchors.append((i, last))
+  anchors.append((len(old), len(new)))
+  changes = []
+  i = j = 0
+  for next_i, next_j in anchors:
+    paired = min(next_i - i, next_j - j)
+    changes.extend(('changed', i + k, j + k) for k in range(paired))
+    changes.extend(('removed', k, None) for k in range(i + paired, next_i))
+    changes.extend(('added', next_i, k) for k in range(j + paired, next_j))
+    i, j = next_i + 1, next_j + 1
+  return changes
+
+def read_changes(file_name, kdf:KdfParams, codec, fingerprints, progress=None):
+  """
+  Reads file_name, a CSV vault changed since the version whose rows
+  (headers first) had fingerprints, and compares the two with diff_rows.
+  Unchanged rows keep their ciphertext when a vault is saved under the
+  same key, so only the rows changed or added are decrypted. Returns
+  (encr_rows, changes, decrypted), where decrypted maps the index in
+  encr_rows of each of those rows to its plaintext. Raises WrongPassword
+  if the file is no longer under kdf, so codec cannot decrypt it, and
+  CorruptVault if it cannot be read.
+  """
+  with VaultFile(file_name, progress) as vault_file:
+    if vault_file.binary is not None or vault_file.kdf != kdf:
+      raise WrongPassword("the file was saved with another password or in another format")
+    encr_rows = vault_file.encr_rows
+    with tracer.span('diff_rows', rows=len(encr_rows)):
+      changes = diff_rows(fingerprints, [row_fingerprint(row) for row in encr_rows])
+    fresh = [new for _, _, new in changes if new is not None]
+    decrypted = vault_file._decrypt(lambda: codec.decrypt_rows([encr_rows[j] for j in fresh], progress=progress))
+  return encr_rows, changes, dict(zip(fresh, decrypted))
+
+class Vault:
+  """
+  A decrypted vault held as plain Python lists.
+  Rows are matched by their first two columns (AccountName, Username).
+  """
+
+  default_headers = ['AccountName', 'Username', 'Password', 'Comments']
+
+  def __init__(self, headers=None, rows=None):
+    self.headers = list(headers or Vault.default_headers)
+    self.rows = []
+    for row in rows or []:
+      self.rows.append(self._pad(row))
+
+  @classmethod
+  @traced('open')
+  def open(cls, file_name, password, key_cache=None):
+    if is_binary(file_name):
+      _, _, rows = read_vault(file_name, password, key_cache)
+      return cls(rows[0], rows[1:])
+    rows = iter_file(file_name, password, key_cache)
+    headers = next(rows, None)
+    if headers is None:
+      raise CorruptVault("not a vault file: no headers row")
+    return cls(headers, rows)
+
+  @traced('save')
+  def save(self, file_name, password, key_cache=None, kdf=None, binary=False):
+    if binary:
+      kdf = kdf or KdfParams.new()
+      key = new_key(bytes(password, 'utf-8'), kdf, key_cache)
+      BinaryVault.write(file_name, kdf, RowCodec(key), [self.headers] + self.rows)
+      return key
+    return write_file(file_name, password, [self.headers] + self.rows, key_cache, kdf)
+
+  def __iter__(self):
+    return iter(self.rows)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def column(self, name):
+    return self.headers.index(name)
+
+  def find(self, account, username=None):
+    """Returns the indices of rows for account (and username, when given)"""
+    return [i for i, row in enumerate(self.rows)
+            if row[0] == account and (username is None or row[1] == username)]
+
+  def search(self, text, field=None):
+    """Yields rows with a cell (in the field column, when given) containing text, ignoring case"""
+    text = text.casefold()
+    columns = [self.column(field)] if field else range(len(self.headers))
+    for row in self.rows:
+      if any(row[column] and text in row[column].casefold() for column in columns):
+        yield row
+
+  def upsert(self, row):
+    """Replaces the row with the same account and username, or appends it.
+    Returns True if the row was appended."""
+    row = self._pad(row)
+    matches = self.find(row[0], row[1])
+    if matches:
+      self.rows[matches[0]] = row
+      return False
+    self.rows.append(row)
+    return True
+
+  def delete(self, account, username=None):
+    """Deletes the rows for account (and username, when given).
+    Returns the number of rows deleted."""
+    matches = set(self.find(account, username))
+    self.rows = [row for i, row in enumerate(self.rows) if i not in matches]
+    return len(matches)
+
+  def _pad(self, row):
+    row = ['' if cell is None else cell for cell in row[:len(self.headers)]]
+    return row + [''] * (len(self.headers) - len(row))
+
+class ColumnStore:
+  """
+  Table cells held column by column, in one list per column, instead of
+  one list per row. This saves a list object per row, and a whole column
+  can be scanned without touching every row.
+  Rows shorter than the number of columns are padded with '' and longer
+  ones are cut.
+  """
+
+  __slots__ = ('_columns', '_length')
+
+  def __init__(self, num_columns, rows=()):
+    self._columns = [[] for _ in range(num_columns)]
+    self._length = 0
+    self.extend(rows)
+
+  def __len__(self):
+    return self._length
+
+  def num_columns(self):
+    return len(self._columns)
+
+  def extend(self, rows):
+    self.insert(self._length, rows)
+
+  def insert(self, position, rows):
+    rows = rows if isinstance(rows, list) else list(rows)
+    num_columns = len(self._columns)
+    if any(len(row) != num_columns for row in rows):
+      rows = [(list(row) + [''] * num_columns)[:num_columns] for row in rows]
+    if num_columns:
+      for column, values in zip(self._columns, zip(*rows) if rows else [()] * num_columns):
+        column[position:position] = values
+    self._length += len(rows)
+
+  def insert_empty(self, position, count, value=None):
+    for column in self._columns:
+      column[position:position] = [value] * count
+    self._length += count
+
+  def delete(self, first, count=1):
+    for column in self._columns:
+      del column[first:first + count]
+    self._length -= count
+
+  def row(self, row):
+    return [column[row] for column in self._columns]
+
+  def set_row(self, row, values):
+    for column, value in zip(self._columns, values):
+      column[row] = value
+
+  def cell(self, row, column):
+    return self._columns[column][row]
+
+  def set_cell(self, row, column, value):
+    self._columns[column][row] = value
+
+  def column(self, column):
+    return self._columns[column]
+
+  def rows(self):
+    return zip(*self._columns) if self._columns else iter([()] * self._length)
+
+_DIGITS = re.compile(r'(\d+)')
+
+def natural_key(text):
+  """
+  Sort key comparing text case-insensitively, with runs of digits compared
+  as numbers: 'item2' sorts before 'Item10'. Empty cells sort first.
+  A run is compared by its length without leading zeros, then digit by
+  digit, rather than through int(), which refuses very long runs.
+  """
+  if not text:
+    return ('',)
+  parts = _DIGITS.split(text.casefold())
+  parts[1::2] = [(len(run), run) for run in (run.lstrip('0') for run in parts[1::2])]
+  return tuple(parts)
+
+class SearchIndex:
+  """
+  Case-insensitive trigram index over the cells of a table, for substring,
+  prefix and column-scoped queries. Rows are identified by stable ids chosen
+  by the caller, so inserting or removing rows does not renumber the index.
+  Each cell is padded with start and end markers before it is split into
+  trigrams, so that prefix queries and queries shorter than a trigram can
+  be answered too. search() returns candidate row ids: every matching row
+  is a candidate, but candidates should be checked against the cells.
+  """
+
+  n = 3
+  start = '\x02'
+  end = '\x03'
+
+  def __init__(self, rows=None):
+    # column -> gram -> set of row ids, with missing grams read through get()
+    self._postings = {}
+    # bumped on every change, so callers can tell cached results are stale
+    self.version = 0
+    for row_id, row in rows or []:
+      self.add_row(row_id, row)
+
+  @classmethod
+  def grams(cls, text):
+    padded = cls.start + text.casefold() + cls.end
+    return {padded[i:i + cls.n] for i in range(len(padded) - cls.n + 1)}
+
+  def add_row(self, row_id, row):
+    # add_cell inlined, since building the index spends most of its time here
+    n = SearchIndex.n
+    for column, cell in enumerate(row):
+      if not cell:
+        continue
+      postings = self._postings.get(column)
+      if postings is None:
+        postings = self._postings[column] = collections.defaultdict(set)
+      padded = SearchIndex.start + cell.casefold() + SearchIndex.end
+      for i in range(len(padded) - n + 1):
+        postings[padded[i:i + n]].add(row_id)
+    self.version += 1
+
+  def remove_row(self, row_id, row):
+    for column, cell in enumerate(row):
+      self.remove_cell(row_id, column, cell)
+
+  def add_cell(self, row_id, column, cell):
+    if not cell:
+      return
+    postings = self._postings.get(column)
+    if postings is None:
+      postings = self._postings[column] = collections.defaultdict(set)
+    for gram in SearchIndex.grams(cell):
+      postings[gram].add(row_id)
+    self.version += 1
+
+  def remove_cell(self, row_id, column, cell):
+    if not cell:
+      return
+    postings = self._postings.get(column, {})
+    for gram in SearchIndex.grams(cell):
+      row_ids = postings.get(gram)
+      if row_ids is not None:
+        row_ids.discard(row_id)
+        if not row_ids:
+          del postings[gram]
+    self.version += 1
+
+  def update_cell(self, row_id, column, old, new):
+    self.remove_cell(row_id, column, old)
+    self.add_cell(row_id, column, new)
+
+  def renumber(self, new_ids):
+    """Replaces every row id with new_ids[row id]"""
+    for postings in self._postings.values():
+      for gram, row_ids in postings.items():
+        postings[gram] = {new_ids[row_id] for row_id in row_ids}
+    self.version += 1
+
+  def search(self, text, columns, prefix=False):
+    """
+    Returns the ids of rows where a cell in one of columns may contain text
+    (or start with it, with prefix), ignoring case.
+    """
+    query = (SearchIndex.start if prefix else '') + text.casefold()
+    candidates = set()
+    for column in columns:
+      postings = self._postings.get(column, {})
+      if len(query) >= SearchIndex.n:
+        # rows having every trigram of the query
+        matches = [postings.get(query[i:i + SearchIndex.n], set())
+                   for i in range(len(query) - SearchIndex.n + 1)]
+        matches.sort(key=len)
+        candidates |= matches[0].intersection(*matches[1:])
+      else:
+        # rows having any trigram that contains the query
+        for gram, row_ids in postings.items():
+          if query in gram:
+            candidates |= row_ids
+    return candidates
+
+# characters read as the letters they stand for when comparing passwords
+_LEET = str.maketrans('@4310$5!7', 'aaeiossit')
+_PASSWORD_EDGES = re.compile(r'^[\W\d_]+|[\W\d_]+$')
+_PASSWORD_SKELETON = re.compile(r'[^a-z]+')
+
+class PasswordAudit:
+  """
+  Classifies the passwords of a vault in a single pass: each password is
+  checked against Crypto.password_flaws, and reuse is found by grouping
+  rows on a keyed hash of their password rather than by comparing every
+  pair, so the cost is linear in the number of rows. Rows whose passwords
+  are equal are REUSED; rows whose passwords differ but share a skeleton
+  are SIMILAR. The skeleton is the password folded to lower case, without
+  leading and trailing digits and symbols, with the look-alike digits and
+  symbols left inside read as letters and the others dropped: 'summer'
+  for both 'Summer2023!' and 'summer24', 'password' for 'p@ssw0rd'. The hashes are HMAC-SHA256 under a key derived
+  from the vault key, so the index holds no plaintext and means nothing
+  without the key.
+  """
+
+  WEAK = 1
+  REUSED = 2
+  SIMILAR = 4
+  # skeletons shorter than this say too little to call two passwords similar
+  min_skeleton = 4
+  key_label = b'ragasiyangal password audit'
+
+  def __init__(self, key:bytes):
+    self._key = key
+    # keyed hash of a password -> ids of the rows using it
+    self._exact = collections.defaultdict(list)
+    # keyed hash of a skeleton -> (row id, keyed hash of the password) of the rows having it
+    self._similar = collections.defaultdict(list)
+    # row id -> password_flaws, for weak passwords only
+    self.flaws = {}
+    self._flags = None
+
+  def _hash(self, text):
+    return hmac.new(self._key, text.encode('utf-8'), hashlib.sha256).digest()
+
+  @staticmethod
+  def skeleton(password):
+    return _PASSWORD_SKELETON.sub('', _PASSWORD_EDGES.sub('', password.casefold()).translate(_LEET))
+
+  def add(self, row_id, password):
+    """Audits the password of one row; rows without a password are skipped"""
+    if not password:
+      return
+    flaws = Crypto.password_flaws(password)
+    if flaws:
+      self.flaws[row_id] = flaws
+    digest = self._hash(password)
+    self._exact[digest].append(row_id)
+    skeleton = PasswordAudit.skeleton(password)
+    if len(skeleton) >= PasswordAudit.min_skeleton:
+      self._similar[self._hash(skeleton)].append((row_id, digest))
+    self._flags = None
+
+  def run(self, passwords, progress=None, total=None):
+    """Audits (row id, password) pairs, reporting progress as it goes, and returns self"""
+    with tracer.span('password_audit'):
+      for row_id, password in _progress_rows(passwords, progress, "Auditing", total):
+        self.add(row_id, password)
+    return self
+
+  def flags(self):
+    """Row id -> combination of WEAK, REUSED and SIMILAR, for the rows with an issue"""
+    if self._flags is None:
+      flags = dict.fromkeys(self.flaws, PasswordAudit.WEAK)
+      for row_ids in self._exact.values():
+        if len(row_ids) > 1:
+          for row_id in row_ids:
+            flags[row_id] = flags.get(row_id, 0) | PasswordAudit.REUSED
+      for rows in self._similar.values():
+        # only a skeleton shared by different passwords makes them similar
+        if len({digest for _, digest in rows}) > 1:
+          for row_id, _ in rows:
+            flags[row_id] = flags.get(row_id, 0) | PasswordAudit.SIMILAR
+      self._flags = flags
+    return self._flags
+
+  def reuse_groups(self):
+    """Lists of the ids of rows sharing a password"""
+    return [row_ids for row_ids in self._exact.values() if len(row_ids) > 1]
+
+  def summary(self):
+    counts = {'weak': 0, 'reused': 0, 'similar': 0}
+    for flags in self.flags().values():
+      counts['weak'] += bool(flags & PasswordAudit.WEAK)
+      counts['reused'] += bool(flags & PasswordAudit.REUSED)
+      counts['similar'] += bool(flags & PasswordAudit.SIMILAR)
+    return counts
+
+  @classmethod
+  def describe(cls, flags, flaws=0):
+    """The issues of one row, as short sentences"""
+    issues = []
+    if flags & cls.WEAK:
+      issues.append("Weak password: " + ", ".join(
+        message.rstrip('.').lower() for flaw, _, message in Crypto._flaw_messages if flaws & flaw) + ".")
+    if flags & cls.REUSED:
+      issues.append("Password is used by other accounts too.")
+    if flags & cls.SIMILAR:
+      issues.append("Password is close to the password of other accounts.")
+    return issues
+
+# files taken from a directory by search_vaults
+VAULT_SUFFIXES = ('.csv', '.txt', BinaryVault.suffix)
+
+def vault_files(paths):
+  """
+  The files named by paths, each a vault file, a directory (its files
+  ending in VAULT_SUFFIXES) or a glob pattern, in order and without
+  repeats. Patterns matching nothing are passed through, to fail on open.
+  """
+  import glob
+  seen = set()
+  for path in paths:
+    if os.path.isdir(path):
+      names = sorted(os.path.join(path, name) for name in os.listdir(path)
+                     if name.endswith(VAULT_SUFFIXES) and os.path.isfile(os.path.join(path, name)))
+    elif os.path.exists(path):
+      names = [path]
+    else:
+      names = sorted(glob.glob(path)) or [path]
+    for name in names:
+      if name not in seen:
+        seen.add(name)
+        yield name
+
+def search_vaults(file_names, password, text, field=None, workers=None):
+  """
+  Searches the vaults file_names for rows with a cell (in the field
+  column, when given) containing text, ignoring case, on a process pool.
+  Keys are derived once per distinct salt and KDF parameters, all at the
+  same time, and each vault is decrypted and searched as soon as its key
+  is ready, so the whole search takes about as long as the slowest vault
+  when there are workers enough. Yields (file_name, headers, rows) as
+  each vault is searched, or (file_name, error, None) for a vault that
+  could not be. Closing the generator drops the jobs not yet started and
+  waits for the running ones.
+  """
+  from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+  groups = {}
+  for file_name in file_names:
+    try:
+      groups.setdefault(read_kdf(file_name), []).append(file_name)
+    except (OSError, CorruptVault) as error:
+      yield file_name, error, None
+  if not groups:
+    return
+  num_files = sum(len(names) for names in groups.values())
+  pool = ProcessPoolExecutor(workers or min(num_files, Crypto.parallel_workers))
+  try:
+    with tracer.span('search', vaults=num_files, keys=len(groups)):
+      # future -> the KdfParams whose key it derives, or the file it searches
+      pending = {pool.submit(_derive_search_key, kdf, bytes(password, 'utf-8')): kdf for kdf in groups}
+      while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          job = pending.pop(future)
+          if isinstance(job, KdfParams):
+            try:
+              key = future.result()
+            except Exception as error:
+              for file_name in groups[job]:
+                yield file_name, error, None
+              continue
+            for file_name in groups[job]:
+              pending[pool.submit(_search_file, file_name, key, text, field)] = file_name
+            continue
+          try:
+            headers, rows = future.result()
+          except Exception as error:
+            yield job, error, None
+          else:
+            yield job, headers, rows
+  finally:
+    # jobs not started are dropped, and the running ones waited for, so
+    # that the workers are gone before the interpreter exits
+    pool.shutdown(wait=True, cancel_futures=True)
+
+def _derive_search_key(kdf, password):
+  return kdf.derive_key(password)
+
+def _search_file(file_name, key, text, field):
+  # runs in a search_vaults worker process, which is busy enough without
+  # a pool of its own for the rows
+  with VaultFile(file_name) as vault_file:
+    codec = RowCodec(vault_file.check_key(key))
+    rows = vault_file.rows(codec, workers=1)
+  vault = Vault(rows[0], rows[1:])
+  if field and field not in vault.headers:
+    raise ValueError("no column " + field)
+  return vault.headers, list(vault.search(text, field))
+
+COMMANDS = ('list', 'get', 'export', 'import', 'rekey', 'convert', 'calibrate', 'search', 'audit')
+
+def _password(env_name, prompt, confirm=False):
+  import getpass
+  password = os.environ.get(env_name)
+  if password:
+    return password
+  password = getpass.getpass(prompt)
+  if confirm:
+    if password != getpass.getpass("Re-enter " + prompt.lower()):
+      raise SystemExit("Passwords don't match")
+    pwd_chk = Crypto.password_check(password)
+    if not pwd_chk['password_ok']:
+      print("Warning: the password you entered is weak because:\n" + pwd_chk['error_msg'], file=sys.stderr)
+  return password
+
+def _exit(file_name, error):
+  # SystemExit for an error reading or writing file_name, or the file an OSError names
+  if isinstance(error, OSError):
+    return SystemExit(str(error.filename or file_name) + ": " + (error.strerror or str(error)))
+  return SystemExit(file_name + ": " + str(error))
+
+def _open(file_name):
+  try:
+    return Vault.open(file_name, _password('RAGASIYANGAL_PASSWORD', "Password: "))
+  except (OSError, WrongPassword, CorruptVault) as error:
+    raise _exit(file_name, error)
+
+def _cmd_list(args):
+  vault = _open(args.vault)
+  writer = csv.writer(sys.stdout)
+  for row in vault:
+    writer.writerow(row[:2])
+
+def _cmd_get(args):
+  vault = _open(args.vault)
+  rows = [vault.rows[i] for i in vault.find(args.account, args.username)]
+  if not rows:
+    raise SystemExit(args.account + ": not found")
+  if args.field:
+    if args.field not in vault.headers:
+      raise SystemExit("unknown field " + args.field + ", the fields are: " + ", ".join(vault.headers))
+    column = vault.column(args.field)
+    for row in rows:
+      print(row[column])
+  else:
+    writer = csv.writer(sys.stdout)
+    writer.writerow(vault.headers)
+    writer.writerows(rows)
+
+def _cmd_export(args):
+  vault = _open(args.vault)
+  try:
+    fout = open(args.output, 'w', newline='') if args.output != '-' else sys.stdout
+  except OSError as error:
+    raise _exit(args.output, error)
+  try:
+    writer = csv.writer(fout)
+    writer.writerow(vault.headers)
+    writer.writerows(vault)
+  finally:
+    if fout is not sys.stdout:
+      fout.close()
+
+def _cmd_import(args):
+  try:
+    fin = open(args.csv)
+  except OSError as error:
+    raise _exit(args.csv, error)
+  with fin:
+    headers, chunks = read_import(fin)
+    if not headers:
+      raise SystemExit(args.csv + ": empty file")
+    reader = (row for rows in chunks for row in rows)
+    if args.merge and os.path.exists(args.vault):
+      password = _password('RAGASIYANGAL_PASSWORD', "Password: ")
+      try:
+        vault = Vault.open(args.vault, password)
+      except (OSError, WrongPassword, CorruptVault) as error:
+        raise _exit(args.vault, error)
+      added = sum(vault.upsert(row) for row in reader)
+    else:
+      password = _password('RAGASIYANGAL_PASSWORD', "Password: ", confirm=True)
+      vault = Vault(headers, reader)
+      added = len(vault)
+  try:
+    vault.save(args.vault, password, kdf=_kdf(args), binary=binary_target(args.vault))
+  except OSError as error:
+    raise _exit(args.vault, error)
+  print("%d rows, %d added" % (len(vault), added), file=sys.stderr)
+
+def _cmd_rekey(args):
+  password = _password('RAGASIYANGAL_PASSWORD', "Password: ")
+  new_password = _password('RAGASIYANGAL_NEW_PASSWORD', "New password: ", confirm=True)
+  try:
+    reencrypted = rekey_file(args.vault, password, new_password, args.output, _kdf(args), args.rotate_key)
+  except (OSError, WrongPassword, CorruptVault) as error:
+    raise _exit(args.vault, error)
+  print("rows encrypted again under a new data key" if reencrypted else "password changed, rows kept as they are",
+        file=sys.stderr)
+
+def _cmd_convert(args):
+  password = _password('RAGASIYANGAL_PASSWORD', "Password: ")
+  binary = {'binary': True, 'csv': False}.get(args.to)
+  try:
+    binary = convert_file(args.vault, args.output, password, binary)
+  except (OSError, WrongPassword, CorruptVault) as error:
+    raise _exit(args.vault, error)
+  print("%s: %d bytes, %s: %d bytes (%s)" % (args.vault, os.path.getsize(args.vault), args.output,
+                                              os.path.getsize(args.output), 'binary' if binary else 'csv'),
+        file=sys.stderr)
+
+def _cmd_search(args):
+  file_names = list(vault_files(args.vaults))
+  password = _password('RAGASIYANGAL_PASSWORD', "Password: ")
+  writer = csv.writer(sys.stdout)
+  found = 0
+  results = search_vaults(file_names, password, args.text, args.field, args.workers)
+  try:
+    for file_name, headers, rows in results:
+      if rows is None:
+        print(file_name + ": " + str(headers), file=sys.stderr)
+        continue
+      for row in rows[:1] if args.first else rows:
+        writer.writerow([file_name] + row)
+      sys.stdout.flush()
+      found += len(rows)
+      if found and args.first:
+        break
+  finally:
+    results.close()
+  if not found:
+    raise SystemExit(args.text + ": not found")
+
+def _kdf(args):
+  return KdfParams.new(args.kdf, args.kdf_time)
+
+def _cmd_audit(args):
+  vault = _open(args.vault)
+  if 'Password' not in vault.headers:
+    raise SystemExit(args.vault + ": no column Password")
+  column = vault.column('Password')
+  # the index lives only as long as the command, so it gets a key of its own
+  audit = PasswordAudit(os.urandom(32)).run((row_id, row[column]) for row_id, row in enumerate(vault))
+  flags = audit.flags()
+  writer = csv.writer(sys.stdout)
+  for row_id in sorted(flags):
+    row = vault.rows[row_id]
+    writer.writerow(row[:2] + [' '.join(PasswordAudit.describe(flags[row_id], audit.flaws.get(row_id, 0)))])
+  print("%(weak)d weak, %(reused)d reused, %(similar)d similar passwords" % audit.summary(), file=sys.stderr)
+
+def _cmd_calibrate(args):
+  kdf = KdfParams.new(args.kdf, args.kdf_time)
+  start = time.perf_counter()
+  kdf.derive_key(b'calibration')
+  print("%s  (%.3f s)" % (kdf.line().partition(' salt=')[0], time.perf_counter() - start))
+
+def add_kdf_arguments(parser):
+  parser.add_argument('--kdf', choices=KdfParams.kdfs,
+                      help="key derivation function, default " + KdfParams.default_kdf)
+  parser.add_argument('--kdf-time', type=float, metavar='SECONDS',
+                      help="target time to derive a key on this machine, default %g" % KdfParams.target_seconds)
+
+def add_trace_arguments(parser):
+  parser.add_argument('--trace', metavar='FILE',
+                      help="write timings of the vault operations to FILE as a JSON trace")
+  parser.add_argument('--trace-memory', action='store_true',
+                      help="with --trace, also record memory use with tracemalloc")
+
+def enable_trace(args):
+  if args.trace:
+    tracer.enable(args.trace, args.trace_memory)
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(prog='ragasiyangal',
+                                   description="Ragasiyangal password manager. "
+                                               "Run without arguments to start the GUI.")
+  commands = parser.add_subparsers(dest='command', required=True)
+  trace_options = argparse.ArgumentParser(add_help=False)
+  add_trace_arguments(trace_options)
+
+  cmd = commands.add_parser('list', parents=[trace_options], help="list account names and usernames")
+  cmd.add_argument('vault')
+  cmd.set_defaults(func=_cmd_list)
+
+  cmd = commands.add_parser('get', parents=[trace_options], help="print the rows for an account")
+  cmd.add_argument('vault')
+  cmd.add_argument('account')
+  cmd.add_argument('--username', help="only rows with this username")
+  cmd.add_argument('--field', help="print only this column, e.g. Password")
+  cmd.set_defaults(func=_cmd_get)
+
+  cmd = commands.add_parser('export', parents=[trace_options], help="write the vault as a plaintext CSV file")
+  cmd.add_argument('vault')
+  cmd.add_argument('output', nargs='?', default='-', help="output file, default stdout")
+  cmd.set_defaults(func=_cmd_export)
+
+  cmd = commands.add_parser('import', parents=[trace_options], help="encrypt a plaintext CSV file into a vault")
+  cmd.add_argument('csv')
+  cmd.add_argument('vault')
+  cmd.add_argument('--merge', action='store_true',
+                   help="add or update rows of an existing vault instead of replacing it")
+  add_kdf_arguments(cmd)
+  cmd.set_defaults(func=_cmd_import)
+
+  cmd = commands.add_parser('rekey', parents=[trace_options], help="re-encrypt the vault under a new password")
+  cmd.add_argument('vault')
+  cmd.add_argument('output', nargs='?', help="output file, default is to overwrite the vault")
+  cmd.add_argument('--rotate-key', action='store_true',
+                   help="also encrypt every row again under a new data key")
+  add_kdf_arguments(cmd)
+  cmd.set_defaults(func=_cmd_rekey)
+
+  cmd = commands.add_parser('convert', parents=[trace_options],
+                            help="write the vault in the binary format, or a binary vault as CSV")
+  cmd.add_argument('vault')
+  cmd.add_argument('output')
+  cmd.add_argument('--to', choices=('binary', 'csv'),
+                   help="output format, default the other format than the vault's")
+  cmd.set_defaults(func=_cmd_convert)
+
+  cmd = commands.add_parser('search', parents=[trace_options],
+                            help="print the rows containing text from many vaults at once")
+  cmd.add_argument('text')
+  cmd.add_argument('vaults', nargs='+', help="vault files, directories or glob patterns")
+  cmd.add_argument('--field', help="search only this column, e.g. AccountName")
+  cmd.add_argument('--first', action='store_true', help="stop at the first matching row")
+  cmd.add_argument('--workers', type=int, help="worker processes, default one per vault up to the CPU count")
+  cmd.set_defaults(func=_cmd_search)
+
+  cmd = commands.add_parser('audit', parents=[trace_options],
+                            help="list the accounts with weak, reused or similar passwords")
+  cmd.add_argument('vault')
+  cmd.set_defaults(func=_cmd_audit)
+
+  cmd = commands.add_parser('calibrate', parents=[trace_options],
+                            help="print the key derivation parameters new vaults get on this machine")
+  add_kdf_arguments(cmd)
+  cmd.set_defaults(func=_cmd_calibrate)
+
+  args = parser.parse_args(argv)
+  enable_trace(args)
+  args.func(args)
+  return 0
+
+if __name__=='__main__':
+  sys.exit(main())